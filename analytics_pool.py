@@ -0,0 +1,159 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import multiprocessing
+import logging
+import threading
+import numpy as np
+import pandas as pd
+
+from implied_volatility import implied_volatility
+from volatility_index import expiry_slice
+
+
+class AnalyticsPool:
+
+    """
+    Runs the per snapshot analytics (implied volatilities of bids and asks
+    plus the per expiry BVIX slice) in a pool of worker processes.
+    The chain is sorted by expiration and each expiry is one task.
+    Instead of pickling DataFrames, the snapshot columns are copied into a
+    shared memory block which workers map, and implied volatilities are
+    written straight into a second shared block. Only the small per expiry
+    slices travel back through the pool. Blocks are reused across snapshots
+    and only reallocated when the chain grows beyond their capacity.
+    """
+
+    columns = ["bid", "ask", "bid_usd", "ask_usd", "forward", "strike",
+               "ttmyears", "is_call"]
+
+    def __init__(self, workers, grid):
+        self.logger = logging.getLogger("deribit")
+        self.workers = workers
+        self.grid = list(grid)
+
+        # spawned workers do not inherit locks held by the websocket threads
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        self.capacity = 0
+        self.shm_in = None
+        self.shm_out = None
+
+        # workers start and import their modules now, not at the first snapshot
+        for _ in range(workers):
+            self.executor.submit(warm_up)
+
+
+    def ensure_capacity(self, n):
+        if n <= self.capacity:
+            return
+        self.release_memory()
+        self.capacity = int(n * 1.5) + 1
+        self.shm_in = shared_memory.SharedMemory(
+            create=True, size=len(self.columns) * self.capacity * 8)
+        self.shm_out = shared_memory.SharedMemory(create=True, size=2 * self.capacity * 8)
+
+
+    def process(self, df):
+
+        """
+        Returns bid ivs and ask ivs (aligned with df) and the BVIX slices
+        {expiration: ExpirySlice}.
+        """
+
+        # one snapshot at a time, a pool can be shared by the currencies' snapshots
+        with self.lock:
+            n = len(df)
+            self.ensure_capacity(n)
+            inputs = np.ndarray((len(self.columns), self.capacity), dtype=np.float64,
+                                buffer=self.shm_in.buf)
+            outputs = np.ndarray((2, self.capacity), dtype=np.float64, buffer=self.shm_out.buf)
+
+            expirations = pd.to_datetime(df["expiration"], utc=True).dt.tz_localize(None).to_numpy()
+            order = np.argsort(expirations, kind="stable")
+
+            for row, column in enumerate(self.columns):
+                if column == "is_call":
+                    values = (df["typ"] == "C").to_numpy(dtype=np.float64)
+                else:
+                    values = df[column].to_numpy(dtype=np.float64)
+                inputs[row, :n] = values[order]
+
+            sorted_expirations = expirations[order]
+            starts = np.flatnonzero(np.r_[True, sorted_expirations[1:] != sorted_expirations[:-1]])
+            stops = np.r_[starts[1:], n]
+
+            tasks = dict()
+            for start, stop in zip(starts, stops):
+                expiration = pd.Timestamp(sorted_expirations[start]).tz_localize("UTC")
+                tasks[expiration] = self.executor.submit(process_partition, self.shm_in.name,
+                                                         self.shm_out.name, self.capacity,
+                                                         int(start), int(stop), self.grid)
+
+            slices = {expiration: task.result() for expiration, task in tasks.items()}
+
+            bid_iv = np.empty(n)
+            ask_iv = np.empty(n)
+            bid_iv[order] = outputs[0, :n]
+            ask_iv[order] = outputs[1, :n]
+            return bid_iv, ask_iv, slices
+
+
+    def release_memory(self):
+        for block in [self.shm_in, self.shm_out]:
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.shm_in = None
+        self.shm_out = None
+        self.capacity = 0
+
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.release_memory()
+
+
+
+# Shared memory blocks attached by a worker, kept open between tasks
+_attached = dict()
+
+
+def _attach(name):
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    return _attached[name]
+
+
+def _forget_other_blocks(names):
+    # blocks are replaced when the chain outgrows them
+    for name in list(_attached.keys()):
+        if name not in names:
+            _attached.pop(name).close()
+
+
+def warm_up():
+    pass
+
+
+def process_partition(in_name, out_name, capacity, start, stop, grid):
+
+    """ Worker task: ivs for one expiry written in place, slice returned """
+
+    _forget_other_blocks([in_name, out_name])
+    inputs = np.ndarray((len(AnalyticsPool.columns), capacity), dtype=np.float64,
+                        buffer=_attach(in_name).buf)
+    outputs = np.ndarray((2, capacity), dtype=np.float64, buffer=_attach(out_name).buf)
+
+    bid, ask, bid_usd, ask_usd, forward, strike, ttm, is_call = inputs[:, start:stop]
+    is_call = is_call.astype(bool)
+    bid_iv = outputs[0, start:stop]
+    ask_iv = outputs[1, start:stop]
+
+    implied_volatility(bid_usd, forward, strike, ttm, is_call, out=bid_iv)
+    implied_volatility(ask_usd, forward, strike, ttm, is_call, out=ask_iv)
+    np.round(bid_iv, 4, out=bid_iv)
+    np.round(ask_iv, 4, out=ask_iv)
+
+    return expiry_slice(bid, ask, bid_iv, ask_iv, strike, forward, is_call,
+                        float(ttm[0]) * 365, grid)
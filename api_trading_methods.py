@@ -1,3 +1,7 @@
+import json
+from json.encoder import encode_basestring
+
+
 class ApiMethods:
     
     """
@@ -16,7 +20,7 @@ class ApiMethods:
                    order_type=None, label=None, price=None, time_in_force=None, 
                    max_show=None, post_only=None, reject_post_only=None, 
                    reduce_only=None, trigger=None, trigger_price=None, 
-                   trigger_offset=None, advanced=None, mmp=None, valid_until=None:
+                   trigger_offset=None, advanced=None, mmp=None, valid_until=None):
         
         if instrument == None or side == None or amount == None:
             print("Required arguments not provided: instrument / side / amount")
@@ -73,5 +77,63 @@ class ApiMethods:
         return [message, calltype]
     
     
+    def order_template(self, instrument, side, order_type, size_multiplier=1, 
+                       label_prefix="manual_api_", **options):
+        return OrderTemplate(self, instrument, side, order_type, size_multiplier, 
+                             label_prefix, **options)
+
+
+
+class OrderTemplate:
+    
+    """
+    An order with everything but amount, price, label number (and trigger 
+    price for stops) fixed, compiled once into the final JSON-RPC frame with 
+    placeholders. Filling it skips send_order's checks and json.dumps; the 
+    frame is identical to what send_to_ws would produce for the same params.
+    """
+    
+    variable_fields = ["amount", "price", "label", "trigger_price"]
+    
+    def __init__(self, api_methods, instrument, side, order_type, size_multiplier, 
+                 label_prefix, **options):
+        self.size_multiplier = size_multiplier
+        self.label_prefix = label_prefix
+        
+        # send_order with markers in the variable fields, so key order is the same
+        markers = {field: "@{}@".format(field) for field in self.variable_fields}
+        if "trigger" in options:
+            options["trigger_price"] = markers["trigger_price"]
+        else:
+            del markers["trigger_price"]
+        self.params, self.call_type = api_methods.send_order(
+            instrument, side, markers["amount"], order_type, markers["label"], 
+            markers["price"], **options)
+        self.fields = list(markers)
+        
+        frame = json.dumps({"jsonrpc" : "2.0", 
+                            "id" : "@id@", 
+                            "method" : self.call_type, 
+                            "params" : self.params}).replace("%", "%%")
+        for field in ["id"] + self.fields:
+            frame = frame.replace('"@{}@"'.format(field), "%({})s".format(field))
+        self.frame = frame
+    
+    
+    def order(self, amount, price, label_number, trigger_price=None):
+        """ [params, call_type, template] request, amount in size multiplier units """
+        params = self.params.copy()
+        params["amount"] = amount * self.size_multiplier
+        params["price"] = price
+        params["label"] = self.label_prefix + str(label_number)
+        if "trigger_price" in params:
+            params["trigger_price"] = trigger_price
+        return [params, self.call_type, self]
     
     
+    def serialize(self, call_id, params):
+        values = {field: params[field] for field in self.fields}
+        values["label"] = encode_basestring(values["label"])
+        values["id"] = call_id
+        return self.frame % values
+
@@ -0,0 +1,158 @@
+"""
+Logging off the caller's thread. Records go into a bounded queue and a
+listener thread formats and writes them (terminal and file), so a slow
+terminal or disk never holds up the websocket thread. When the queue is
+full, records are dropped and counted instead of blocking.
+
+Repetitive messages are limited per call site (module and line): 'burst'
+records pass per 'period' seconds, of the rest only every 'sample'th
+(0 = none). The next record passed notes how many were suppressed.
+Records logged with extra={"unlimited": True} (e.g. the legs of a rejected
+batch, which come all at once from one line) always pass.
+
+The file is written as JSON lines (one object per record) unless
+json_file is off, the terminal keeps the plain text format.
+"""
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import queue
+import time
+
+
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(module)s - %(message)s"
+
+
+class AsyncQueueHandler(QueueHandler):
+
+    """ Enqueues records as they are, formatting happens on the listener thread """
+
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+
+    def prepare(self, record):
+        return record
+
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+
+class RateLimitFilter(logging.Filter):
+
+    """
+    Limits records per call site, see module docstring. Errors and unlimited
+    records always pass.
+    Runs on the thread that logs, without locks; concurrent records of one call
+    site may be miscounted by one, which is fine for a limit.
+    """
+
+    def __init__(self, burst=10, period=10, sample=0):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.sample = sample
+        self.sites = dict() # (pathname, lineno) -> [window start, records, suppressed]
+        self.suppressed = 0
+
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR or getattr(record, "unlimited", False):
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None:
+            self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            return True
+
+        if now - site[0] > self.period:
+            site[0] = now
+            site[1] = 0
+        site[1] += 1
+        if site[1] <= self.burst or (self.sample and (site[1] - self.burst) % self.sample == 0):
+            if site[2]:
+                record.suppressed = site[2]
+                site[2] = 0
+            return True
+        site[2] += 1
+        self.suppressed += 1
+        return False
+
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += " ({} similar messages suppressed)".format(record.suppressed)
+        return text
+
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                     timespec="milliseconds"),
+                 "level": record.levelname,
+                 "module": record.module,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+
+def setup_async_logging(logger, path="deribit.log", json_file=True, burst=10, period=10,
+                        sample=0, queue_size=10000):
+
+    """
+    Routes the logger through a queue to a stream and a file handler on a
+    listener thread. Returns the queue handler (depth, dropped) and the
+    listener, which is stopped (and the queue flushed) at exit.
+    """
+
+    text = TextFormatter(fmt=TEXT_FORMAT)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(text)
+    file_handler = logging.FileHandler(path, mode="w")
+    file_handler.setFormatter(JsonFormatter() if json_file else text)
+
+    handler = AsyncQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(RateLimitFilter(burst, period, sample))
+    listener = QueueListener(handler.queue, stream_handler, file_handler,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, listener)
+    logger.addHandler(handler)
+    return handler, listener
+
+
+def stop_listener(listener, timeout=5):
+    """ Writes what is queued and ends the listener thread, if it still runs """
+    if listener._thread is None:
+        return
+    try:
+        # QueueListener.stop would not wait for room in a full queue
+        listener.queue.put(listener._sentinel, timeout=timeout)
+    except queue.Full:
+        return
+    listener._thread.join(timeout)
+    listener._thread = None
@@ -0,0 +1,239 @@
+"""
+OHLC bars of the futures at several timeframes (e.g. 1s, 1m, 5m), built as
+the quotes and trades come in, for strategies which should never rescan
+ticks. Open, high, low and close are those of the mid price from the best
+bid and offer (DataFeed.update_futures_bbo); volume, VWAP, signed flow
+(taker buys minus sells) and the number of trades come from the prints on
+the tape (DataFeed.update_trades).
+
+Closed bars go into fixed size columns per instrument and timeframe (ring
+buffers of preallocated arrays, the oldest bar is overwritten), so memory
+does not grow with the session. Bars are closed by exchange time: the first
+quote or trade of any instrument past a bar's end closes that bar for all
+instruments. A bar opens at the previous close, so one without quotes is
+flat; after a gap (e.g. a reconnect) at most a buffer's worth of such bars
+is written.
+
+    bars = BarAggregator(timeframes=(1, 60, 300))
+    bars.on_close(callback, 60)         # callback(instrument, seconds, bar) per closed 1m bar
+    bars.bars("BTC-PERPETUAL", 60, 30)  # the last 30 closed 1m bars as columns
+    bars.forming("BTC-PERPETUAL", 60)   # the 1m bar still forming
+
+Callbacks run on the websocket thread once the bars are written, so they
+should be quick (or hand the bar on to a thread of their own).
+"""
+
+from array import array
+import logging
+import math
+import threading
+
+
+COLUMNS = ["start", "open", "high", "low", "close", "volume", "vwap", "flow", "trades"]
+
+
+class BarSeries:
+
+    """ One instrument's bars of one timeframe: the forming bar and the closed ones in columns """
+
+    __slots__ = ("period", "capacity", "columns", "count", "start", "open", "high", "low",
+                 "close", "volume", "notional", "flow", "trades")
+
+    def __init__(self, seconds, capacity):
+        self.period = int(seconds * 1000)
+        self.capacity = capacity
+        self.columns = {column: array("q" if column in ("start", "trades") else "d",
+                                      bytes(8 * capacity))
+                        for column in COLUMNS}
+        self.count = 0 # bars closed so far, the next one goes to count % capacity
+        self.start = None # the forming bar, in ms since epoch
+        self.open = self.high = self.low = self.close = math.nan
+        self.volume = self.notional = self.flow = 0.
+        self.trades = 0
+
+
+    def begin(self, timestamp):
+        if self.start is None:
+            self.start = timestamp - timestamp % self.period
+
+
+    def quote(self, price):
+        if self.open != self.open: # nan until the first quote
+            self.open = self.high = self.low = price
+        elif price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+
+
+    def trade(self, price, amount, side):
+        self.volume += amount
+        self.notional += price * amount
+        self.flow += side * amount
+        self.trades += 1
+
+
+    def close_until(self, timestamp, closed):
+        """ Closes the bars ending up to timestamp, appends them to closed """
+        if self.start is None:
+            return
+        bars = (timestamp - self.start) // self.period
+        if bars <= 0:
+            return
+        self.write(closed)
+        self.reset()
+        # bars without quotes in between, of a long gap only the last capacity are kept
+        empty = min(bars - 1, self.capacity)
+        self.start += (bars - empty) * self.period
+        for _ in range(empty):
+            self.write(closed)
+            self.start += self.period
+
+
+    def reset(self):
+        # the next bar opens at the close
+        self.open = self.high = self.low = self.close
+        self.volume = self.notional = self.flow = 0.
+        self.trades = 0
+
+
+    def write(self, closed):
+        i = self.count % self.capacity
+        bar = self.bar()
+        for column in COLUMNS:
+            self.columns[column][i] = bar[column]
+        self.count += 1
+        closed.append(bar)
+
+
+    def bar(self):
+        return {"start": self.start, "open": self.open, "high": self.high, "low": self.low,
+                "close": self.close, "volume": self.volume,
+                "vwap": self.notional / self.volume if self.volume > 0 else math.nan,
+                "flow": self.flow, "trades": self.trades}
+
+
+    def ordered(self, count):
+        """ The last count closed bars as columns, oldest first """
+        held = min(self.count, self.capacity)
+        count = held if count is None else max(min(count, held), 0)
+        end = self.count % self.capacity
+        result = dict()
+        for column in COLUMNS:
+            values = self.columns[column]
+            if self.count <= self.capacity:
+                result[column] = values[self.count - count:self.count].tolist()
+            else:
+                result[column] = (values[end:].tolist() + values[:end].tolist())[held - count:]
+        return result
+
+
+
+class BarAggregator:
+
+    """
+    Bars of every future at each timeframe (seconds), capacity closed bars
+    kept per instrument and timeframe. See module docstring.
+    """
+
+    def __init__(self, timeframes=(1, 60, 300), capacity=1440):
+        self.logger = logging.getLogger("deribit")
+        self.timeframes = [int(seconds) for seconds in timeframes]
+        self.capacity = capacity
+        self.series = dict() # instrument -> [BarSeries per timeframe]
+        self.next_close = [0] * len(self.timeframes) # earliest end of a forming bar per timeframe, in ms
+        self.callbacks = [] # (timeframe or None for all, callback)
+        self.lock = threading.Lock()
+
+
+    def on_close(self, callback, timeframe=None):
+        """ callback(instrument, seconds, bar) for each closed bar (of the timeframe or all) """
+        self.callbacks.append((timeframe, callback))
+
+
+    def on_quote(self, instrument, timestamp, price):
+        with self.lock:
+            closed = self.advance(timestamp)
+            for series in self.instrument_series(instrument):
+                series.begin(timestamp)
+                series.quote(price)
+        if closed:
+            self.notify(closed)
+
+
+    def on_trades(self, data):
+        closed = []
+        with self.lock:
+            for trade in data:
+                name = trade["instrument_name"]
+                if name.count("-") == 3: # options are not aggregated
+                    continue
+                closed += self.advance(trade["timestamp"])
+                side = 1 if trade["direction"] == "buy" else -1
+                for series in self.instrument_series(name):
+                    series.begin(trade["timestamp"])
+                    series.trade(trade["price"], trade["amount"], side)
+        if closed:
+            self.notify(closed)
+
+
+    def instrument_series(self, instrument):
+        series = self.series.get(instrument)
+        if series is None:
+            series = [BarSeries(seconds, self.capacity) for seconds in self.timeframes]
+            self.series[instrument] = series
+        return series
+
+
+    def advance(self, timestamp):
+        """ Closes the bars of all instruments which ended before timestamp """
+        closed = []
+        for k, seconds in enumerate(self.timeframes):
+            if timestamp < self.next_close[k]:
+                continue
+            for instrument, series in self.series.items():
+                bars = []
+                series[k].close_until(timestamp, bars)
+                closed += [(instrument, seconds, bar) for bar in bars]
+            period = int(seconds * 1000)
+            self.next_close[k] = timestamp - timestamp % period + period
+        return closed
+
+
+    def notify(self, closed):
+        # outside the lock, so callbacks may read the bars
+        for instrument, seconds, bar in closed:
+            for timeframe, callback in self.callbacks:
+                if timeframe is None or timeframe == seconds:
+                    try:
+                        callback(instrument, seconds, bar)
+                    except Exception:
+                        self.logger.exception("Error in a bar close callback.")
+
+
+    def remove(self, instrument):
+        with self.lock:
+            self.series.pop(instrument, None)
+
+
+    def instruments(self):
+        return list(self.series)
+
+
+    def bars(self, instrument, seconds, count=None):
+        """ The instrument's last count closed bars (all held by default) as columns, oldest first """
+        with self.lock:
+            series = self.series.get(instrument)
+            if series is None or seconds not in self.timeframes:
+                return None
+            return series[self.timeframes.index(seconds)].ordered(count)
+
+
+    def forming(self, instrument, seconds):
+        """ The instrument's bar which is not closed yet """
+        with self.lock:
+            series = self.series.get(instrument)
+            if series is None or seconds not in self.timeframes:
+                return None
+            return series[self.timeframes.index(seconds)].bar()
@@ -0,0 +1,99 @@
+"""
+Compares the project's implied volatility solver with py_vollib_vectorized
+on synthetic, deribit-like option chains (r = q = 0, USD prices).
+
+Usage: python benchmarks/iv_benchmark.py [--sizes 250 1000 4000] [--repeats 50]
+
+py_vollib_vectorized is optional. Without it, only the in-house solver is
+timed and its accuracy is checked by repricing.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from implied_volatility import implied_volatility, black_price, black_delta
+
+
+def synthetic_chain(n, underlying=20000., seed=0):
+    """ Strikes, maturities and vols roughly resembling a deribit BTC chain """
+    rng = np.random.default_rng(seed)
+    strikes = np.round(underlying * np.exp(rng.uniform(-1.2, 1.0, n)), -3)
+    strikes = np.maximum(strikes, 1000.)
+    ttm = rng.choice([1, 2, 3, 7, 14, 21, 49, 77, 140, 231, 322], n) / 365
+    sigma = rng.uniform(0.35, 1.5, n)
+    is_call = rng.random(n) < 0.5
+    prices = black_price(underlying, strikes, ttm, sigma, is_call)
+    # deribit quotes in BTC with a 0.0005 tick, converted back to USD
+    prices = np.maximum(np.round(prices / underlying / 0.0005) * 0.0005, 0.0005) * underlying
+    return prices, underlying, strikes, ttm, is_call
+
+
+def time_call(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1e3, np.min(timings) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 1000, 4000])
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        from py_vollib_vectorized import vectorized_implied_volatility as viv
+    except Exception as e:
+        viv = None
+        print("py_vollib_vectorized not available ({}), timing in-house solver only.".format(e))
+    else:
+        print("py_vollib_vectorized import: {:.1f} ms".format((time.perf_counter() - start) * 1e3))
+
+    for n in args.sizes:
+        prices, underlying, strikes, ttm, is_call = synthetic_chain(n)
+        out = np.empty(n)
+
+        median, best = time_call(lambda: implied_volatility(prices, underlying, strikes,
+                                                            ttm, is_call, out=out), args.repeats)
+        ivs = out.copy()
+        repriced = black_price(underlying, strikes, ttm, ivs, is_call)
+        reprice_error = np.nanmax(np.abs(repriced - prices))
+        print("n={:5d} in-house   median {:7.3f} ms  best {:7.3f} ms  "
+              "max reprice error {:.2e} USD  NaN {}".format(n, median, best, reprice_error,
+                                                             int(np.isnan(ivs).sum())))
+
+        median, best = time_call(lambda: black_delta(underlying, strikes, ttm, ivs, is_call),
+                                 args.repeats)
+        print("n={:5d} delta      median {:7.3f} ms  best {:7.3f} ms".format(n, median, best))
+
+        if viv is not None:
+            flags = np.where(is_call, "c", "p")
+            run = lambda: viv(prices, underlying, strikes, ttm, 0, flags, 0,
+                              on_error="ignore", model="black_scholes_merton",
+                              return_as="numpy")
+            try:
+                reference = run()
+            except Exception as e:
+                print("py_vollib_vectorized failed ({}), skipping comparison.".format(
+                    str(e).splitlines()[0]))
+                viv = None
+                continue
+            median, best = time_call(run, args.repeats)
+            difference = np.nanmax(np.abs(reference - ivs))
+            mismatched_masks = int((np.isnan(reference) != np.isnan(ivs)).sum())
+            print("n={:5d} py_vollib  median {:7.3f} ms  best {:7.3f} ms  "
+                  "max |iv diff| {:.2e}  mask mismatches {}".format(n, median, best, difference,
+                                                                    mismatched_masks))
+
+
+if __name__ == "__main__":
+    main()
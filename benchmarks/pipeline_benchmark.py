@@ -0,0 +1,241 @@
+"""
+Times the message and analytics paths of the bot offline, on synthetic
+Deribit traffic (synthetic_feed.py):
+
+    message_distribution   WSClient.message_distribution, per raw frame
+    update_options_ob      DataFeed.update_options_ob, per book change
+    take_snapshot          SaveBBO.take_snapshot, the whole minutely snapshot
+    book_collection        take_snapshot up to the DataFrame of best quotes
+    options_calculations   SaveBBO.options_calculations without the BVIX part
+    create_volsurf_snapshot  BVIX.create_volsurf_snapshot incl. the SVI fit
+    determine_option_delta DeltaHedge.determine_option_delta, with a fresh
+                           surface and without (ivs solved from marks)
+
+Usage: python benchmarks/pipeline_benchmark.py [--options 800] [--messages 50000]
+       [--repeats 10] [--positions 40] [--output results.json] [--compare old.json]
+
+Each path reports throughput (calls per second) and latency percentiles in
+microseconds. Results are written as JSON (default benchmarks/results/
+<timestamp>.json); --compare prints the p50 ratio against an earlier file.
+Database writes go to an in-memory SQLite database. message_distribution
+needs the websocket-client package (it is skipped without it).
+"""
+
+from datetime import datetime
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_feed import SyntheticDeribit
+from data_feed import DataFeed
+from forward_curve import ForwardCurve
+from vol_surface import VolSurface
+from hedger import DeltaHedge
+
+
+class NullCursor:
+
+    """ Stands in for the psycopg2 cursor / connection, DDL is not timed """
+
+    def execute(self, *args, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def fetchone(self):
+        return None
+
+    def cursor(self):
+        return self
+
+
+class NullSocket:
+
+    def send(self, message):
+        pass
+
+
+def summary(timings, calls_per_timing=1):
+    timings = np.asarray(timings)
+    return {"calls": int(len(timings) * calls_per_timing),
+            "throughput_per_s": round(len(timings) * calls_per_timing / timings.sum(), 1),
+            "mean_us": round(timings.mean() * 1e6, 2),
+            "p50_us": round(np.percentile(timings, 50) * 1e6, 2),
+            "p90_us": round(np.percentile(timings, 90) * 1e6, 2),
+            "p99_us": round(np.percentile(timings, 99) * 1e6, 2),
+            "max_us": round(timings.max() * 1e6, 2)}
+
+
+def timed(function, arguments):
+    timings = np.empty(len(arguments))
+    clock = time.perf_counter
+    for i, argument in enumerate(arguments):
+        start = clock()
+        function(argument)
+        timings[i] = clock() - start
+    return timings
+
+
+def loaded_feed(market):
+    feed = DataFeed()
+    for frame in market.initial_frames():
+        channel = frame["params"]["channel"]
+        data = frame["params"]["data"]
+        if channel.endswith(".none.1.100ms"):
+            feed.update_futures_bbo(data)
+        elif channel.startswith("ticker."):
+            feed.manage_option_oi(data)
+        else:
+            feed.build_options_ob_from_snapshots(data)
+    feed.initial_positions(list(market.positions.values()))
+    feed.got_open_orders = True
+    return feed
+
+
+def open_positions(market, count):
+    """ Option positions spread over the chain plus a perpetual hedge """
+    step = max(1, len(market.options) // max(count, 1))
+    for i, name in enumerate(market.options[::step][:count]):
+        market.open_position(name, round((-1) ** i * (1 + i % 5) * 0.5, 1))
+    market.open_position(market.perpetual, -10000)
+
+
+def bench_message_distribution(market, feed, hedger, count):
+    try:
+        from ws_client import WSClient
+    except ImportError as e:
+        return {"skipped": "ws_client not importable: {}".format(e)}
+    client = WSClient(feed, hedger, "", "")
+    client.ws = NullSocket()
+    client.awaiting_first_book = False
+    # generated only here, the feed has to see every change the generator makes
+    raw = [json.dumps(frame) for frame in market.stream(count)]
+    return summary(timed(client.message_distribution, raw))
+
+
+def bench_update_options_ob(market, feed, count):
+    changes = [market.book_change()["params"]["data"] for _ in range(count)]
+    return summary(timed(feed.update_options_ob, changes))
+
+
+def bench_snapshot(feed, forward_curve, vol_surface, repeats):
+    import sqlite3
+    from save_top_of_book import SaveBBO
+
+    db_connection = {"c": NullCursor(), "conn": NullCursor(),
+                     "engine": sqlite3.connect(":memory:")}
+    save_bbo = SaveBBO(feed, db_connection, forward_curve, 0, vol_surface)
+    results = dict()
+
+    timestamps = [datetime.now(pytz.UTC) for _ in range(repeats)]
+    results["take_snapshot"] = summary(timed(save_bbo.take_snapshot, timestamps))
+
+    # the stages on their own, by capturing what each hands to the next
+    captured = dict()
+    calculations = save_bbo.options_calculations
+    save_bbo.options_calculations = lambda df: captured.__setitem__("quotes", df)
+    results["book_collection"] = summary(timed(save_bbo.take_snapshot, timestamps))
+    save_bbo.options_calculations = calculations
+
+    surface_snapshot = save_bbo.bvix.create_volsurf_snapshot
+    save_bbo.bvix.create_volsurf_snapshot = lambda df, slices=None: captured.__setitem__("derbbo", df)
+    quotes = [captured["quotes"].copy() for _ in range(repeats)]
+    results["options_calculations"] = summary(timed(save_bbo.options_calculations, quotes))
+    save_bbo.bvix.create_volsurf_snapshot = surface_snapshot
+
+    snapshots = [captured["derbbo"].copy() for _ in range(repeats)]
+    results["create_volsurf_snapshot"] = summary(timed(save_bbo.bvix.create_volsurf_snapshot,
+                                                       snapshots))
+    return results
+
+
+def bench_option_delta(hedger, vol_surface, repeats):
+    results = dict()
+    calls = list(range(repeats))
+    results["determine_option_delta"] = summary(timed(lambda _: hedger.determine_option_delta(),
+                                                      calls))
+    state = vol_surface.state
+    vol_surface.state = None
+    results["determine_option_delta_no_surface"] = summary(
+        timed(lambda _: hedger.determine_option_delta(), calls))
+    vol_surface.state = state
+    return results
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = json.load(f)["results"]
+    print("\np50 against {} (ratio < 1 is faster now):".format(path))
+    for name, current in results.items():
+        before = previous.get(name, {})
+        if "p50_us" in current and "p50_us" in before:
+            print("  {:<36} {:>10.1f}us  {:>10.1f}us  {:>6.2f}x".format(
+                name, before["p50_us"], current["p50_us"], current["p50_us"] / before["p50_us"]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--options", type=int, default=800, help="option instruments")
+    parser.add_argument("--messages", type=int, default=50000, help="frames for the message paths")
+    parser.add_argument("--repeats", type=int, default=10, help="runs of the snapshot paths")
+    parser.add_argument("--positions", type=int, default=40, help="option positions for the hedger")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", default=None, help="earlier results file")
+    args = parser.parse_args()
+
+    market = SyntheticDeribit(options=args.options, seed=args.seed)
+    open_positions(market, args.positions)
+    feed = loaded_feed(market)
+    forward_curve = ForwardCurve(feed)
+    vol_surface = VolSurface()
+    hedger = DeltaHedge(feed, forward_curve, vol_surface)
+    print("{} options, {} futures, {} positions".format(
+        len(market.options), len(market.futures), len(market.positions)))
+
+    results = dict()
+    results["message_distribution"] = bench_message_distribution(market, feed, hedger,
+                                                                 args.messages)
+    results["update_options_ob"] = bench_update_options_ob(market, feed, args.messages)
+    results.update(bench_snapshot(feed, forward_curve, vol_surface, args.repeats))
+    results.update(bench_option_delta(hedger, vol_surface, max(args.repeats, 100)))
+
+    print("\n{:<36} {:>12} {:>10} {:>10} {:>10} {:>10}".format(
+        "path", "per second", "p50 us", "p90 us", "p99 us", "max us"))
+    for name, result in results.items():
+        if "skipped" in result:
+            print("{:<36} skipped: {}".format(name, result["skipped"]))
+            continue
+        print("{:<36} {:>12,.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            name, result["throughput_per_s"], result["p50_us"], result["p90_us"],
+            result["p99_us"], result["max_us"]))
+
+    output = args.output
+    if output is None:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, "{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S")))
+    meta = {"timestamp": datetime.now(pytz.UTC).isoformat(), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "machine": platform.machine(),
+            "options": len(market.options), "messages": args.messages,
+            "repeats": args.repeats, "positions": args.positions, "seed": args.seed}
+    with open(output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    print("\nSaved to {}".format(output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,26 @@
 from datetime import datetime
 import pytz
-import psycopg2
 import threading
 import time
-from sqlalchemy import create_engine
 import logging
 
 from ws_client import WSClient
-from save_top_of_book import SaveBBO
 from data_feed import DataFeed
 from hedger import DeltaHedge
+from forward_curve import ForwardCurve
+from trade_tape import TradeTape
+from bars import BarAggregator
+from vol_surface import VolSurface
 from custom_input_parser import InputParser
 from api_trading_methods import ApiMethods
-import configparser
+from order_pipeline import OrderPipeline
+from status_line import StatusLine
+from startup_profile import StartupProfile
+import profiling
+import database
+
+# The snapshot / analytics modules (pandas, SQLAlchemy, psycopg2) are imported 
+# in Bot.setup_storage, which runs while the websocket connects.
 
 
 class Bot:
@@ -22,79 +30,371 @@ class Bot:
     and then sets them in motion. Additionally, it restarts the connection
     to the exchange every day at 8:00am UTC since some contracts expire at 
     that time and others are introduced. 
+    Startup is ordered for a fast first quote: the modules needed to connect 
+    and trade are created here, the websocket handshake then runs in parallel 
+    with the database setup (see run).
     """
     
-    def __init__(self):
+    def __init__(self, profile=None):
         
         self.logger = logging.getLogger("deribit")
-        config = configparser.RawConfigParser()
-        config.read_file(open("settings.txt"))
+        self.profile = profile if profile is not None else StartupProfile()
+        config = database.read_settings("settings.txt")
+        self.config = config
         
         self.api_information = dict(config.items("API"))
         self.api_key = self.api_information["api_key"]
         self.api_secret = self.api_information["api_secret"]
-
-
-        """ PostgreSQL information parsing """
-
+        self.ws_url = self.api_information.get("url") or "wss://www.deribit.com/ws/api/v2"
+        
         self.database_information = dict(config.items("PostgreSQL"))
-        database = self.database_information["database"]
-        user = self.database_information["user"]
-        password = self.database_information["password"]
-        host = self.database_information["host"]
-        port = self.database_information["port"]
-        if host == "localhost":
-            host_numeric = "127.0.0.1"
-        else:
-            host_numeric = host
+        self.db_connection_url = database.connection_url(config)
         
-        self.conn = psycopg2.connect(database=database, 
-                                     user=user, 
-                                     password=password, 
-                                     host=host, 
-                                     port=port)
         
-        self.c = self.conn.cursor()
-        self.db_connection_url = "postgresql://{}:{}@{}:{}/{}".format(database, 
-                                                                      password, 
-                                                                      host_numeric, 
-                                                                      port,
-                                                                      user)
-        self.engine = create_engine(self.db_connection_url)
+        """ Startup budget (optional section), seconds from start to the first quote """
         
-        db_connection = {"c":self.c, "conn":self.conn, "engine":self.engine}
+        if config.has_section("Startup"):
+            self.profile.budget = config.getfloat("Startup", "budget", 
+                                                  fallback=self.profile.budget)
         
         
-        """ Other modules """
+        """ Analytics settings (optional section) """
+        
+        self.analytics_workers = 0
+        self.streaming_interval = 0
+        if config.has_section("Analytics"):
+            self.analytics_workers = config.getint("Analytics", "workers", fallback=0)
+            self.streaming_interval = config.getfloat("Analytics", "streaming_interval", 
+                                                      fallback=0)
+        
+        
+        """ Order rate limits (optional section), Deribit's default matching engine limits """
+        
+        self.order_rate = 5
+        self.order_burst = 20
+        if config.has_section("Orders"):
+            self.order_rate = config.getfloat("Orders", "rate", fallback=5)
+            self.order_burst = config.getint("Orders", "burst", fallback=20)
+        
+        
+        """ Timing counters of the hot paths (optional section), off unless enabled """
+        
+        self.timing_log = None
+        if config.has_section("Profiling"):
+            if config.getboolean("Profiling", "timings", fallback=False):
+                profiling.enable_timings()
+            log_interval = config.getfloat("Profiling", "log_interval", fallback=0)
+            if log_interval > 0:
+                self.timing_log = profiling.TimingLog(log_interval)
+        
+        
+        """ Prometheus metrics on localhost (optional section), port 0 = off """
+        
+        self.metrics_port = 0
+        if config.has_section("Metrics"):
+            self.metrics_port = config.getint("Metrics", "port", fallback=0)
+        
+        
+        """ Snapshots in their own process on a shared memory book (optional section) """
+        
+        self.snapshot_process = False
+        self.book_name = "deribit_book"
+        self.publish_interval = 0.05
+        if config.has_section("Processes"):
+            self.snapshot_process = config.getboolean("Processes", "snapshot_process", 
+                                                      fallback=False)
+            self.book_name = config.get("Processes", "book_name", fallback="deribit_book")
+            self.publish_interval = config.getfloat("Processes", "publish_interval", 
+                                                    fallback=0.05)
+        
+        
+        """ Underlyings (optional section), BTC unless e.g. currencies = BTC, ETH """
+        
+        self.currencies = database.currencies(config)
         
-        self.api_methods = ApiMethods()
         
-        self.feed = DataFeed()
+        """ Trade tape (optional section), public trades in fixed size buffers """
         
-        self.delta_hedger = DeltaHedge(self.feed)
+        self.tape = True
+        self.tape_settings = dict()
+        if config.has_section("Tape"):
+            self.tape = config.getboolean("Tape", "tape", fallback=True)
+            self.tape_settings = {"window": config.getfloat("Tape", "window", fallback=300), 
+                                  "options_capacity": config.getint("Tape", "options_capacity", 
+                                                                    fallback=256), 
+                                  "futures_capacity": config.getint("Tape", "futures_capacity", 
+                                                                    fallback=4096)}
         
-        self.client = WSClient(self.feed, self.delta_hedger, 
-                               self.api_key, self.api_secret)
         
-        self.save_bbo = SaveBBO(self.feed, db_connection)
+        """ Futures bars (optional section), 1s, 1m and 5m unless set """
         
-        self.input_parser = InputParser(self.client, 
-                                        self.feed, 
+        self.bar_timeframes = [1, 60, 300]
+        self.bar_capacity = 1440
+        if config.has_section("Bars"):
+            timeframes = config.get("Bars", "timeframes", fallback="1, 60, 300")
+            self.bar_timeframes = [int(seconds) for seconds in timeframes.split(",") 
+                                   if seconds.strip()]
+            self.bar_capacity = config.getint("Bars", "capacity", fallback=1440)
+        
+        
+        """ Sub-accounts on connections of their own, one [Account <name>] section each """
+        
+        self.account_settings = [(section.split(" ", 1)[1].strip(), 
+                                  config.get(section, "api_key"), 
+                                  config.get(section, "api_secret")) 
+                                 for section in config.sections() 
+                                 if section.startswith("Account ")]
+        
+        
+        """ CLI settings (optional section) """
+        
+        self.status_interval = 1
+        if config.has_section("CLI"):
+            self.status_interval = config.getfloat("CLI", "status_interval", fallback=1)
+        
+        
+        """ Modules needed to connect and trade """
+        
+        self.api_methods = ApiMethods()
+        
+        self.bars = None
+        if self.bar_timeframes:
+            self.bars = BarAggregator(self.bar_timeframes, self.bar_capacity)
+        self.feed = DataFeed(tape=TradeTape(**self.tape_settings), bars=self.bars)
+        
+        # per currency, the first one's are the CLI's
+        self.forward_curves = {currency: ForwardCurve(self.feed, currency) 
+                               for currency in self.currencies}
+        self.vol_surfaces = {currency: VolSurface() for currency in self.currencies}
+        self.forward_curve = self.forward_curves[self.currencies[0]]
+        self.vol_surface = self.vol_surfaces[self.currencies[0]]
+        
+        self.sessions = None
+        if self.account_settings:
+            # the [API] connection carries the market data only, the CLI trades 
+            # the first account
+            from session_manager import SessionManager
+            self.client = WSClient(self.feed, None, self.api_key, self.api_secret, 
+                                   self.ws_url, channels="market", currencies=self.currencies)
+            self.sessions = SessionManager(self.client, self.forward_curves, self.vol_surfaces, 
+                                           self.order_rate, self.order_burst)
+            for name, api_key, api_secret in self.account_settings:
+                self.sessions.add_account(name, api_key, api_secret)
+            trading = list(self.sessions.accounts.values())[0]
+            self.trading_client = trading.client
+            self.trading_feed = trading.feed
+            self.delta_hedgers = trading.delta_hedgers
+            self.delta_hedger = trading.delta_hedger
+            self.order_pipeline = trading.order_pipeline
+        else:
+            self.delta_hedgers = {currency: DeltaHedge(self.feed, self.forward_curves[currency], 
+                                                       self.vol_surfaces[currency], currency) 
+                                  for currency in self.currencies}
+            self.delta_hedger = self.delta_hedgers[self.currencies[0]]
+            
+            self.client = WSClient(self.feed, self.delta_hedger, 
+                                   self.api_key, self.api_secret, self.ws_url, 
+                                   currencies=self.currencies)
+            self.client.delta_hedgers = self.delta_hedgers
+            
+            self.order_pipeline = OrderPipeline(self.client, self.order_rate, self.order_burst)
+            self.client.order_pipeline = self.order_pipeline
+            self.trading_client = self.client
+            self.trading_feed = self.feed
+        self.client.tape = self.tape
+        
+        self.input_parser = InputParser(self.trading_client, 
+                                        self.trading_feed, 
                                         self.api_methods, 
-                                        self.delta_hedger)
+                                        self.delta_hedger, 
+                                        self.vol_surface, 
+                                        self.order_pipeline)
+        
+        self.status_line = StatusLine(self.trading_feed, self.delta_hedger, 
+                                      self.input_parser, self.status_interval)
+        self.input_parser.status_line = self.status_line
+        self.input_parser.delta_hedgers = self.delta_hedgers
+        
+        self.metrics = None
+        if self.metrics_port > 0:
+            from metrics import MetricsServer
+            self.metrics = MetricsServer(self.client, self.feed, self.delta_hedger, 
+                                         self.order_pipeline, self.metrics_port)
+            self.metrics.delta_hedgers = self.delta_hedgers
+            self.add_logging_metrics()
+            if self.sessions is not None:
+                self.add_account_metrics()
+        
+        # set up in setup_storage, per currency
+        self.save_bbos = dict()
+        self.streaming_surfaces = dict()
+        self.analytics_pool = None
+        self.schema_manager = None
+        self.book_writer = None
+        
+        
+    def add_logging_metrics(self):
+        from async_logging import AsyncQueueHandler
+        for handler in self.logger.handlers:
+            if isinstance(handler, AsyncQueueHandler):
+                self.metrics.extra_gauges.append(
+                    ("deribit_log_records", "Log records queued and dropped (queue full).", 
+                     lambda handler=handler: {(("state", "queued"),): handler.depth(), 
+                                              (("state", "dropped"),): handler.dropped}))
+        
+        
+    def add_account_metrics(self):
+        accounts = self.sessions.accounts
+        self.metrics.extra_gauges.append(
+            ("deribit_account_connected", "1 while the account's connection is connected.", 
+             lambda: {(("account", name),): int(session.client.connected) 
+                      for name, session in accounts.items()}))
+        self.metrics.extra_gauges.append(
+            ("deribit_account_positions", "Open positions per account.", 
+             lambda: {(("account", name),): len(session.feed.positions) 
+                      for name, session in accounts.items()}))
+        
+        
+    def setup_storage(self):
+        
+        """ 
+        PostgreSQL connection, the optional managed storage layout (must exist 
+        before the tables are used) and the snapshot and analytics modules, 
+        imported only here.
+        """
+        
+        with self.profile.step("db connection"):
+            db_connection = database.db_connection(self.config)
+            self.conn = db_connection["conn"]
+            self.c = db_connection["c"]
+            self.engine = db_connection["engine"]
+        
+        with self.profile.step("import storage modules"):
+            import schema_manager
+            from save_top_of_book import SaveBBO
+            from streaming_surface import StreamingSurface
+        
+        with self.profile.step("schema manager"):
+            self.schema_manager = schema_manager.from_settings(self.config)
+            if self.schema_manager is not None:
+                self.schema_manager.prepare()
+        
+        if self.snapshot_process:
+            # SaveBBO and the streaming surface run in the snapshot process
+            from shared_book import SharedBookWriter
+            self.book_writer = SharedBookWriter(self.feed, self.book_name, self.publish_interval)
+            return
+        
+        with self.profile.step("snapshot module"):
+            # one worker pool for all currencies
+            if self.analytics_workers > 0:
+                from analytics_pool import AnalyticsPool
+                from volatility_index import BVIX
+                self.analytics_pool = AnalyticsPool(self.analytics_workers, 
+                                                    BVIX.log_moneyness_intervals)
+            for currency in self.currencies:
+                self.save_bbos[currency] = SaveBBO(self.feed, db_connection, 
+                                                   self.forward_curves[currency], 
+                                                   vol_surface=self.vol_surfaces[currency], 
+                                                   analytics_pool=self.analytics_pool)
+        if self.metrics is not None:
+            self.metrics.snapshots = self.save_bbos
+        
+        # optional sub-second surface updates between the minutely snapshots
+        if self.streaming_interval > 0:
+            for currency, save_bbo in self.save_bbos.items():
+                self.streaming_surfaces[currency] = StreamingSurface(
+                    self.feed, self.forward_curves[currency], self.vol_surfaces[currency], 
+                    save_bbo.bvix, self.streaming_interval)
+    
+    
+    def start_snapshot_process(self):
+        
+        """ 
+        Publishes the books to shared memory and starts the snapshot process 
+        on them, the surfaces it builds are handed to the local VolSurfaces.
+        """
+        
+        import multiprocessing
+        from shared_book import snapshot_process
+        
+        self.book_thread = threading.Thread(target=lambda: self.book_writer.run(), 
+                                            name="shared book", daemon=True)
+        self.book_thread.start()
+        
+        # spawned, since fork would copy the locks held by the websocket threads
+        context = multiprocessing.get_context("spawn")
+        self.surfaces = context.Queue()
+        self.snapshot_stop = context.Event()
+        self.snapshot = context.Process(target=snapshot_process, name="snapshots", 
+                                        args=(self.book_name, "settings.txt", self.surfaces, 
+                                              self.snapshot_stop, self.analytics_workers, 
+                                              self.streaming_interval))
+        self.snapshot.start()
+        self.surface_thread = threading.Thread(target=lambda: self.receive_surfaces(), 
+                                               name="surfaces", daemon=True)
+        self.surface_thread.start()
+        self.logger.info("Snapshot process started (pid {}).".format(self.snapshot.pid))
+    
+    
+    def receive_surfaces(self):
+        import queue
+        while not self.snapshot_stop.is_set():
+            try:
+                currency, state, durations = self.surfaces.get(timeout=0.5)
+                self.vol_surfaces[currency].state = state
+                if self.metrics is not None:
+                    self.metrics.snapshot_durations[currency] = durations
+            except queue.Empty:
+                if not self.snapshot.is_alive():
+                    self.logger.info("Snapshot process exited (code {}).".format(
+                        self.snapshot.exitcode))
+                    return
+    
+    
+    def connect(self):
+        with self.profile.step("websocket and streams"):
+            if not self.client.connected:
+                self.logger.info("Starting websocket client.")
+                self.client.create_ws_connection()
+            if self.sessions is not None:
+                self.sessions.connect()
         
         
     def run(self):
         
-        if not self.client.connected:
-            self.logger.info("Starting websocket client.")
-            self.client.create_ws_connection()
-            
+        """ Websocket handshake and stream setup run while the DB is set up """
+        
+        if self.metrics is not None:
+            self.metrics.start()
+        
+        self.quote_thread = threading.Thread(
+            target=lambda: self.profile.wait_for_first_quote(
+                self.feed, lambda: self.client.shutdown_client), daemon=True)
+        self.quote_thread.start()
+        
+        self.connection_thread = threading.Thread(target=lambda: self.connect(), 
+                                                  name="connect")
+        self.connection_thread.start()
+        try:
+            self.setup_storage()
+        except Exception:
+            self.connection_thread.join()
+            self.client.shutdown()
+            raise
+        self.connection_thread.join()
+        
             
         """ Separate thread saves all optoins best bid and offer to DB """
         
-        self.save_bbo_thread = threading.Thread(target=lambda: self.save_bbo.schedule_snapshot())
-        self.save_bbo_thread.start()
+        if self.book_writer is not None:
+            self.start_snapshot_process()
+        else:
+            self.save_bbo_threads = []
+            for save_bbo in self.save_bbos.values():
+                thread = threading.Thread(target=save_bbo.schedule_snapshot)
+                thread.start()
+                self.save_bbo_threads.append(thread)
         
         
         """ Separate thread to reconnect daily for new contract introduction """
@@ -103,35 +403,92 @@ class Bot:
         self.reconnection_thread.start()
         
         
-        """ Main thread will call user input function, which runs forever """
-        
-        while True:
-            if self.client.connected and not self.input_parser.shutdown_input:
-                try:
-                    self.input_parser.accept_user_input()
-                except KeyboardInterrupt:
-                    self.shutdown_all("KeyboardInterrupt")
-                    break
-                
-                except Exception as e:
-                    error_type, error_tb, tb = sys.exc_info()
-                    filename, lineno, func_name, line = traceback.extract_tb(tb)[-1]
-                    self.logger.info("Exception occured (main thread): {}".format(e))
-                    self.logger.info("Error details: {} {} {} {}".format(
-                        filename, lineno, func_name, line))                    
-            
-            elif self.input_parser.shutdown_input:
-                self.shutdown_all("CLI quit")
-                break
-            
-            else:
-                time.sleep(0.5)
-                
+        """ Separate thread creates partitions and rolls up old data (if enabled) """
+        
+        if self.schema_manager is not None:
+            self.storage_thread = threading.Thread(target=lambda: self.schema_manager.run())
+            self.storage_thread.start()
+        
+        
+        """ Separate thread keeps the in-memory surface current (if enabled) """
+        
+        self.streaming_threads = []
+        for streaming_surface in self.streaming_surfaces.values():
+            thread = threading.Thread(target=streaming_surface.run)
+            thread.start()
+            self.streaming_threads.append(thread)
+        
+        
+        """ User input and the live status line run on their own threads """
+        
+        # daemon, so a pending input() never holds up the shutdown
+        self.input_thread = threading.Thread(target=lambda: self.input_parser.run(), daemon=True)
+        self.input_thread.start()
+        
+        if self.status_interval > 0:
+            self.status_thread = threading.Thread(target=lambda: self.status_line.run(), daemon=True)
+            self.status_thread.start()
+        
+        if self.timing_log is not None:
+            self.timing_thread = threading.Thread(target=lambda: self.timing_log.run(), daemon=True)
+            self.timing_thread.start()
+        
+        
+        if self.profile.original_import is not None: # --profile-startup
+            self.quote_thread.join(timeout=30)
+            self.profile.stop_tracing()
+            print(self.profile.report())
+        
+        
+        """ Main thread waits for a quit command or KeyboardInterrupt """
+        
+        try:
+            while not self.input_parser.shutdown_input:
+                time.sleep(0.2)
+            self.shutdown_all("CLI quit")
+        except KeyboardInterrupt:
+            self.shutdown_all("KeyboardInterrupt")
+        
+        
     def shutdown_all(self, reason):
         self.logger.info("{} - Shutting down.".format(reason))
-        self.save_bbo.shutdown = True
+        self.input_parser.shutdown_input = True
+        self.status_line.shutdown = True
+        if self.timing_log is not None:
+            self.timing_log.shutdown = True
+        for save_bbo in self.save_bbos.values():
+            save_bbo.shutdown = True
+        if self.book_writer is not None:
+            self.snapshot_stop.set()
+        for streaming_surface in self.streaming_surfaces.values():
+            streaming_surface.shutdown = True
+        if self.schema_manager is not None:
+            self.schema_manager.shutdown = True
         self.client.shutdown()
+        if self.sessions is not None:
+            self.sessions.shutdown()
+        if self.metrics is not None:
+            self.metrics.shutdown()
         
         self.client.t1.join()
-        self.save_bbo_thread.join()
+        if self.sessions is not None:
+            self.sessions.join()
+        if self.book_writer is not None:
+            self.snapshot.join(timeout=30)
+            if self.snapshot.is_alive():
+                self.snapshot.terminate()
+            self.book_writer.shutdown = True
+            self.book_thread.join()
+            self.book_writer.close()
+        else:
+            for thread in self.save_bbo_threads:
+                thread.join()
         self.reconnection_thread.join()
+        for thread in self.streaming_threads:
+            thread.join()
+        if self.analytics_pool is not None:
+            self.analytics_pool.shutdown()
+        if self.schema_manager is not None:
+            self.storage_thread.join()
+        if self.status_interval > 0:
+            self.status_thread.join()
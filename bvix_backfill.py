@@ -0,0 +1,234 @@
+"""
+Recomputes obot.bvix from the stored obot.derbbo snapshots, e.g. after a
+change of the surface methodology.
+
+Usage: python bvix_backfill.py --start 2022-11-01 --end 2022-12-01 [--workers 4]
+       [--chunk-hours 6] [--currency BTC] [--table bvix] [--job name] [--recompute-iv]
+
+The time range is processed in chunks. Each chunk is streamed out of
+PostgreSQL with COPY ... TO STDOUT, split into its snapshot timestamps and
+fanned out to a process pool running the same surface code as the live BVIX
+(volatility_index.build_slices / surface_frame). While the pool works on one
+chunk, the next one is already being read.
+
+Writes are idempotent: a chunk's rows in the target table are deleted and
+rewritten with COPY ... FROM STDIN in the same transaction that advances the
+job's checkpoint in obot.bvix_backfill_progress. Rerunning a job (same
+--job, or same table and range) resumes after the last committed chunk.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import multiprocessing
+import argparse
+import io
+import logging
+import time
+import pandas as pd
+
+import database
+from database import utc_timestamp
+from implied_volatility import implied_volatility, call_flags
+from volatility_index import BVIX, build_slices, surface_frame, bvix_table_sql
+
+
+class BVIXBackfill:
+
+    """ Streams derbbo chunk by chunk, builds surfaces in parallel, writes them back """
+
+    columns = ["timestamp", "expiration", "ttmyears", "strike", "typ", "bid", "ask",
+               "bid_usd", "ask_usd", "bid_iv", "ask_iv", "btcusd_price", "forward"]
+
+    def __init__(self, config, table=None, workers=4, chunk=timedelta(hours=6),
+                 recompute_iv=False, batch_size=15, currency="BTC"):
+        self.logger = logging.getLogger("deribit")
+        self.conn = database.connect(config)
+        self.c = self.conn.cursor()
+        self.schema = "obot"
+        self.source = database.currency_table("derbbo", currency)
+        self.table = table or database.currency_table("bvix", currency)
+        self.progress_table = "bvix_backfill_progress"
+
+        self.workers = workers
+        self.chunk = chunk
+        self.recompute_iv = recompute_iv
+        self.batch_size = batch_size # snapshots per pool task
+
+        self.prepare_db()
+
+
+    def prepare_db(self):
+        # text output of timestamps in UTC, as written by the live modules
+        self.c.execute("SET TIME ZONE 'UTC'")
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        self.c.execute(bvix_table_sql(self.schema, self.table, BVIX.days_til_maturity))
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
+                       "job TEXT PRIMARY KEY, done_until TIMESTAMPTZ, "
+                       "updated TIMESTAMPTZ)".format(self.schema, self.progress_table))
+        self.conn.commit()
+
+
+    def resume_point(self, job, start):
+        self.c.execute("SELECT done_until FROM {}.{} WHERE job = %s".format(
+            self.schema, self.progress_table), (job,))
+        row = self.c.fetchone()
+        if row is None or row[0] is None:
+            return start
+        return max(start, pd.Timestamp(row[0]))
+
+
+    def run(self, start, end, job=None):
+        start = utc_timestamp(start)
+        end = utc_timestamp(end)
+        if job is None:
+            job = "{}:{}:{}".format(self.table, start.isoformat(), end.isoformat())
+
+        position = self.resume_point(job, start)
+        if position > start:
+            self.logger.info("Resuming backfill '{}' at {}.".format(job, position))
+
+        chunks = []
+        while position < end:
+            chunks.append((position, min(position + self.chunk, end)))
+            position = chunks[-1][1]
+
+        started = time.time()
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            pending = None
+            for chunk_start, chunk_end in chunks:
+                tasks = self.submit_chunk(executor, self.read_chunk(chunk_start, chunk_end))
+                # the previous chunk is written while this one is being computed
+                if pending is not None:
+                    self.write_chunk(job, *pending)
+                pending = (chunk_start, chunk_end, tasks)
+            if pending is not None:
+                self.write_chunk(job, *pending)
+
+        self.logger.info("Backfill '{}' done: {} chunks in {:.1f}s.".format(
+            job, len(chunks), time.time() - started))
+
+
+    def read_chunk(self, start, end):
+        query = self.c.mogrify("COPY (SELECT {} FROM {}.{} WHERE timestamp >= %s "
+                               "AND timestamp < %s ORDER BY timestamp) TO STDOUT "
+                               "WITH CSV HEADER".format(", ".join(self.columns), self.schema,
+                                                        self.source),
+                               (start.to_pydatetime(), end.to_pydatetime()))
+        buffer = io.StringIO()
+        self.c.copy_expert(query.decode(), buffer)
+        self.conn.commit()
+        buffer.seek(0)
+
+        df = pd.read_csv(buffer)
+        df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+        df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
+        # snapshots taken before forwards were stored
+        df["forward"] = df["forward"].fillna(df["btcusd_price"])
+        return df
+
+
+    def submit_chunk(self, executor, df):
+        snapshots = list(df.groupby("timestamp"))
+        tasks = []
+        for i in range(0, len(snapshots), self.batch_size):
+            tasks.append(executor.submit(surface_rows, snapshots[i:i+self.batch_size],
+                                         self.recompute_iv))
+        return tasks
+
+
+    def write_chunk(self, job, start, end, tasks):
+        frames = [frame for frame in (task.result() for task in tasks) if len(frame) > 0]
+        rows = 0
+        try:
+            self.c.execute("DELETE FROM {}.{} WHERE timestamp >= %s AND timestamp < %s".format(
+                self.schema, self.table), (start.to_pydatetime(), end.to_pydatetime()))
+
+            if frames:
+                df = pd.concat(frames, ignore_index=True)
+                rows = len(df)
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                self.c.copy_expert("COPY {}.{} ({}) FROM STDIN WITH CSV".format(
+                    self.schema, self.table, ", ".join(df.columns)), buffer)
+
+            self.c.execute("INSERT INTO {}.{} (job, done_until, updated) VALUES (%s, %s, now()) "
+                           "ON CONFLICT (job) DO UPDATE SET done_until = EXCLUDED.done_until, "
+                           "updated = EXCLUDED.updated".format(self.schema, self.progress_table),
+                           (job, end.to_pydatetime()))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.logger.info("Backfilled {} to {}: {} rows.".format(start, end, rows))
+
+
+
+
+def with_ivs(df):
+    """ Re-solves the snapshot's ivs against its forwards, premiums converted with them """
+    df = df.copy()
+    df["bid_usd"] = (df["bid"] * df["forward"]).round(2)
+    df["ask_usd"] = (df["ask"] * df["forward"]).round(2)
+    forwards = df["forward"].to_numpy(dtype=float)
+    strikes = df["strike"].to_numpy(dtype=float)
+    ttm = df["ttmyears"].to_numpy(dtype=float)
+    is_call = call_flags(df["typ"])
+    df["bid_iv"] = implied_volatility(df["bid_usd"].to_numpy(dtype=float), forwards,
+                                      strikes, ttm, is_call).round(4)
+    df["ask_iv"] = implied_volatility(df["ask_usd"].to_numpy(dtype=float), forwards,
+                                      strikes, ttm, is_call).round(4)
+    return df
+
+
+def surface_rows(snapshots, recompute_iv):
+
+    """ Worker task: obot.bvix rows for a batch of (timestamp, snapshot) pairs """
+
+    frames = []
+    for ts, df in snapshots:
+        if recompute_iv:
+            df = with_ivs(df)
+        slices = build_slices(df, BVIX.log_moneyness_intervals)
+        if not slices:
+            continue
+        surface = surface_frame(slices, BVIX.log_moneyness_intervals, BVIX.days_til_maturity)
+        surface["timestamp"] = ts
+        frames.append(surface)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute obot.bvix from obot.derbbo.")
+    parser.add_argument("--start", required=True, help="UTC start, e.g. 2022-11-01")
+    parser.add_argument("--end", required=True, help="UTC end (exclusive)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-hours", type=float, default=6)
+    parser.add_argument("--currency", default="BTC",
+                        help="underlying, other than BTC read from / written to e.g. derbbo_eth, bvix_eth")
+    parser.add_argument("--table", default=None, help="target table in schema obot, default the currency's bvix")
+    parser.add_argument("--job", default=None, help="checkpoint name, default from table and range")
+    parser.add_argument("--recompute-iv", action="store_true",
+                        help="re-solve bid/ask ivs against the stored forwards")
+    parser.add_argument("--settings", default="settings.txt")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("deribit")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+    backfill = BVIXBackfill(database.read_settings(args.settings), table=args.table,
+                            workers=args.workers, chunk=timedelta(hours=args.chunk_hours),
+                            recompute_iv=args.recompute_iv, currency=args.currency.upper())
+    backfill.run(args.start, args.end, args.job)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,16 @@
 import logging
-import pandas as pd
 import time
+import sys
+import traceback
+import re
+from collections import deque
+from vol_surface import expiration_from_code
+import profiling
+
+# a/d (buy/sell), optional w/s (at ask/bid), amount, then optionally a price 
+# (with 's' for a stop) or two bounds and a number of orders for a ladder
+TRADE_COMMAND = re.compile(r"([ad])([ws]?)(\d+)(?: (\d+)(s?)| (\d+) (\d+) (\d+))?")
+
 
 class InputParser:
     
@@ -13,11 +23,17 @@ class InputParser:
     Type 'help' for syntax (or check out the show_syntax method)
     """
     
-    def __init__(self, client, feed, api_methods, delta_hedger):
+    def __init__(self, client, feed, api_methods, delta_hedger, vol_surface=None, 
+                 order_pipeline=None):
         self.client = client
+        self.order_pipeline = order_pipeline
+        self.status_line = None # set by the bot
         self.feed = feed
         self.api_methods = api_methods
         self.delta_hedger = delta_hedger
+        # hedger per currency (set by the bot), the active one follows the instrument
+        self.delta_hedgers = {delta_hedger.currency: delta_hedger}
+        self.vol_surface = vol_surface
         
         self.logger = logging.getLogger("deribit")
         
@@ -36,25 +52,56 @@ class InputParser:
         
         self.label_counter_updated = False
         
+        # compiled per instrument and size multiplier, see compile_templates
+        self.templates = dict()
+        self.latencies = deque(maxlen=100) # (parse, serialize per order) in seconds
+        
     
     def determine_label_counter(self):
-        orders = self.feed.get_orders()
-        if orders:
-            for i in orders.keys():                
-                for j in orders[i].keys():
-                    label = orders[i][j]["label"]
-                    if "manual_api_" in label:
-                        label_number = label.replace("manual_api_", "")
-                        if not label_number.isnumeric():
-                            pass
-                        else:
-                            label_number = int(label_number)
-                            self.label_storage.append(label_number)
+        # one entry per distinct open label, from the feed's label index
+        for label in self.feed.get_order_labels():
+            if "manual_api_" in label:
+                label_number = label.replace("manual_api_", "")
+                if label_number.isnumeric():
+                    self.label_storage.append(int(label_number))
         
         if self.label_storage:
             self.label_counter = max(self.label_storage) + 1
 
         
+    def cancel_labels(self, orders, currency):
+        # cancel by label cancels every order carrying it, so one request per label
+        labels = []
+        for order in orders:
+            if order["label"] not in labels:
+                labels.append(order["label"])
+        return [self.api_methods.cancel_last(label, currency) for label in labels]
+    
+    
+    def run(self):
+        
+        """ 
+        Input loop for its own thread. Blocking in input() holds up nothing 
+        else; the bot shuts down without this loop returning.
+        """
+        
+        while not self.shutdown_input:
+            if not self.client.connected:
+                time.sleep(0.5)
+                continue
+            try:
+                self.accept_user_input()
+            except EOFError:
+                self.shutdown_input = True
+            except Exception as e:
+                error_type, error_tb, tb = sys.exc_info()
+                filename, lineno, func_name, line = traceback.extract_tb(tb)[-1]
+                self.logger.info("Exception occured (input thread): {}".format(e))
+                self.logger.info("Error details: {} {} {} {}".format(
+                    filename, lineno, func_name, line))
+        self.logger.info("Shutting down user input thread.")
+    
+    
     def accept_user_input(self):
         
         if not self.shutdown_input:
@@ -63,17 +110,21 @@ class InputParser:
             
             if not self.instrument_set:
                 
+                # futures with quotes, the instrument list is the market connection's
+                futures = list(self.feed.futures_bbo.keys())
                 instrument_string = "Instrument to trade: \n"
-                for i in self.client.active_futures_contracts:
+                for i in futures:
                     instrument_string += "{}\n".format(str(i))
                 instrument_string += "\n"
                 instrument = input(instrument_string)
                 
-                if instrument not in self.client.active_futures_contracts:
+                if instrument not in futures:
                     print("Incorrect instrument provided. Check Typos?")
                     self.instrument_set = False
                 else:
                     self.instrument = instrument
+                    self.delta_hedger = self.delta_hedgers.get(instrument.split("-")[0], 
+                                                               self.delta_hedger)
                     self.instrument_set = True
                 
                 
@@ -85,6 +136,7 @@ class InputParser:
                 else:
                     self.size_multiplier = int(x)
                     self.size_multiplier_set = True
+                    self.compile_templates()
             
             elif not self.label_counter_updated:
                 if not self.feed.got_open_orders:
@@ -97,27 +149,148 @@ class InputParser:
                 x = input("{} :~$ ".format(self.instrument))
                 x = x.strip()
                 
+                start = time.perf_counter()
                 parsed = self.custom_parse(x)
+                parse_time = time.perf_counter() - start
                 
                 if parsed:
-                    for order in range(len(parsed)):
-                        data = parsed[order][0]
-                        call_type = parsed[order][1]
-                        if (data and call_type) or (call_type == "private/cancel_all"): # THIS IS NOT THE CASE FOR CANCEL ALL CALL
-                            self.client.send_to_ws(data, call_type)
-                            
-                            if len(parsed) > 1:
-                                if order != len(parsed) - 1:
-                                    time.sleep(0.2)
+                    if self.order_pipeline is not None:
+                        # paced by the rate limiter, failed legs are reported per batch
+                        self.order_pipeline.submit(parsed)
+                        if len(parsed[0]) > 2:
+                            self.latencies.append((parse_time, self.order_pipeline.last_serialize_time))
+                    else:
+                        for request in parsed:
+                            data, call_type = request[0], request[1]
+                            if (data and call_type) or (call_type == "private/cancel_all"):
+                                self.client.send_to_ws(data, call_type)
                 
         else:
             self.logger.info("Shutting down user input thread.")
             
             
+    def compile_templates(self):
+        
+        """ 
+        Order templates for the selected instrument and size multiplier, so 
+        a trade command only fills in amount, price and label.
+        """
+        
+        self.templates = dict()
+        for side in ["buy", "sell"]:
+            variants = {"market": ("market_limit", {}), 
+                        "taker": ("market_limit", {"post_only": False}), 
+                        "maker": ("limit", {"post_only": True}), 
+                        "stop": ("stop_market", {"trigger": "mark_price", "reduce_only": True})}
+            for name, (order_type, options) in variants.items():
+                self.templates[(side, name)] = self.api_methods.order_template(
+                    self.instrument, side, order_type, self.size_multiplier, **options)
+    
+    
+    def next_label(self):
+        label_number = self.label_counter
+        self.label_storage.append(label_number)
+        self.label_counter += 1
+        return label_number
+    
+    
+    def parse_trade(self, command):
+        
+        """ Orders for a matched TRADE_COMMAND, see show_syntax """
+        
+        side = "buy" if command.group(1) == "a" else "sell"
+        at = command.group(2)
+        amount = int(command.group(3))
+        price_override, stop, bound1, bound2, number_of_orders = command.group(4, 5, 6, 7, 8)
+        
+        if price_override is None and bound1 is None:
+            if amount > 10**4:
+                raise InvalidInput
+            
+            if not at:
+                # market_limit capped 0.1% through the touch
+                if side == "buy":
+                    price = int(self.feed.fetch_btcusd_bbo(self.instrument, "ask") * 1.001)
+                else:
+                    price = int(self.feed.fetch_btcusd_bbo(self.instrument, "bid") * 0.999)
+                return [self.templates[(side, "market")].order(amount, price, self.next_label())]
+            
+            price = self.feed.fetch_btcusd_bbo(self.instrument, "ask" if at == "w" else "bid")
+            # joining the own side of the book is post only, crossing is market_limit
+            if (side == "buy" and at == "s") or (side == "sell" and at == "w"):
+                template = self.templates[(side, "maker")]
+            else:
+                template = self.templates[(side, "taker")]
+            return [template.order(amount, price, self.next_label())]
+        
+        elif price_override is not None:
+            price = int(price_override)
+            if stop:
+                if ((side == "buy" and price <= self.feed.fetch_btcusd_bbo(self.instrument, "ask"))
+                    or (side == "sell" and price >= self.feed.fetch_btcusd_bbo(self.instrument, "bid"))):
+                    raise InvalidInput
+                return [self.templates[(side, "stop")].order(amount, price, self.next_label(), 
+                                                             trigger_price=price)]
+            return [self.templates[(side, "maker")].order(amount, price, self.next_label())]
+        
+        else:
+            bound1 = int(bound1)
+            bound2 = int(bound2)
+            number_of_orders = int(number_of_orders)
+            if number_of_orders < 2:
+                raise InvalidInput
+            
+            distance = abs(bound1 - bound2) / number_of_orders
+            if side == "buy":
+                prices = [min(bound1, bound2) + distance * i for i in range(number_of_orders)]
+            else:
+                prices = [max(bound1, bound2) - distance * i for i in range(number_of_orders)]
+            
+            template = self.templates[(side, "maker")]
+            return [template.order(amount, int(price), self.next_label()) for price in prices]
+    
+    
+    def show_latency(self):
+        if not self.latencies:
+            print("No orders sent yet.")
+            return
+        parse, serialize = self.latencies[-1]
+        print("Last order command: parse {:.1f}us, serialize {:.1f}us per order".format(
+            parse * 1e6, serialize * 1e6))
+        parse_times = sorted(latency[0] for latency in self.latencies)
+        serialize_times = sorted(latency[1] for latency in self.latencies)
+        middle = len(parse_times) // 2
+        print("Median of last {}: parse {:.1f}us, serialize {:.1f}us per order".format(
+            len(parse_times), parse_times[middle] * 1e6, serialize_times[middle] * 1e6))
+    
+    
+    def stats_command(self, argument):
+        if argument == "on":
+            profiling.enable_timings()
+        elif argument == "off":
+            profiling.disable_timings()
+        elif argument == "reset":
+            profiling.reset_timings()
+        elif argument:
+            raise InvalidInput
+        
+        rows = profiling.timing_stats()
+        if rows:
+            print(format_table(rows, ["name", "calls", "total_s", "mean_us", "max_ms"]))
+        if not profiling.timings_enabled():
+            print("Timings are off, 'stats on' enables them.")
+        elif not rows:
+            print("No timed calls yet.")
+    
+    
     def custom_parse(self, x):
         try:
-            currency = "BTC"
-            label = "manual_api_{}".format(str(self.label_counter))
+            currency = self.instrument.split("-")[0] if self.instrument_set else "BTC"
+            
+            # hot path: trade commands skip the command branches below
+            command = TRADE_COMMAND.fullmatch(x)
+            if command is not None:
+                return self.parse_trade(command)
             
             if len(x) < 2:
                 raise InvalidInput
@@ -149,15 +322,14 @@ class InputParser:
                                                    self.feed.fetch_btcusd_bbo(self.instrument, "ask")))
             
             elif x == "funds":
-                account = self.feed.get_account_data()
+                account = self.feed.get_account_data(currency)
                 current_price = self.feed.fetch_btcusd_bbo(self.instrument, "bid")
                 data = []
                 for i in account.keys():
                     data.append([i, account[i], 
                                  "$"+str(round(account[i]*current_price, 2))])
                 
-                df = pd.DataFrame(data, columns=["item", "balance_btc", "balance_usd"])
-                print(df.to_string())
+                print(format_table(data, ["item", "balance_" + currency.lower(), "balance_usd"]))
             
             
             elif x == "orders":
@@ -174,13 +346,11 @@ class InputParser:
                                  orders[i][j]["label"]]
                         data.append(entry)
                 
-                df = pd.DataFrame(data, columns=["underlying", "id", "direction", 
-                                                 "amount", "price", "order_type", 
-                                                 "post_only", "reduce_only", 
-                                                 "label"])
-                
-                if len(df) > 0:
-                    print(df.to_string())
+                if len(data) > 0:
+                    print(format_table(data, ["underlying", "id", "direction", 
+                                              "amount", "price", "order_type", 
+                                              "post_only", "reduce_only", 
+                                              "label"]))
                 else:
                     print("No open orders at this moment.")
                     
@@ -195,12 +365,10 @@ class InputParser:
                              round(positions[i]["total_profit_loss"], 5)]
                     data.append(entry)
                     
-                df = pd.DataFrame(data, columns=["underlying", "direction", 
-                                                 "average_price", "size", 
-                                                 "total_pnl"])
-                
-                if len(df) > 0:
-                    print(df.to_string())
+                if len(data) > 0:
+                    print(format_table(data, ["underlying", "direction", 
+                                              "average_price", "size", 
+                                              "total_pnl"]))
                 else:
                     print("No open positions at this moment.")
                 
@@ -212,9 +380,85 @@ class InputParser:
                 self.size_multiplier = 0
                 self.size_multiplier_set = False
             
+            elif x == "status":
+                if self.status_line is not None:
+                    print(self.status_line.text())
+            
+            elif x == "latency":
+                self.show_latency()
+            
+            elif x[:5] == "stats":
+                self.stats_command(x[5:].strip())
+            
+            elif x[:7] == "profile":
+                # e.g. 'profile 30' samples all threads for 30 seconds
+                duration = x[7:].strip() or "10"
+                if not duration.isnumeric() or int(duration) == 0:
+                    raise InvalidInput
+                profiler = profiling.SamplingProfiler(int(duration))
+                profiler.start()
+                print("Sampling for {}s, writing {}.".format(duration, profiler.path))
+            
+            elif x == "tape":
+                rolling = self.feed.trades.rolling(self.instrument)
+                if rolling is None:
+                    print("No trades in {} yet.".format(self.instrument))
+                else:
+                    recent = self.feed.trades.recent(self.instrument, 5)
+                    rows = [[time.strftime("%H:%M:%S", time.localtime(recent["timestamp"][i] / 1000)), 
+                             "buy" if recent["side"][i] > 0 else "sell", 
+                             recent["amount"][i], recent["price"][i]] 
+                            for i in range(len(recent["price"]))]
+                    print(format_table(rows, ["time", "side", "amount", "price"]))
+                    print("Last {}s: {} trades, volume {}, vwap {}, flow {}".format(
+                        int(self.feed.trades.window_ms / 1000), rolling["trades"], 
+                        round(rolling["volume"], 4), round(rolling["vwap"], 4), 
+                        round(rolling["flow"], 4)))
+            
+            elif x[:5] == "bars ":
+                # e.g. 'bars 60'
+                seconds = x[5:].strip()
+                if not seconds.isnumeric():
+                    raise InvalidInput
+                bars = None
+                if self.feed.bars is not None:
+                    bars = self.feed.bars.bars(self.instrument, int(seconds), 5)
+                if bars is None:
+                    print("No {}s bars of {}.".format(seconds, self.instrument))
+                else:
+                    rows = [[time.strftime("%H:%M:%S", time.localtime(bars["start"][i] / 1000))] 
+                            + [round(bars[column][i], 4) for column in 
+                               ["open", "high", "low", "close", "volume", "flow"]] 
+                            for i in range(len(bars["start"]))]
+                    print(format_table(rows, ["start", "open", "high", "low", "close", 
+                                              "volume", "flow"]))
+            
             elif x == "connection status":
                 print("Connected: ", self.client.connected)
             
+            elif x == "surface":
+                if self.vol_surface is None or self.vol_surface.state is None:
+                    print("No volatility surface built yet.")
+                else:
+                    print(format_table(self.vol_surface.expiry_summary(), 
+                                       ["expiration", "forward", "atm_iv"]))
+                    print("Built {} seconds ago.".format(int(self.vol_surface.age())))
+            
+            elif x[:3] == "iv ":
+                # e.g. 'iv 20000 30DEC22'
+                parts = x.split()
+                if len(parts) != 3 or not parts[1].isnumeric():
+                    raise InvalidInput
+                try:
+                    expiration = expiration_from_code(parts[2])
+                except ValueError:
+                    raise InvalidInput
+                if self.vol_surface is None or self.vol_surface.state is None:
+                    print("No volatility surface built yet.")
+                else:
+                    print("IV {} {}: {}".format(parts[1], parts[2].upper(), 
+                          round(self.vol_surface.iv(int(parts[1]), expiration), 4)))
+            
             elif x[0] == "c":
                 if len(x) == 2:
                     if x[1] == "a":
@@ -229,248 +473,21 @@ class InputParser:
                             return [self.api_methods.cancel_last(cancel_last_label, currency)]
                     
                     elif x[1] == "b":
-                        to_cancel = []
-                        orders = self.feed.orders.copy()
-                        for i in orders.keys():
-                            for j in orders[i].keys():
-                                if (orders[i][j]["direction"] == "buy" and 
-                                "stop" not in orders[i][j]["order_type"]):
-                                    label_to_cancel = orders[i][j]["label"]
-                                    to_cancel.append(self.api_methods.cancel_last(label_to_cancel, currency))
-                        return to_cancel
+                        return self.cancel_labels(self.feed.find_orders(direction="buy", stop=False), currency)
                     
                     elif x[1] == "s":
-                        to_cancel = []
-                        orders = self.feed.orders.copy()
-                        for i in orders.keys():
-                            for j in orders[i].keys():
-                                if (orders[i][j]["direction"] == "sell" and 
-                                "stop" not in orders[i][j]["order_type"]):
-                                    label_to_cancel = orders[i][j]["label"]
-                                    to_cancel.append(self.api_methods.cancel_last(label_to_cancel, currency))
-                        return to_cancel
-
-                    elif x[1:] == "stops":
-                        to_cancel = []
-                        orders = self.feed.orders.copy()
-                        for i in orders.keys():
-                            for j in orders[i].keys():
-                                if "stop" in orders[i][j]["order_type"]:
-                                    label_to_cancel = orders[i][j]["label"]
-                                    to_cancel.append(self.api_methods.cancel_last(label_to_cancel, currency))
-                        return to_cancel
-
+                        return self.cancel_labels(self.feed.find_orders(direction="sell", stop=False), currency)
+                    
+                elif x[1:] == "stops":
+                    return self.cancel_labels(self.feed.find_orders(stop=True), currency)
                     
                 else:
                     raise InvalidInput            
             
             
             elif not x[-1] == "c":
-                
-                x_without_spaces = x.replace(" ", "")
-                if not x_without_spaces.isalnum():
-                    raise InvalidInput
-                
-                spaces = [0]
-                for i in range((len(x) - len(x_without_spaces)) + 1):
-                    space = x.find(" ", spaces[i]+1)
-                    if space > 0:
-                        spaces.append(space)
-                del spaces[0]
-                
-                
-                if x[0] == "a":
-                    side = "buy"
-                    
-                elif x[0] == "d":
-                    side = "sell"
-                
-                else:
-                    raise InvalidInput
-                
-                
-                if x[1] == "w":
-                    price = self.feed.fetch_btcusd_bbo(self.instrument, "ask")
-                elif x[1] == "s":
-                    price = self.feed.fetch_btcusd_bbo(self.instrument, "bid")
-                else:
-                    price = None
-                
-                
-                
-                if len(spaces) == 0:
-                    
-                    if x[1].isdigit():
-                        amount = x[1:]
-                        if not amount.isnumeric():
-                            raise InvalidInput
-                        
-                        elif int(amount) > 10**4:
-                            raise InvalidInput
-                            
-                        amount = int(amount) * self.size_multiplier
-                        
-                        if side == "buy":
-                            price = self.feed.fetch_btcusd_bbo(self.instrument, "ask") * 1.001
-                        elif side == "sell":
-                            price = self.feed.fetch_btcusd_bbo(self.instrument, "bid") * 0.999
-                        
-                        price = int(price)
-                        
-                        order_type = "market_limit"
-                        self.label_storage.append(self.label_counter)
-                        self.label_counter += 1
-                        return [self.api_methods.send_order(self.instrument, 
-                                                            side, amount, 
-                                                            order_type, 
-                                                            label, price)]
-                        
-                        
-                    else:
-                        amount = x[2:]
-                        if not amount.isnumeric():
-                            raise InvalidInput                        
-                        elif int(amount) > 10**4:
-                            raise InvalidInput
-                            
-                        if ((x[1] != "w") and (x[1] != "s")):
-                            raise InvalidInput
-                            
-                        amount = int(amount) * self.size_multiplier
-                        
-                        if (side == "buy" and x[1] == "s") or (side == "sell" and x[1] == "w"):
-                            post_only = True
-                            order_type = "limit"
-                        else:
-                            post_only = False
-                            order_type = "market_limit"
-                        self.label_storage.append(self.label_counter)
-                        self.label_counter += 1
-                        return [self.api_methods.send_order(self.instrument, 
-                                                            side, amount, 
-                                                            order_type, label, 
-                                                            price, 
-                                                            post_only=post_only)]    
-                        
-                
-                
-                elif len(spaces) == 1:
-        
-                    if price is not None:
-                        amount = x[2:spaces[0]]
-                    else:
-                        amount = x[1:spaces[0]]
-                    
-                    if not amount.isnumeric():
-                        raise InvalidInput
-                    
-                    amount = int(amount) * self.size_multiplier
-                    
-                    if x[-1] == "s":
-                        order_type = "stop_market"
-                        price = x[spaces[0] + 1 : -1]
-                        
-                        if not price.isnumeric():
-                            raise InvalidInput
-                        
-                        price = int(price)
-                        
-                        if ((side == "buy" and price <= self.feed.fetch_btcusd_bbo(self.instrument, "ask"))
-                            or (side == "sell" and price >= self.feed.fetch_btcusd_bbo(self.instrument, "bid"))):
-                            raise InvalidInput
-                        
-                        trigger_price = int(price)
-                        trigger = "mark_price"
-                        reduce_only = True
-                        self.label_storage.append(self.label_counter)                        
-                        self.label_counter += 1
-                        return [self.api_methods.send_order(self.instrument, 
-                                                            side, amount, 
-                                                            order_type, label, 
-                                                            price, 
-                                                            trigger=trigger, 
-                                                            trigger_price=trigger_price, 
-                                                            reduce_only=reduce_only)]
-                        
-                        
-                    else:
-                        price = x[spaces[0] + 1 :]
-                        order_type = "limit"
-                        
-                        if not price.isnumeric():
-                            raise InvalidInput
-                    
-                        price = int(price)
-                        post_only = True
-                        self.label_storage.append(self.label_counter)
-                        self.label_counter += 1
-                        return [self.api_methods.send_order(self.instrument, 
-                                                            side, amount, 
-                                                            order_type, label, 
-                                                            price, 
-                                                            post_only=post_only)]
-                        
-                    
-                    
-                elif len(spaces) == 3:
-                    
-                    if price:
-                        amount = x[2:spaces[0]]
-                    else:
-                        amount = x[1:spaces[0]]
-                    
-                    if not amount.isnumeric():
-                        raise InvalidInput
-                    
-                    amount = int(amount) * self.size_multiplier
-                    
-                    bound1 = x[spaces[0] + 1 : spaces[1]]
-                    bound2 = x[spaces[1] + 1 : spaces[2]]
-                    number_of_orders = x[spaces[2] + 1 :]
-                    
-                    
-                    if not bound1.isnumeric():
-                        raise InvalidInput
-                        
-                    if not bound2.isnumeric():
-                        raise InvalidInput
-                        
-                    if not number_of_orders.isnumeric():
-                        raise InvalidInput
-                    
-        
-                    bound1 = int(bound1)
-                    bound2 = int(bound2)
-                    number_of_orders = int(number_of_orders)
-                    if number_of_orders < 2:
-                        raise InvalidInput
-                    
-                    distance = abs(bound1 - bound2) / number_of_orders
-                    
-                    if side == "buy":
-                        prices = [min(bound1, bound2) + distance * i for i in range(number_of_orders)]
-                    elif side == "sell":
-                        prices = [max(bound1, bound2) - distance * i for i in range(number_of_orders)]
-                    
-                    order_type = "limit"
-                    
-                    laddered_orders = []
-                    
-                    for p in range(len(prices)):
-                        price = int(prices[p])
-                        label = "manual_api_{}".format(str(self.label_counter))
-                        order = self.api_methods.send_order(self.instrument, 
-                                                            side, amount, 
-                                                            order_type, label, 
-                                                            price, 
-                                                            post_only=True)
-                        laddered_orders.append(order)
-                        self.label_storage.append(self.label_counter)
-                        self.label_counter += 1
-                    return laddered_orders
-                    
-                else:
-                    raise InvalidInput
+                # trade commands are handled by parse_trade before the branches above
+                raise InvalidInput
                 
             else:
                 print("Command not executed, last letter = 'c'.")
@@ -509,12 +526,29 @@ class InputParser:
               "\ncstops (= cancel all stop orders)"
               "\nshow size multiplier \nreset size multiplier"
               "\nchange instrument \nconnection status"
+              "\nsurface (= forward and atm iv per expiry)"
+              "\niv 20000 30DEC22 (= iv of a strike and expiry from the surface)"
               "\nprice (= show best bid and offer of current instrument)"
+              "\ntape (= last trades, volume, vwap and signed flow of current instrument)"
+              "\nbars 60 (= last 60s bars of current instrument, as set in settings)"
+              "\nlatency (= parse / serialize time of order commands)"
+              "\nstatus (= bbo, position, net delta, hedger and feed lag)"
+              "\nstats (= calls and times of the hot paths), stats on / off / reset"
+              "\nprofile 10 (= sample all threads for 10s, write the profile to a file)"
               "\nshutdown / quit"
               )
     
 
         
 
+def format_table(rows, columns):
+    """ Rows as right-aligned text columns under a header """
+    cells = [[str(column) for column in columns]]
+    cells += [[str(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(columns))]
+    return "\n".join("  ".join(value.rjust(width) for value, width in zip(row, widths))
+                     for row in cells)
+
+
 class InvalidInput(Exception):
     pass
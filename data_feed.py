@@ -1,5 +1,8 @@
 from datetime import datetime
 import logging
+import time
+from profiling import timed
+from trade_tape import TradeTape
 
 class DataFeed:
     
@@ -7,22 +10,47 @@ class DataFeed:
     This module processes the incoming data and stores part of it locally.
     As such, it builds and updates all options complete orderbooks, 
     keeps track of account positions and open orders and a few other things.
+    An account's feed (DataFeed(market=feed)) shares the books of the market 
+    data feed, which are only ever updated in place, and keeps its own 
+    orders, positions and account information. Public trades go to the 
+    trade tape (trade_tape.py), which accounts share as well, as do the 
+    futures bars (bars.py) if given.
     """
     
-    def __init__(self):
+    def __init__(self, market=None, tape=None, bars=None):
         self.logger = logging.getLogger("deribit")
+        self.market = market
         self.ob = dict() # All options contracts complete order books
         self.oi = dict() # Options OI per contract
         self.futures_bbo = dict() # All futures contracts best bid and offer
-        self.account = {} # Account information e.g. balance
+        self.account = {} # Account information e.g. balance, per currency
         self.orders = {} # Accounts open orders
-        self.trades = {} # Accounts trade history, not yet implemented
+        self.order_by_id = {} # Open orders by id (same objects as in self.orders)
+        self.order_ids_by_label = {} # Label -> ids of open orders
+        self.order_ids_by_direction = {"buy":set(), "sell":set()} # Direction -> ids of open orders
+        self.order_ids_by_stop = {True:set(), False:set()} # Stop / non-stop -> ids of open orders
+        self.trades = tape if tape is not None else TradeTape() # Public trades per instrument
+        self.bars = bars # Futures bars at several timeframes, None = off
         self.positions = {} # Accounts positions
         self.account_info_headers = ["available_funds", "balance", 
                                      "delta_total", "initial_margin", 
                                      "maintenance_margin", "margin_balance"]
         self.got_open_orders = False # True if accounts open orders have been received
+        self.expiry_contracts = dict() # Options contracts per expiry, e.g. 'BTC-30DEC22'
+        self.expiry_versions = dict() # Book updates per expiry, consumers compare to find changed expiries
+        self.last_futures_update = None # (exchange timestamp in ms, local receive time) of the last futures bbo
+        self.changed_books = None # option books changed since taken by the shared book writer, None = not tracked
         
+        if market is not None:
+            self.ob = market.ob
+            self.oi = market.oi
+            self.futures_bbo = market.futures_bbo
+            self.expiry_contracts = market.expiry_contracts
+            self.expiry_versions = market.expiry_versions
+            self.trades = market.trades
+            self.bars = market.bars
+        
+    @timed
     def initial_open_orders(self, data):
         for order in data:
             order["replaced"] = False
@@ -34,9 +62,11 @@ class DataFeed:
                 self.orders[instrument_name] = {order_id : order}
             else:
                 self.orders[instrument_name][order_id] = order
+            self.index_order(order)
         
         self.got_open_orders = True
     
+    @timed
     def initial_positions(self, data):
         for position in data:
             if not position["size"] == 0:
@@ -44,6 +74,7 @@ class DataFeed:
                 self.positions[instrument_name] = position
         
     
+    @timed
     def update_positions(self, data):
         
         """
@@ -96,6 +127,7 @@ class DataFeed:
             
                 
     
+    @timed
     def manage_orders(self, data):
         instrument_name = data["instrument_name"]
         order_id = data["order_id"]
@@ -112,33 +144,124 @@ class DataFeed:
                     # cancelled orders are taken out
                     if data["order_state"] == "cancelled": 
                         del self.orders[instrument_name][order_id]
+                        self.unindex_order(order_id)
                     
                     # fully filled orders are taken out
                     elif (data["order_state"] == "filled" and data["filled_amount"] == data["max_show"]):
                         del self.orders[instrument_name][order_id]
+                        self.unindex_order(order_id)
                     
                     # partially filled, and generally open orders which are 
                     # already in the system are updated
                     else: 
                         self.orders[instrument_name][order_id] = data
+                        self.index_order(data)
                         
-                else: # open orders which are not in the system yet
+                # open orders which are not in the system yet (the notification 
+                # of an order closed e.g. by cancel_all can follow its reply)
+                elif data["order_state"] in ["open", "untriggered"]:
                     self.orders[instrument_name][order_id] = data
+                    self.index_order(data)
                     
         else:
             print("ORDER REJECTED! Check margin balance?")
     
     
     
+    def index_order(self, order):
+        
+        """
+        Secondary indexes over the open orders, so cancel selections and 
+        label lookups do not have to scan self.orders. Updates re-index.
+        """
+        
+        order_id = order["order_id"]
+        if order_id in self.order_by_id:
+            self.unindex_order(order_id)
+        self.order_by_id[order_id] = order
+        
+        if order["label"] not in self.order_ids_by_label:
+            self.order_ids_by_label[order["label"]] = set()
+        self.order_ids_by_label[order["label"]].add(order_id)
+        
+        if order["direction"] not in self.order_ids_by_direction:
+            self.order_ids_by_direction[order["direction"]] = set()
+        self.order_ids_by_direction[order["direction"]].add(order_id)
+        
+        self.order_ids_by_stop["stop" in order["order_type"]].add(order_id)
+        
+        
+    def unindex_order(self, order_id):
+        order = self.order_by_id.pop(order_id, None)
+        if order is None:
+            return
+        
+        ids = self.order_ids_by_label.get(order["label"])
+        if ids is not None:
+            ids.discard(order_id)
+            if not ids:
+                del self.order_ids_by_label[order["label"]]
+        
+        if order["direction"] in self.order_ids_by_direction:
+            self.order_ids_by_direction[order["direction"]].discard(order_id)
+        self.order_ids_by_stop["stop" in order["order_type"]].discard(order_id)
+        
+        
+    def clear_orders(self):
+        self.orders = {}
+        self.order_by_id = {}
+        self.order_ids_by_label = {}
+        self.order_ids_by_direction = {"buy":set(), "sell":set()}
+        self.order_ids_by_stop = {True:set(), False:set()}
+        
+        
+    def find_orders(self, direction=None, stop=None, label=None):
+        
+        """ 
+        Open orders matching all given criteria, via the indexes. 
+        E.g. find_orders(direction="buy", stop=False) for all non-stop bids.
+        """
+        
+        selections = []
+        if direction is not None:
+            selections.append(self.order_ids_by_direction.get(direction, set()))
+        if stop is not None:
+            selections.append(self.order_ids_by_stop[stop])
+        if label is not None:
+            selections.append(self.order_ids_by_label.get(label, set()))
+        
+        if selections:
+            ids = set.intersection(*selections)
+        else:
+            ids = set(self.order_by_id.keys())
+        
+        orders = [self.order_by_id.get(order_id) for order_id in ids]
+        return [order for order in orders if order is not None]
+    
+    
+    def get_order(self, order_id):
+        return self.order_by_id.get(order_id)
+    
+    
+    def get_order_labels(self):
+        return list(self.order_ids_by_label.keys())
+    
+    
+    @timed
     def manage_portfolio(self, data):
+        currency = data.get("currency", "BTC").upper()
+        if currency not in self.account:
+            self.account[currency] = {}
         for header in self.account_info_headers:
-            self.account[header] = data[header]
+            self.account[currency][header] = data[header]
         
         
+    @timed
     def manage_option_oi(self, msg):
         self.oi[msg["instrument_name"]] = msg["open_interest"]
         
         
+    @timed
     def build_options_ob_from_snapshots(self, snapshot):
         bids = dict()
         for bid in snapshot["bids"]:
@@ -148,7 +271,16 @@ class DataFeed:
             asks[ask[1]] = ask[2]
         self.ob[snapshot["instrument_name"]] = {"bids":bids, "asks":asks}
         
+        expiry = expiry_key(snapshot["instrument_name"])
+        if expiry not in self.expiry_contracts:
+            self.expiry_contracts[expiry] = set()
+        self.expiry_contracts[expiry].add(snapshot["instrument_name"])
+        self.mark_expiry_changed(expiry)
+        if self.changed_books is not None:
+            self.changed_books[snapshot["instrument_name"]] = None
+        
         
+    @timed
     def update_options_ob(self, msg):
         contract = msg["instrument_name"]
         for side in ["bids", "asks"]:
@@ -160,13 +292,45 @@ class DataFeed:
                         self.ob[contract][side][i[1]] = i[2]
                     else:
                         pass
+        self.mark_expiry_changed(expiry_key(contract))
+        if self.changed_books is not None:
+            self.changed_books[contract] = None
     
     
+    @timed
     def update_futures_bbo(self, message):
         instrument = message["instrument_name"]
         bid = message["bids"][0][0]
         ask = message["asks"][0][0]
         self.futures_bbo[instrument] = {"bid":bid, "ask":ask}
+        self.last_futures_update = (message.get("timestamp"), time.time())
+        if self.bars is not None:
+            # the receive time for a quote without exchange time
+            timestamp = self.last_futures_update[0] or int(self.last_futures_update[1] * 1000)
+            self.bars.on_quote(instrument, timestamp, (bid + ask) / 2)
+        
+        # a dated future is its expiry's forward, the perpetual the spot of
+        # all of its currency's expiries (fallback forward, strikes ranking)
+        if instrument.endswith("-PERPETUAL"):
+            prefix = instrument[:instrument.find("-") + 1]
+            for expiry in list(self.expiry_versions):
+                if expiry.startswith(prefix):
+                    self.mark_expiry_changed(expiry)
+        else:
+            expiry = expiry_key(instrument)
+            if expiry in self.expiry_versions:
+                self.mark_expiry_changed(expiry)
+    
+    
+    @timed
+    def update_trades(self, data):
+        self.trades.add_trades(data)
+        if self.bars is not None:
+            self.bars.on_trades(data)
+    
+    
+    def mark_expiry_changed(self, expiry):
+        self.expiry_versions[expiry] = self.expiry_versions.get(expiry, 0) + 1
     
     
     # def delete_order(self):
@@ -177,8 +341,8 @@ class DataFeed:
     def get_orders(self):
         return self.orders
     
-    def get_account_data(self):
-        return self.account
+    def get_account_data(self, currency="BTC"):
+        return self.account.get(currency, {})
     
     def get_trades(self):
         return self.trades
@@ -192,6 +356,29 @@ class DataFeed:
     def fetch_local_oi(self):
         return self.oi
     
+    def feed_lag(self):
+        
+        """ 
+        Seconds between the exchange's timestamp of the last futures bbo and 
+        its arrival, and seconds since it arrived. None before the first one.
+        """
+        
+        if self.market is not None:
+            return self.market.feed_lag()
+        if self.last_futures_update is None:
+            return None
+        exchange_ms, received = self.last_futures_update
+        lag = None
+        if exchange_ms is not None:
+            lag = received - exchange_ms / 1000
+        return lag, time.time() - received
+    
     def fetch_btcusd_bbo(self, instrument, side):
         return self.futures_bbo[instrument][side]
         
+
+
+
+def expiry_key(instrument):
+    """ 'BTC-30DEC22-20000-C' (or the future 'BTC-30DEC22') -> 'BTC-30DEC22' """
+    return "-".join(instrument.split("-", 2)[:2])
@@ -0,0 +1,71 @@
+import configparser
+
+
+def read_settings(path="settings.txt"):
+    config = configparser.RawConfigParser()
+    with open(path) as f:
+        config.read_file(f)
+    return config
+
+
+def connection_parameters(config):
+    """ The [PostgreSQL] section of settings.txt as psycopg2.connect keywords """
+    database_information = dict(config.items("PostgreSQL"))
+    return {"database": database_information["database"],
+            "user": database_information["user"],
+            "password": database_information["password"],
+            "host": database_information["host"],
+            "port": database_information["port"]}
+
+
+def connection_url(config):
+    """ SQLAlchemy url for the same database """
+    parameters = connection_parameters(config)
+    host = parameters["host"]
+    if host == "localhost":
+        host = "127.0.0.1"
+    return "postgresql://{}:{}@{}:{}/{}".format(parameters["user"],
+                                                parameters["password"],
+                                                host,
+                                                parameters["port"],
+                                                parameters["database"])
+
+
+def connect(config):
+    """ New psycopg2 connection from the settings """
+    import psycopg2
+    return psycopg2.connect(**connection_parameters(config))
+
+
+def db_connection(config):
+
+    """
+    The {"c", "conn", "engine"} dict the snapshot and BVIX modules expect,
+    with a new connection and engine.
+    """
+
+    from sqlalchemy import create_engine
+    conn = connect(config)
+    return {"c": conn.cursor(), "conn": conn, "engine": create_engine(connection_url(config))}
+
+
+def utc_timestamp(value):
+    """ Time range bounds for queries, naive values are taken as UTC """
+    import pandas as pd
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tz is None else ts.tz_convert("UTC")
+
+
+def currency_table(table, currency="BTC"):
+    """ obot table of a currency: BTC keeps the original names (derbbo), others get a suffix (derbbo_eth) """
+    if currency == "BTC":
+        return table
+    return "{}_{}".format(table, currency.lower())
+
+
+def currencies(config):
+    """ Underlyings of the [Markets] section (comma separated), BTC if not set """
+    if not config.has_section("Markets"):
+        return ["BTC"]
+    names = config.get("Markets", "currencies", fallback="BTC")
+    return [name.strip().upper() for name in names.split(",") if name.strip()] or ["BTC"]
@@ -0,0 +1,138 @@
+import time
+import numpy as np
+
+
+class ForwardCurve:
+
+    """
+    Implied forward price per expiry, computed once per snapshot epoch and
+    shared by all consumers (snapshots, BVIX, hedger).
+
+    For each expiry, the forward is taken from the matching dated future
+    (e.g. BTC-30DEC22) if it has a two-sided quote. Otherwise it is implied
+    from put-call parity on the local option books, averaged over the
+    strikes closest to the underlying where both the call and the put have a
+    bid and an ask. Option prices are in coin, the USD premium divided by
+    the forward, so parity reads C - P = 1 - K / F, i.e. F = K / (1 - (C - P)),
+    and USD premiums are the coin prices times their expiry's forward. If
+    neither source is available, the perpetual mid itself is used.
+    """
+
+    def __init__(self, feed, currency="BTC", epoch_seconds=60, parity_strikes=3):
+        self.feed = feed
+        self.currency = currency
+        self.epoch_seconds = epoch_seconds
+        self.parity_strikes = parity_strikes
+        self.perpetual = "{}-PERPETUAL".format(currency)
+
+        self.epoch = None
+        self.forwards = dict() # expiry code (e.g. '30DEC22') -> forward
+
+
+    def current_epoch(self):
+        return int(time.time() // self.epoch_seconds)
+
+
+    def spot(self):
+        return (self.feed.fetch_btcusd_bbo(self.perpetual, "ask")
+                + self.feed.fetch_btcusd_bbo(self.perpetual, "bid")) / 2
+
+
+    def curve(self, epoch=None):
+        """ Forwards of the given (default: current) epoch, computed from the live books if stale """
+        if epoch is None:
+            epoch = self.current_epoch()
+        if epoch != self.epoch:
+            self.update(epoch, *self.quotes_from_books(), self.spot())
+        return self.forwards
+
+
+    def forward(self, expiry_code, epoch=None):
+        curve = self.curve(epoch)
+        if expiry_code in curve:
+            return curve[expiry_code]
+        return self.spot()
+
+
+    def update(self, epoch, codes, strikes, is_call, bid, ask, spot):
+
+        """
+        Builds the curve from one snapshot of option quotes (arrays of equal
+        length, prices in BTC) and caches it for the epoch.
+        """
+
+        self.forwards = self.compute(codes, strikes, is_call, bid, ask, spot)
+        self.epoch = epoch
+        return self.forwards
+
+
+    def compute(self, codes, strikes, is_call, bid, ask, spot):
+        """ Like update, for any subset of expiries and without touching the cached curve """
+        codes = np.asarray(codes)
+        strikes = np.asarray(strikes, dtype=float)
+        is_call = np.asarray(is_call, dtype=bool)
+        mid = (np.asarray(bid, dtype=float) + np.asarray(ask, dtype=float)) / 2
+
+        unique_codes, code_index = np.unique(codes, return_inverse=True)
+        forwards = np.full(len(unique_codes), np.nan)
+
+        # put-call parity on strikes with two-sided call and put quotes
+        quoted = ~np.isnan(mid)
+        keys = code_index * 10**9 + strikes
+        call_keys = keys[quoted & is_call]
+        put_keys = keys[quoted & ~is_call]
+        pairs, call_rows, put_rows = np.intersect1d(call_keys, put_keys, return_indices=True)
+
+        if len(pairs) > 0:
+            call_mid = mid[quoted & is_call][call_rows]
+            put_mid = mid[quoted & ~is_call][put_rows]
+            pair_code = code_index[quoted & is_call][call_rows]
+            pair_strike = strikes[quoted & is_call][call_rows]
+            # coin quoted parity, a spread of 1 coin or more implies no forward
+            with np.errstate(divide="ignore", invalid="ignore"):
+                parity = np.where(call_mid - put_mid < 1,
+                                  pair_strike / (1 - (call_mid - put_mid)), np.nan)
+
+            # rank strikes by distance to the underlying within each expiry
+            order = np.lexsort((np.abs(pair_strike - spot), pair_code))
+            sorted_code = pair_code[order]
+            group_start = np.r_[0, np.flatnonzero(np.diff(sorted_code)) + 1]
+            rank = np.arange(len(order)) - np.repeat(group_start, np.diff(np.r_[group_start, len(order)]))
+            nearest = order[rank < self.parity_strikes]
+
+            nearest = nearest[~np.isnan(parity[nearest])]
+            total = np.bincount(pair_code[nearest], weights=parity[nearest], minlength=len(unique_codes))
+            count = np.bincount(pair_code[nearest], minlength=len(unique_codes))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                forwards = np.where(count > 0, total / count, np.nan)
+
+        # dated futures take precedence
+        for i, code in enumerate(unique_codes):
+            future = self.feed.futures_bbo.get("{}-{}".format(self.currency, code))
+            if future is not None and future["bid"] and future["ask"]:
+                forwards[i] = (future["bid"] + future["ask"]) / 2
+
+        forwards = np.where(np.isnan(forwards), spot, forwards)
+        return dict(zip(unique_codes.tolist(), forwards.tolist()))
+
+
+    def quotes_from_books(self):
+        """ Best bids and asks of all local options books as arrays """
+        codes = []
+        strikes = []
+        is_call = []
+        bids = []
+        asks = []
+        books = self.feed.fetch_local_ob().copy()
+        for name in list(books.keys()):
+            parts = name.split("-")
+            if len(parts) != 4 or parts[0] != self.currency:
+                continue
+            bid_prices = list(books[name]["bids"].keys())
+            ask_prices = list(books[name]["asks"].keys())
+            codes.append(parts[1])
+            strikes.append(float(parts[2]))
+            is_call.append(parts[3] == "C")
+            bids.append(max(bid_prices) if bid_prices else np.nan)
+            asks.append(min(ask_prices) if ask_prices else np.nan)
+        return codes, strikes, is_call, bids, asks
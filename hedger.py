@@ -1,18 +1,18 @@
-from py_vollib_vectorized import vectorized_implied_volatility as viv
 from datetime import datetime
 import pytz
-from scipy.stats import norm
 import numpy as np
 import logging
+import time
 from api_trading_methods import ApiMethods
+from profiling import timed
 
 class DeltaHedge:
     
     """ 
     Any options contract can be delta-hedged dynamically using the underlying.
-    In this hedger, the underlying is the BTC-PERPETUAL trading pair, 
-    but can be altered. 
-    This module ONLY compares ALL options deltas to ONE 
+    In this hedger, the underlying is the currency's perpetual (BTC-PERPETUAL 
+    by default), one hedger runs per currency. 
+    This module ONLY compares ALL options deltas of its currency to ONE 
     specified futures position, and hedges based on this comparison. 
     It does NOT hedge taking other futures positions into account.
     
@@ -27,9 +27,12 @@ class DeltaHedge:
     Unfortunately, deribits naming convention requires a bit of tedious work.
     """
     
-    def __init__(self, feed):
+    def __init__(self, feed, forward_curve, vol_surface=None, currency="BTC"):
         
         self.feed = feed
+        self.currency = currency
+        self.forward_curve = forward_curve
+        self.vol_surface = vol_surface
         self.api_methods = ApiMethods()
         self.logger = logging.getLogger("deribit")
         self.delta_hedging_activated = False
@@ -37,12 +40,18 @@ class DeltaHedge:
                        "JUL":7, "AUG":8, "SEP":9, "OCT":10, "NOV":11, "DEC":12}
         
         self.max_delta_mismatch = 0.0025 # Percentage of the underlyings value deltas may differ
-        self.hedge_instrument = "BTC-PERPETUAL"
+        self.hedge_instrument = "{}-PERPETUAL".format(currency)
+        self.amount_step = 10 if currency == "BTC" else 1 # perpetual order amounts in USD
         self.op_delta = 0
         self.btchedge_delta = 0
+        self.delta_time = None # time.time() of the last delta determination (read by the status line)
         self.send_to_ws = None
         
+        # outcomes of the delta checks while active (read by metrics)
+        self.decisions = dict.fromkeys(["no_option_delta", "within_band", "buy", "sell"], 0)
+        
     
+    @timed
     def check_deltas(self, send_method):
         
         if not self.delta_hedging_activated:
@@ -52,16 +61,26 @@ class DeltaHedge:
             self.send_to_ws = send_method
             current_options_delta, current_hedge_delta = self.determine_option_delta()
             
-            lower_bound = self.max_delta_mismatch * self.feed.fetch_btcusd_bbo(self.hedge_instrument, "bid") * -1
-            upper_bound = self.max_delta_mismatch * self.feed.fetch_btcusd_bbo(self.hedge_instrument, "bid")
+            # the band scales with the same (unrounded) mid the deltas are valued at
+            lower_bound = self.max_delta_mismatch * self.hedge_price() * -1
+            upper_bound = self.max_delta_mismatch * self.hedge_price()
             
             if abs(current_options_delta) > 0:
                 if not (lower_bound < ((current_hedge_delta * -1) - current_options_delta) < upper_bound):
                     self.rehedge(current_options_delta, current_hedge_delta)
+                else:
+                    self.decisions["within_band"] += 1
             else:
-                pass
+                self.decisions["no_option_delta"] += 1
+    
     
+    def hedge_price(self):
+        """ Mid of the hedge instrument, unrounded (ETH trades in fractions of a dollar) """
+        return (self.feed.fetch_btcusd_bbo(self.hedge_instrument, "bid") 
+                + self.feed.fetch_btcusd_bbo(self.hedge_instrument, "ask")) / 2
     
+    
+    @timed
     def determine_option_delta(self):
         
         positions = self.feed.positions.copy()
@@ -77,6 +96,8 @@ class DeltaHedge:
         for key in positions.keys():
             if (str(key)[-1] != "P" and str(key)[-1] != "C"):
                 keys_to_delete.append(key)
+            elif not str(key).startswith(self.currency + "-"):
+                keys_to_delete.append(key)
             elif positions[key]["size"] == 0:
                 keys_to_delete.append(key)
                 
@@ -87,14 +108,24 @@ class DeltaHedge:
         option_delta = 0
         
         if len(positions) > 0:
+            
+            btcusd_price = self.hedge_price()
+            now = datetime.now(pytz.UTC)
+            
+            curve = self.forward_curve.curve()
+            
+            sizes = []
+            marks = []
+            forwards = []
+            strikes = []
+            ttms = []
+            expirations = []
+            is_call = []
         
             for key in positions.keys():
                 name = str(positions[key]["instrument_name"])
-                size = positions[key]["size"]
-                hedge_bid = self.feed.fetch_btcusd_bbo(self.hedge_instrument, "bid")
-                hedge_ask = self.feed.fetch_btcusd_bbo(self.hedge_instrument, "ask")
-                btcusd_price = int((hedge_bid + hedge_ask) / 2)
-                price = positions[key]["mark_price"] * btcusd_price
+                sizes.append(positions[key]["size"])
+                marks.append(positions[key]["mark_price"])
                 
                 # tedious parsing of deribit option naming convention
                 first = name.find("-")
@@ -103,32 +134,51 @@ class DeltaHedge:
                 
                 typ = name[-1]
                 exp = name[first+1:second]
-                strike = int(name[second+1:third])
+                strikes.append(int(name[second+1:third]))
+                forwards.append(curve.get(exp, btcusd_price))
                 
                 year = int(exp[-2:]) + 2000
                 month = self.months[exp[-5:-2]]
                 day = int(exp[:-5])
                 
                 expiration = datetime(year, month, day, 8, 0, 0, 0, pytz.UTC)
-                ttmyears = ((expiration - datetime.now(pytz.UTC)).total_seconds()) / (60*60*24*365)
-                
-                iv = viv(price, btcusd_price, strike, ttmyears, 0, 
-                         typ.lower(), 0, on_error="ignore", 
-                         model='black_scholes_merton', 
-                         return_as = 'numpy').round(4)
-                iv = iv[0]
-                
-                delta = self.bsm_delta(btcusd_price, strike, iv, 0, 0, ttmyears, typ.lower())
-                delta = delta * size * btcusd_price
-                option_delta += delta
+                expirations.append(expiration)
+                ttms.append(((expiration - now).total_seconds()) / (60*60*24*365))
+                is_call.append(typ == "C")
+            
+            forwards = np.array(forwards)
+            # marks are in coin, worth their price in the expiry's forward
+            prices = np.array(marks) * forwards
+            strikes = np.array(strikes)
+            ttms = np.array(ttms)
+            is_call = np.array(is_call)
+            
+            # ivs come from the live surface, positions are only solved 
+            # from their mark prices if there is no recent surface build
+            ivs = np.full(len(strikes), np.nan)
+            if self.vol_surface is not None and self.vol_surface.available():
+                ivs = self.vol_surface.implied_volatility(strikes, expirations).round(4)
+            
+            # solver (scipy) imported on first use of the hedging subsystem
+            from implied_volatility import implied_volatility, black_delta
+            missing = np.isnan(ivs)
+            if missing.any():
+                ivs[missing] = implied_volatility(prices[missing], forwards[missing], 
+                                                  strikes[missing], ttms[missing], 
+                                                  is_call[missing]).round(4)
+            
+            deltas = black_delta(forwards, strikes, ttms, ivs, is_call)
+            option_delta = float(np.sum(deltas * np.array(sizes) * btcusd_price))
         
         self.op_delta = option_delta
         self.btchedge_delta = hedge_delta
+        self.delta_time = time.time()
         
         return option_delta, hedge_delta
     
     
     
+    @timed
     def rehedge(self, option_delta, hedge_delta):
         side = ""
         target = option_delta * -1
@@ -141,7 +191,8 @@ class DeltaHedge:
             side = "buy"
             price = self.feed.fetch_btcusd_bbo(self.hedge_instrument, "ask")
             
-        amount = (abs(diff) // 10) * 10        
+        amount = (abs(diff) // self.amount_step) * self.amount_step
+        self.decisions[side] += 1
         self.logger.info("Rehedging: {} {} at market.".format(side, amount))
         
         order = self.api_methods.send_order(self.hedge_instrument, 
@@ -149,18 +200,4 @@ class DeltaHedge:
                                             "delta_hedge", price)
         message = order[0]
         call_type = order[1]
-        self.send_to_ws(message, call_type)          
-    
-
-    def bsm_delta(self, S,X,sigma, r, q, ttm, otype):
-        delta = None
-        
-        b = float(r - q)
-        d1 = (np.log(S/X) + (b + (sigma**2)/2)*ttm) / (sigma * np.sqrt(ttm))
-        d2 = d1 - sigma * np.sqrt(ttm)
-        
-        if (otype == "c"):
-            delta = np.exp((b-r)*ttm)*norm.cdf(d1)
-        elif (otype == "p"):
-            delta = -np.exp((b-r)*ttm)*norm.cdf(-d1)
-        return delta
\ No newline at end of file
+        self.send_to_ws(message, call_type)
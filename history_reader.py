@@ -0,0 +1,198 @@
+"""
+Bulk reads of the stored snapshots (obot.derbbo), the BVIX (obot.bvix) and
+the SVI parameters (obot.bvix_svi) into NumPy arrays, for research and
+backtests.
+
+    reader = HistoryReader()
+    data = reader.read("derbbo", "2022-11-01", "2022-11-02",
+                       columns=["timestamp", "strike", "typ", "bid_iv", "ask_iv"],
+                       instruments=["BTC-30DEC22-20000-C"])
+    for chunk in reader.iter_chunks("bvix", "2022-01-01", "2022-12-01", chunk=timedelta(days=7)):
+        ...
+
+Rows are streamed with COPY ... TO STDOUT (FORMAT binary). The query casts
+every column to a fixed width type (float8, timestamptz, a one byte code for
+typ) and replaces NULLs with NaN / -infinity, so each row has the same
+length and a whole chunk is decoded with a single numpy.frombuffer instead
+of a Python loop per row. Timestamps come back as datetime64[ns] in UTC
+(NaT for NULL), typ as 'C'/'P' strings, everything else as float64.
+
+iter_chunks splits the time range into windows and holds one window at a
+time, which bounds memory for long ranges. The connection is made from the
+same settings.txt the bot uses (database.py).
+"""
+
+from datetime import timedelta
+import io
+import numpy as np
+import pandas as pd
+
+import database
+from database import utc_timestamp
+from volatility_index import BVIX
+
+
+# column -> kind, in table order
+TABLES = {
+    "derbbo": {"timestamp": "ts", "btcusd_price": "f8", "ttmyears": "f8",
+               "expiration": "ts", "strike": "f8", "typ": "char", "oi": "f8",
+               "bid": "f8", "bid_usd": "f8", "bid_size": "f8", "bid_iv": "f8",
+               "ask": "f8", "ask_usd": "f8", "ask_size": "f8", "ask_iv": "f8",
+               "forward": "f8"},
+    "bvix": dict([("timestamp", "ts"), ("moneyness", "f8")]
+                 + [("d" + str(i), "f8") for i in BVIX.days_til_maturity]),
+    "bvix_svi": {"timestamp": "ts", "expiration": "ts", "ttmyears": "f8", "a": "f8",
+                 "b": "f8", "rho": "f8", "m": "f8", "sigma": "f8", "rmse": "f8",
+                 "points": "f8", "iterations": "f8"},
+}
+
+# select expression and binary field dtype per kind, NULLs mapped to a value of the same width
+KINDS = {
+    "f8": ("COALESCE({}::float8, 'NaN')", ">f8"),
+    "ts": ("COALESCE({}, '-infinity')", ">i8"),
+    "char": ("COALESCE(ascii({}), 0)::int2", ">i2"),
+}
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+POSTGRES_EPOCH_US = 946684800 * 10**6 # 2000-01-01 in unix microseconds
+MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN",
+          "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+
+
+class HistoryReader:
+
+    """ Time range reads of the obot tables as dicts of NumPy arrays """
+
+    def __init__(self, config=None, settings="settings.txt", schema="obot"):
+        if config is None:
+            config = database.read_settings(settings)
+        self.conn = database.connect(config)
+        self.c = self.conn.cursor()
+        self.schema = schema
+
+
+    def read(self, table, start, end, columns=None, instruments=None,
+             expirations=None, strikes=None, typ=None, currency="BTC"):
+
+        """
+        All rows with start <= timestamp < end as {column: array}, ordered by
+        timestamp. columns defaults to all of the table's columns.
+        Filters (derbbo and bvix_svi where the columns exist):
+            instruments: deribit names, e.g. ['BTC-30DEC22-20000-C']
+            expirations: datetimes, strikes: numbers, typ: 'C' or 'P'
+        Other currencies than BTC are read from their own tables (currency='ETH'
+        reads derbbo from obot.derbbo_eth).
+        """
+
+        columns = self.check_columns(table, columns)
+        query, parameters = self.build_query(table, start, end, columns, instruments,
+                                             expirations, strikes, typ, currency)
+        buffer = io.BytesIO()
+        self.c.copy_expert(self.c.mogrify(query, parameters).decode(), buffer)
+        self.conn.commit()
+        return decode_copy(buffer.getbuffer(), [TABLES[table][name] for name in columns],
+                           columns)
+
+
+    def iter_chunks(self, table, start, end, chunk=timedelta(days=1), **kwargs):
+        """ Like read, one time window of length chunk at a time """
+        position = utc_timestamp(start)
+        end = utc_timestamp(end)
+        while position < end:
+            chunk_end = min(position + chunk, end)
+            yield self.read(table, position, chunk_end, **kwargs)
+            position = chunk_end
+
+
+    def check_columns(self, table, columns):
+        if table not in TABLES:
+            raise ValueError("Unknown table {}, available: {}".format(table, list(TABLES)))
+        if columns is None:
+            return list(TABLES[table])
+        unknown = [name for name in columns if name not in TABLES[table]]
+        if unknown:
+            raise ValueError("Unknown columns for {}: {}".format(table, unknown))
+        return list(columns)
+
+
+    def build_query(self, table, start, end, columns, instruments, expirations, strikes, typ,
+                    currency="BTC"):
+        selected = [KINDS[TABLES[table][name]][0].format(name) for name in columns]
+        conditions = ["timestamp >= %s", "timestamp < %s"]
+        parameters = [utc_timestamp(start).to_pydatetime(), utc_timestamp(end).to_pydatetime()]
+
+        if instruments:
+            keys = [instrument_key(name) for name in instruments]
+            conditions.append("(expiration, strike, typ) IN ({})".format(
+                ", ".join(["(%s, %s, %s)"] * len(keys))))
+            parameters += [value for key in keys for value in key]
+        if expirations:
+            conditions.append("expiration IN ({})".format(", ".join(["%s"] * len(expirations))))
+            parameters += [utc_timestamp(e).to_pydatetime() for e in expirations]
+        if strikes:
+            conditions.append("strike IN ({})".format(", ".join(["%s"] * len(strikes))))
+            parameters += [float(k) for k in strikes]
+        if typ:
+            conditions.append("typ = %s")
+            parameters.append(typ)
+
+        query = "COPY (SELECT {} FROM {}.{} WHERE {} ORDER BY timestamp) TO STDOUT " \
+                "WITH (FORMAT binary)".format(", ".join(selected), self.schema,
+                                              database.currency_table(table, currency),
+                                              " AND ".join(conditions))
+        return query, parameters
+
+
+    def close(self):
+        self.conn.close()
+
+
+
+def decode_copy(data, kinds, names):
+
+    """
+    Decodes a binary COPY stream of fixed width rows (see KINDS) into
+    {name: array}.
+    """
+
+    data = memoryview(data)
+    if bytes(data[:11]) != COPY_SIGNATURE:
+        raise ValueError("Not a binary COPY stream")
+    extension = int.from_bytes(data[15:19], "big")
+    offset = 19 + extension
+
+    fields = [("count", ">i2")]
+    for i, kind in enumerate(kinds):
+        fields += [("length{}".format(i), ">i4"), ("value{}".format(i), KINDS[kind][1])]
+    row = np.dtype(fields)
+
+    # the stream ends with a 2 byte trailer (-1)
+    rows = (len(data) - offset - 2) // row.itemsize
+    records = np.frombuffer(data, dtype=row, count=rows, offset=offset)
+    if rows > 0 and (records["count"] != len(kinds)).any():
+        raise ValueError("Unexpected field count in COPY stream")
+
+    arrays = dict()
+    for i, (name, kind) in enumerate(zip(names, kinds)):
+        values = records["value{}".format(i)]
+        if kind == "f8":
+            arrays[name] = values.astype(np.float64)
+        elif kind == "ts":
+            micros = values.astype(np.int64)
+            missing = micros == np.iinfo(np.int64).min
+            stamps = (micros + POSTGRES_EPOCH_US).astype("datetime64[us]").astype("datetime64[ns]")
+            stamps[missing] = np.datetime64("NaT")
+            arrays[name] = stamps
+        else:
+            codes = values.astype(np.uint8)
+            arrays[name] = np.where(codes > 0, codes.view("S1").astype("U1"), "")
+    return arrays
+
+
+def instrument_key(name):
+    """ 'BTC-30DEC22-20000-C' -> (expiration, strike, typ) as stored in derbbo """
+    _, code, strike, typ = name.split("-")
+    expiration = pd.Timestamp(year=2000 + int(code[-2:]), month=MONTHS.index(code[-5:-2]) + 1,
+                              day=int(code[:-5]), hour=8, tz="UTC")
+    return expiration.to_pydatetime(), float(strike), typ
+
@@ -0,0 +1,158 @@
+"""
+The bot's health in the Prometheus text exposition format, served on
+localhost (http://127.0.0.1:<port>/metrics) when a port is set in the
+[Metrics] section of settings.txt.
+
+Nothing here is written on the ingest path: the modules keep plain
+counters which only their own thread increments (e.g. WSClient's message
+counts on the websocket thread), and a scrape reads them as they are. A
+scrape can thus be a message off, but never holds up market data.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+import numpy as np
+
+import profiling
+
+
+class MetricsServer:
+
+    def __init__(self, client, feed, delta_hedger, order_pipeline, port=9108, host="127.0.0.1"):
+        self.client = client
+        self.feed = feed
+        self.delta_hedger = delta_hedger
+        self.delta_hedgers = {delta_hedger.currency: delta_hedger} # all currencies, set by the bot
+        self.order_pipeline = order_pipeline
+        self.snapshots = dict() # currency -> SaveBBO, set once the storage is set up
+        # currency -> {stage: seconds}, reported by the snapshot process if it runs
+        self.snapshot_durations = dict()
+        self.extra_gauges = [] # (name, help, function returning {labels: value}), e.g. queue depths
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger("deribit")
+        self.server = None
+
+
+    def start(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = metrics.render().encode()
+                except Exception as e:
+                    metrics.logger.info("Metrics not rendered: {}".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics",
+                                       daemon=True)
+        self.thread.start()
+        self.logger.info("Metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, description, samples):
+            """ samples: {label dict as tuple of pairs: value} or a single value """
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if not isinstance(samples, dict):
+                samples = {(): samples}
+            for labels, value in samples.items():
+                if value is None:
+                    continue
+                label_text = ",".join('{}="{}"'.format(key, str(label).replace('"', "'"))
+                                      for key, label in labels)
+                lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "",
+                                              float(value)))
+
+        client = self.client
+        metric("deribit_messages_total", "counter", "Websocket messages received, by kind.",
+               {(("kind", kind),): count for kind, count in list(client.message_counts.items())})
+        metric("deribit_connected", "gauge", "1 while the websocket is connected.",
+               int(client.connected))
+        metric("deribit_ws_error_counter", "gauge",
+               "WSClient.error_counter, errors since the connection was last stable for a minute.",
+               client.error_counter)
+        metric("deribit_reconnects_total", "counter", "Websocket reconnects.", client.reconnects)
+
+        lag = self.feed.feed_lag()
+        metric("deribit_feed_lag_seconds", "gauge",
+               "Exchange timestamp of the last futures quote to its arrival.",
+               lag[0] if lag is not None else None)
+        metric("deribit_feed_age_seconds", "gauge", "Seconds since the last futures quote arrived.",
+               lag[1] if lag is not None else None)
+        metric("deribit_option_books", "gauge", "Option order books held.", len(self.feed.ob))
+
+        pipeline = self.order_pipeline
+        metric("deribit_queue_depth", "gauge", "Requests waiting for a reply, by queue.",
+               {(("queue", "order_legs"),): len(pipeline.pending),
+                (("queue", "order_batches"),): len(pipeline.batches),
+                (("queue", "subscriptions"),): len(client.pending_subscriptions)})
+        for name, description, function in self.extra_gauges:
+            metric(name, "gauge", description,
+                   {tuple(labels): value for labels, value in function().items()})
+
+        round_trips = np.array(list(pipeline.round_trips))
+        quantiles = dict()
+        if len(round_trips):
+            for q in [0.5, 0.9, 0.99]:
+                quantiles[(("quantile", q),)] = np.quantile(round_trips, q)
+        metric("deribit_order_round_trip_seconds", "summary",
+               "Order request to its reply (quantiles over the last {} requests).".format(
+                   pipeline.round_trips.maxlen), quantiles)
+        lines.append("deribit_order_round_trip_seconds_count {}".format(pipeline.round_trip_count))
+        lines.append("deribit_order_round_trip_seconds_sum {}".format(pipeline.round_trip_sum))
+
+        hedgers = list(self.delta_hedgers.items())
+        metric("deribit_hedger_decisions_total", "counter",
+               "Delta checks of the active hedgers, by currency and outcome.",
+               {(("currency", currency), ("decision", decision)): count
+                for currency, hedger in hedgers for decision, count in list(hedger.decisions.items())})
+        metric("deribit_hedger_active", "gauge", "1 while delta hedging is activated, by currency.",
+               {(("currency", currency),): int(hedger.delta_hedging_activated)
+                for currency, hedger in hedgers})
+
+        durations = dict()
+        snapshots = {currency: save_bbo.durations()
+                     for currency, save_bbo in list(self.snapshots.items())}
+        snapshots.update(self.snapshot_durations)
+        for currency, stages in list(snapshots.items()):
+            for stage, seconds in stages.items():
+                durations[(("currency", currency), ("stage", stage))] = seconds
+        if durations:
+            metric("deribit_snapshot_duration_seconds", "gauge",
+                   "Duration of the last minutely snapshot, by currency and stage.", durations)
+
+        rows = profiling.timing_stats()
+        if rows:
+            metric("deribit_timed_calls_total", "counter", "Calls of the timed paths (CLI stats).",
+                   {(("path", row[0]),): row[1] for row in rows})
+            metric("deribit_timed_seconds_total", "counter", "Time in the timed paths.",
+                   {(("path", row[0]),): row[2] for row in rows})
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,734 @@
+"""
+Local stand-in for the Deribit websocket API, for load tests without the
+exchange. It speaks the JSON-RPC subset WSClient uses (auth, instruments,
+subscriptions, orders, cancels, positions, open orders) on top of a
+SyntheticDeribit market, streams book, ticker, futures and portfolio traffic
+at a set rate and fills market orders. Faults can be injected: dropped
+frames, change id gaps in the book streams and periodic disconnects.
+
+    python mock_deribit.py serve [--port 8765] [--rate 2000] [--options 800]
+                                 [--drop 0.001] [--gap 0.001] [--disconnect 60]
+
+serves until interrupted; point the bot at it with url = ws://127.0.0.1:8765
+in the [API] section of settings.txt.
+
+    python mock_deribit.py ramp [--rates 1000,2000,5000,10000,20000] [--step 10]
+
+runs the server in a separate process, connects the bot's WSClient (with
+its feed and hedger, no database) and raises the rate step by step. Per
+step it reports the rate sent, the feed lag (exchange timestamp of the
+futures quotes to their processing) and reconnects, and stops at the rate
+where the client falls behind. Needs the websocket-client package.
+
+The websocket protocol (RFC 6455) is implemented here on plain sockets,
+text frames only, so the server has no dependencies of its own.
+"""
+
+from bisect import bisect
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+from synthetic_feed import SyntheticDeribit, subscription
+
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# subscription traffic of the server (account trades only come from fills)
+STREAM_MIX = {"book_change": 0.82, "futures_bbo": 0.08, "ticker": 0.075, "tape": 0.02,
+              "portfolio": 0.005}
+
+class RPCError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+
+class Connection:
+
+    """ One client: websocket framing, its subscriptions and its stream thread """
+
+    def __init__(self, mock, sock, address):
+        self.mock = mock
+        self.sock = sock
+        self.address = address
+        self.send_lock = threading.Lock()
+        self.channels = set()
+        self.authenticated = False
+        self.open = True
+        self.opened = time.time()
+
+
+    def run(self):
+        try:
+            self.handshake()
+        except (OSError, ValueError) as e:
+            self.mock.logger.info("Handshake with {} failed: {}".format(self.address, e))
+            self.sock.close()
+            return
+        self.mock.logger.info("Client {} connected.".format(self.address))
+        streamer = threading.Thread(target=self.stream, daemon=True)
+        streamer.start()
+        try:
+            while self.open:
+                message = self.receive()
+                if message is None:
+                    break
+                self.mock.handle(self, message)
+        except OSError:
+            pass
+        finally:
+            self.close()
+            self.mock.logger.info("Client {} disconnected.".format(self.address))
+
+
+    def handshake(self):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ValueError("connection closed during handshake")
+            request += chunk
+        headers = dict()
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if "sec-websocket-key" not in headers:
+            raise ValueError("not a websocket request")
+        accept = base64.b64encode(hashlib.sha1(
+            (headers["sec-websocket-key"] + GUID).encode()).digest()).decode()
+        self.sock.sendall("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                          "Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n".format(
+                              accept).encode())
+
+
+    def receive_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise OSError("connection closed")
+            data += chunk
+        return data
+
+
+    def receive(self):
+        """ Next text message from the client, None once it closed; answers pings """
+        fragments = []
+        while True:
+            first, second = self.receive_exactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self.receive_exactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.receive_exactly(8))[0]
+            mask = self.receive_exactly(4) if second & 0x80 else None
+            payload = self.receive_exactly(length)
+            if mask is not None and length:
+                key = int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+                payload = (int.from_bytes(payload, "big") ^ key).to_bytes(length, "big")
+
+            if opcode == 0x8: # close
+                self.send_frame(0x8, payload[:2])
+                return None
+            elif opcode == 0x9: # ping
+                self.send_frame(0xA, payload)
+            elif opcode in (0x0, 0x1, 0x2):
+                fragments.append(payload)
+                if first & 0x80: # final fragment
+                    return b"".join(fragments).decode("utf-8")
+
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self.send_lock:
+            self.sock.sendall(header + payload)
+
+
+    def send(self, message):
+        if not self.open:
+            return False
+        try:
+            self.send_frame(0x1, json.dumps(message).encode())
+            return True
+        except OSError:
+            self.close()
+            return False
+
+
+    def close(self):
+        if not self.open:
+            return
+        self.open = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.mock.remove(self)
+
+
+    def stream(self):
+
+        """
+        Sends subscription traffic at the mock's rate (read on every round,
+        it can be changed while running). Frames that are due but could not
+        be sent within a second (client or server too slow) are skipped and
+        counted as backlog.
+        """
+
+        interval = 0.002
+        rate = self.mock.rate
+        start = time.perf_counter()
+        sent = 0
+        while self.open and not self.mock.shutdown:
+            if self.mock.disconnect and time.time() - self.opened > self.mock.disconnect:
+                self.mock.disconnects += 1
+                self.mock.logger.info("Fault: disconnecting {}.".format(self.address))
+                self.close()
+                return
+            if self.mock.rate != rate:
+                rate = self.mock.rate
+                start = time.perf_counter()
+                sent = 0
+            due = int((time.perf_counter() - start) * rate) - sent
+            if due <= 0:
+                time.sleep(interval)
+                continue
+            if due > rate: # more than a second behind
+                self.mock.backlog += due
+                sent += due
+                continue
+            for _ in range(due):
+                frame = self.mock.next_frame(self)
+                if frame is not None and not self.send(frame):
+                    return
+            sent += due
+
+
+
+class MockDeribit:
+
+    """
+    The server: accepts websocket clients, answers their requests from one
+    SyntheticDeribit market (shared by all connections, so several
+    connections see the same account) and publishes to every connection
+    subscribed to a channel. rate is frames per second per connection.
+    drop and gap are probabilities per frame, disconnect closes each
+    connection after that many seconds.
+    """
+
+    def __init__(self, market=None, host="127.0.0.1", port=8765, rate=1000,
+                 drop=0, gap=0, disconnect=0, mix=None, seed=0):
+        self.logger = logging.getLogger("deribit")
+        self.market = market if market is not None else SyntheticDeribit(seed=seed)
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.drop = drop
+        self.gap = gap
+        self.disconnect = disconnect
+        self.shutdown = False
+
+        mix = mix or STREAM_MIX
+        self.kinds = list(mix)
+        total = float(sum(mix.values()))
+        self.cumulative = []
+        for kind in self.kinds:
+            self.cumulative.append((self.cumulative[-1] if self.cumulative else 0) + mix[kind] / total)
+
+        self.lock = threading.Lock() # market state, shared by the connection threads
+        self.connections_lock = threading.Lock()
+        self.connections = []
+        self.open_orders = dict() # order id -> order
+        self.token_counter = 0
+
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.gaps = 0
+        self.disconnects = 0
+        self.backlog = 0
+        self.requests = dict() # method -> count
+
+
+    def serve_forever(self, ready=None):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.port = self.server_socket.getsockname()[1] # port 0 = any free one
+        self.server_socket.listen(8)
+        self.server_socket.settimeout(0.5)
+        self.logger.info("Mock Deribit on ws://{}:{} ({} options, {} msg/s).".format(
+            self.host, self.port, len(self.market.options), self.rate))
+        if ready is not None:
+            ready.set()
+        while not self.shutdown:
+            try:
+                sock, address = self.server_socket.accept()
+            except socket.timeout:
+                continue
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock, address)
+            with self.connections_lock:
+                self.connections.append(connection)
+            threading.Thread(target=connection.run, daemon=True).start()
+        self.server_socket.close()
+        for connection in list(self.connections):
+            connection.close()
+
+
+    def remove(self, connection):
+        with self.connections_lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+
+    def publish(self, channel, data):
+        """ Sends a subscription message to every connection subscribed to the channel """
+        for connection in list(self.connections):
+            if channel in connection.channels:
+                connection.send(subscription(channel, data))
+
+
+    # stream
+
+    def next_frame(self, connection):
+        """
+        The next subscription frame for a connection, None if dropped, not
+        subscribed or already sent (book changes)
+        """
+        market = self.market
+        with self.lock:
+            kind = self.kinds[min(bisect(self.cumulative, market.rng.random()), len(self.kinds) - 1)]
+            if kind == "book_change":
+                name = market.rng.choice(market.options)
+                if self.gap and market.rng.random() < self.gap:
+                    market.change_ids[name] += 1 # prev_change_id will not match the last one
+                    self.gaps += 1
+                frame = market.book_change(name)
+            elif kind == "futures_bbo":
+                frame = market.futures_bbo()
+            elif kind == "ticker":
+                frame = market.ticker()
+            elif kind == "tape":
+                frame = market.public_trades()
+            else:
+                frame = market.portfolio()
+            if kind == "book_change":
+                # the books are shared, so a change goes to every connection subscribed
+                # to it, sent under the lock to keep the changes in order
+                for receiver in list(self.connections):
+                    if frame["params"]["channel"] not in receiver.channels:
+                        continue
+                    if self.drop and market.rng.random() < self.drop:
+                        self.dropped += 1
+                    elif receiver.send(frame):
+                        self.sent += 1
+                return None
+            if frame["params"]["channel"] not in connection.channels:
+                return None
+            if self.drop and market.rng.random() < self.drop:
+                self.dropped += 1
+                return None
+            self.sent += 1
+        return frame
+
+
+    # requests
+
+    def handle(self, connection, message):
+        try:
+            request = json.loads(message)
+        except ValueError:
+            connection.send({"jsonrpc": "2.0", "error": {"code": -32700, "message": "Parse error"}})
+            return
+        method = request.get("method", "")
+        params = request.get("params") or {}
+        self.requests[method] = self.requests.get(method, 0) + 1
+        reply = {"jsonrpc": "2.0", "id": request.get("id"), "usIn": int(time.time() * 1e6)}
+        notifications = []
+        try:
+            if method.startswith("private/") and not connection.authenticated:
+                raise RPCError(13009, "unauthorized")
+            handler = None
+            if method.startswith(("public/", "private/")):
+                handler = getattr(self, method.replace("/", "_"), None)
+            if handler is None:
+                raise RPCError(-32601, "Method not found")
+            with self.lock:
+                reply["result"] = handler(connection, params, notifications)
+        except RPCError as e:
+            reply["error"] = {"code": e.code, "message": e.message}
+        except (KeyError, TypeError, ValueError) as e:
+            reply["error"] = {"code": -32602, "message": "Invalid params", "data": str(e)}
+        reply["usOut"] = int(time.time() * 1e6)
+        reply["usDiff"] = reply["usOut"] - reply["usIn"]
+        connection.send(reply)
+        for channel, data in notifications:
+            self.publish(channel, data)
+        if method.endswith("/subscribe") and "result" in reply:
+            self.add_channels(connection, reply["result"])
+
+
+    def add_channels(self, connection, channels):
+
+        """
+        Subscribes the connection, a book channel starts with a snapshot (a
+        quote for futures), a ticker channel with a ticker. The channel is
+        added under the market lock right after that is sent, so no change
+        can precede it.
+        """
+
+        for channel in channels:
+            name = channel.split(".")[1] if channel.count(".") >= 2 else None
+            with self.lock:
+                if channel.startswith("ticker.") and name in self.market.books:
+                    connection.send(self.market.ticker(name))
+                elif channel.startswith("book.") and channel.endswith(".raw") and name in self.market.books:
+                    connection.send(self.market.book_snapshot(name))
+                elif channel.endswith(".none.1.100ms") and name in self.market.futures_quotes:
+                    connection.send(self.market.futures_bbo(name))
+                connection.channels.add(channel)
+
+
+    def public_auth(self, connection, params, notifications):
+        if params.get("grant_type") not in ("client_signature", "client_credentials"):
+            raise RPCError(13004, "invalid_credentials")
+        connection.authenticated = True
+        self.token_counter += 1
+        return {"access_token": "mock-access-{}".format(self.token_counter),
+                "refresh_token": "mock-refresh-{}".format(self.token_counter),
+                "token_type": "bearer", "expires_in": 31536000, "scope": "connection mainaccount"}
+
+
+    def public_get_instruments(self, connection, params, notifications):
+        if params.get("currency", self.market.currency) not in (self.market.currency, "any"):
+            return []
+        kind = params.get("kind")
+        return [instrument for instrument in self.market.instruments()
+                if kind is None or instrument["kind"] == kind]
+
+
+    # subscriptions are added once the reply is sent, see add_channels
+
+    def public_subscribe(self, connection, params, notifications):
+        return [channel for channel in params["channels"] if not channel.startswith("user.")]
+
+
+    def private_subscribe(self, connection, params, notifications):
+        return list(params["channels"])
+
+
+    def public_unsubscribe(self, connection, params, notifications):
+        connection.channels.difference_update(params["channels"])
+        return list(params["channels"])
+
+    private_unsubscribe = public_unsubscribe
+
+
+    def public_test(self, connection, params, notifications):
+        return {"version": "mock"}
+
+
+    def public_get_time(self, connection, params, notifications):
+        return self.market.timestamp()
+
+
+    def private_buy(self, connection, params, notifications):
+        return self.place_order("buy", params, notifications)
+
+
+    def private_sell(self, connection, params, notifications):
+        return self.place_order("sell", params, notifications)
+
+
+    def place_order(self, direction, params, notifications):
+
+        """
+        Market orders fill completely at the best opposite price, limit
+        orders rest (no matching against the synthetic books) and orders
+        with a trigger wait untriggered.
+        """
+
+        market = self.market
+        name = params["instrument_name"]
+        if name not in market.books and name not in market.futures_quotes:
+            raise RPCError(10028, "instrument_not_found")
+        amount = float(params["amount"])
+        if amount <= 0:
+            raise RPCError(-32602, "Invalid params")
+        order_type = params.get("type", "limit")
+        label = params.get("label", "")
+
+        if order_type == "market":
+            price = self.fill_price(name, direction)
+            order = market.order(name, direction, amount, price, label, order_type,
+                                 state="filled", filled=amount)
+            trade = market.trades(name, direction, amount, price)["params"]["data"]
+            trade[0]["label"] = label
+            trade[0]["order_id"] = order["order_id"]
+            self.fill_position(name, direction, amount, price)
+            notifications.append(("user.orders.any.any.raw", order))
+            notifications.append(("user.trades.any.any.raw", trade))
+            tape = market.public_trades(name, direction, amount, price)["params"]
+            notifications.append((tape["channel"], tape["data"]))
+            return {"order": order, "trades": trade}
+
+        price = params.get("price")
+        if price is None and "trigger" not in params:
+            raise RPCError(-32602, "Invalid params")
+        state = "untriggered" if "trigger" in params else "open"
+        order = market.order(name, direction, amount, price or params.get("trigger_price"),
+                             label, order_type, state=state)
+        if "trigger_price" in params:
+            order["trigger_price"] = params["trigger_price"]
+            order["trigger"] = params.get("trigger")
+        self.open_orders[order["order_id"]] = order
+        notifications.append(("user.orders.any.any.raw", order))
+        return {"order": order, "trades": []}
+
+
+    def fill_price(self, name, direction):
+        if name in self.market.futures_quotes:
+            return self.market.futures_quotes[name] + (0.5 if direction == "buy" else -0.5)
+        book = self.market.books[name]
+        if direction == "buy" and book["asks"]:
+            return min(book["asks"])
+        if direction == "sell" and book["bids"]:
+            return max(book["bids"])
+        return round(self.market.theoretical(name), 4)
+
+
+    def fill_position(self, name, direction, amount, price):
+        positions = self.market.positions
+        size = positions[name]["size"] if name in positions else 0
+        size += amount if direction == "buy" else -amount
+        if size == 0:
+            positions.pop(name, None)
+            return
+        average = positions[name]["average_price"] if name in positions else price
+        self.market.open_position(name, size)["average_price"] = average
+
+
+    def cancel_orders(self, orders, notifications):
+        for order in orders:
+            del self.open_orders[order["order_id"]]
+            order["order_state"] = "cancelled"
+            order["last_update_timestamp"] = self.market.timestamp()
+            notifications.append(("user.orders.any.any.raw", order))
+        return len(orders)
+
+
+    def private_cancel(self, connection, params, notifications):
+        order = self.open_orders.get(params["order_id"])
+        if order is None:
+            raise RPCError(11044, "not_open_order")
+        self.cancel_orders([order], notifications)
+        return order
+
+
+    def private_cancel_all(self, connection, params, notifications):
+        return self.cancel_orders(list(self.open_orders.values()), notifications)
+
+
+    def private_cancel_all_by_currency(self, connection, params, notifications):
+        return self.cancel_orders([order for order in self.open_orders.values()
+                                   if order["instrument_name"].startswith(params["currency"])],
+                                  notifications)
+
+
+    def private_cancel_all_by_instrument(self, connection, params, notifications):
+        return self.cancel_orders([order for order in self.open_orders.values()
+                                   if order["instrument_name"] == params["instrument_name"]],
+                                  notifications)
+
+
+    def private_cancel_by_label(self, connection, params, notifications):
+        return self.cancel_orders([order for order in self.open_orders.values()
+                                   if order["label"] == params["label"]], notifications)
+
+
+    def kind(self, name):
+        return "option" if name in self.market.option_params else "future"
+
+
+    def private_get_positions(self, connection, params, notifications):
+        return [position for name, position in self.market.positions.items()
+                if params.get("kind") in (None, "any", self.kind(name))]
+
+
+    def private_get_position(self, connection, params, notifications):
+        name = params["instrument_name"]
+        if name in self.market.positions:
+            return self.market.positions[name]
+        if name not in self.market.books and name not in self.market.futures_quotes:
+            raise RPCError(10028, "instrument_not_found")
+        return {"instrument_name": name, "size": 0, "direction": "zero", "average_price": 0,
+                "mark_price": 0, "delta": 0, "total_profit_loss": 0.0, "kind": self.kind(name)}
+
+
+    def private_get_open_orders_by_currency(self, connection, params, notifications):
+        return [order for order in self.open_orders.values()
+                if params.get("kind") in (None, "any", self.kind(order["instrument_name"]))]
+
+
+    def stats(self):
+        return {"connections": len(self.connections), "sent": self.sent,
+                "dropped": self.dropped, "gaps": self.gaps, "disconnects": self.disconnects,
+                "backlog": self.backlog, "requests": dict(self.requests)}
+
+
+
+def serve_process(args, rate, sent, ready):
+    """ Target of the ramp's server process, rate and sent are shared values """
+    mock = MockDeribit(SyntheticDeribit(options=args.options, seed=args.seed), port=args.port,
+                       rate=rate.value, drop=args.drop, gap=args.gap, disconnect=args.disconnect)
+
+    def sync():
+        while True:
+            mock.rate = rate.value
+            sent.value = mock.sent
+            time.sleep(0.05)
+
+    threading.Thread(target=sync, daemon=True).start()
+    mock.serve_forever(ready)
+
+
+def ramp(args):
+
+    """
+    Runs the server in its own process (so it does not share the GIL with
+    the client), connects WSClient and raises the rate per step. A step is
+    behind when the server could not send at the rate (the client stopped
+    reading) or the feed lag exceeds max_lag.
+    """
+
+    import multiprocessing
+    import os
+    import tempfile
+    import numpy as np
+    from ws_client import WSClient
+    from data_feed import DataFeed
+    from forward_curve import ForwardCurve
+    from vol_surface import VolSurface
+    from hedger import DeltaHedge
+
+    rates = [float(rate) for rate in args.rates.split(",")]
+    rate = multiprocessing.Value("d", rates[0])
+    sent = multiprocessing.Value("q", 0)
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve_process, args=(args, rate, sent, ready),
+                                     daemon=True)
+    server.start()
+    ready.wait(60)
+
+    feed = DataFeed()
+    forward_curve = ForwardCurve(feed)
+    vol_surface = VolSurface()
+    hedger = DeltaHedge(feed, forward_curve, vol_surface)
+    client = WSClient(feed, hedger, "mock", "mock", "ws://127.0.0.1:{}".format(args.port))
+    # the synthetic instruments must not replace the bot's own instrument cache
+    client.instrument_cache_file = os.path.join(tempfile.mkdtemp(), "instrument_cache.json")
+    client.cached_instruments = None
+    client.create_ws_connection()
+    print("Connected, bootstrap: {}".format(", ".join(
+        "{} {:.0f}ms".format(step, seconds * 1000) for step, seconds in
+        sorted(client.bootstrap_times.items(), key=lambda t: t[1]))))
+
+    print("\n{:>10} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+        "target/s", "sent/s", "lag p50ms", "lag p99ms", "lag max", "errors"))
+    results = []
+    for target in rates:
+        rate.value = target
+        time.sleep(1) # settle at the new rate
+        errors = client.error_counter
+        first_sent, start = sent.value, time.time()
+        lags = []
+        while time.time() - start < args.step:
+            lag = feed.feed_lag()
+            if lag is not None and lag[0] is not None:
+                lags.append(lag[0] + lag[1]) # the age counts while nothing arrives
+            time.sleep(0.02)
+        achieved = (sent.value - first_sent) / (time.time() - start)
+        lags = np.array(lags) * 1000 if lags else np.array([np.nan])
+        result = {"target": target, "sent": achieved, "p50": np.percentile(lags, 50),
+                  "p99": np.percentile(lags, 99), "max": lags.max(),
+                  "errors": client.error_counter - errors}
+        results.append(result)
+        print("{target:>10.0f} {sent:>10.0f} {p50:>10.1f} {p99:>10.1f} {max:>10.1f} "
+              "{errors:>8}".format(**result))
+        if result["p99"] > args.max_lag * 1000:
+            print("\nThe client falls behind at about {:.0f} messages per second "
+                  "(last rate kept up with: {}).".format(
+                      target, "{:.0f}".format(results[-2]["target"]) if len(results) > 1 else "none"))
+            break
+        if achieved < 0.95 * target:
+            # the lag is fine, so the sending side is the limit, not the client
+            print("\nThe server sends at most about {:.0f} messages per second here, the "
+                  "client kept up with that.".format(achieved))
+            break
+    else:
+        print("\nThe client kept up with all rates.")
+
+    client.shutdown()
+    server.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["serve", "ramp"])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--options", type=int, default=800)
+    parser.add_argument("--rate", type=float, default=1000, help="frames per second (serve)")
+    parser.add_argument("--rates", default="1000,2000,5000,10000,20000,50000",
+                        help="frames per second per step (ramp)")
+    parser.add_argument("--step", type=float, default=10, help="seconds per step (ramp)")
+    parser.add_argument("--max-lag", type=float, default=0.25,
+                        help="feed lag in seconds at which a step counts as behind (ramp)")
+    parser.add_argument("--drop", type=float, default=0, help="probability to drop a frame")
+    parser.add_argument("--gap", type=float, default=0, help="probability of a change id gap")
+    parser.add_argument("--disconnect", type=float, default=0,
+                        help="seconds after which connections are closed, 0 = never")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    if args.mode == "ramp":
+        ramp(args)
+        return
+
+    mock = MockDeribit(SyntheticDeribit(options=args.options, seed=args.seed), port=args.port,
+                       rate=args.rate, drop=args.drop, gap=args.gap, disconnect=args.disconnect)
+    thread = threading.Thread(target=mock.serve_forever, daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            time.sleep(10)
+            mock.logger.info("Mock stats: {}".format(mock.stats()))
+    except KeyboardInterrupt:
+        mock.shutdown = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
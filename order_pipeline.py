@@ -0,0 +1,201 @@
+from collections import deque
+import threading
+import time
+import logging
+
+
+class TokenBucket:
+
+    """
+    Deribit limits matching engine requests (buy, sell, edit, cancel) per
+    account with a credit pool: every request costs credits, the pool refills
+    at a constant rate and is capped, which allows short bursts on top of the
+    sustained rate. Expressed in requests, the bucket holds up to 'burst'
+    tokens and refills 'rate' tokens per second. acquire() only waits as long
+    as it takes until the next token is there, so a batch within the burst
+    size goes out at once.
+    """
+
+    def __init__(self, rate=5, burst=20):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def try_acquire(self, cost=1):
+        """ Takes the tokens if available, otherwise returns the seconds until they are """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= cost:
+                self.tokens -= cost
+                return 0
+            return (cost - self.tokens) / self.rate
+
+
+    def acquire(self, cost=1):
+        while True:
+            wait = self.try_acquire(cost)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+
+class OrderPipeline:
+
+    """
+    Sends multi-order commands (ladders, cancel lists) as one batch, paced
+    only by the token bucket instead of a fixed pause between requests.
+    Every leg is registered under its call id before it is sent; the client
+    hands each reply to acknowledge(), and once all legs of a batch are
+    answered (or the batch timed out) a summary is logged, naming each
+    failed leg with the exchange's error message.
+    """
+
+    def __init__(self, client, rate=5, burst=20, timeout=30):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout # seconds until unanswered legs count as failed
+        self.logger = logging.getLogger("deribit")
+
+        self.lock = threading.Lock()
+        self.batch_counter = 0
+        self.batches = dict() # batch id -> state, see submit
+        self.pending = dict() # call id -> (batch id, leg index)
+        self.sent_at = dict() # call id -> time.perf_counter() when sent
+        self.last_report = None
+        self.last_serialize_time = 0 # seconds per order of the last batch from templates
+        
+        # request to reply, in seconds (read by metrics)
+        self.round_trips = deque(maxlen=1000)
+        self.round_trip_count = 0
+        self.round_trip_sum = 0.
+
+
+    def submit(self, requests):
+
+        """
+        Sends a list of [params, call_type] requests as returned by ApiMethods,
+        returns the batch id (None if nothing was sent). Requests made from an
+        OrderTemplate carry it as a third element and are sent pre-serialized.
+        """
+
+        legs = [request for request in requests
+                if (request[0] and request[1]) or request[1] == "private/cancel_all"]
+        if not legs:
+            return None
+        self.expire()
+
+        with self.lock:
+            batch_id = self.batch_counter
+            self.batch_counter += 1
+            self.batches[batch_id] = {"legs": legs,
+                                      "open": len(legs),
+                                      "failed": [],
+                                      "started": time.time()}
+
+        serialize_time = 0
+        for leg, request in enumerate(legs):
+            params, call_type = request[0], request[1]
+            self.bucket.acquire()
+            call_id = self.client.new_call_id()
+            with self.lock:
+                self.pending[call_id] = (batch_id, leg)
+                self.sent_at[call_id] = time.perf_counter()
+            try:
+                if len(request) > 2:
+                    start = time.perf_counter()
+                    frame = request[2].serialize(call_id, params)
+                    serialize_time += time.perf_counter() - start
+                    self.client.send_frame(frame, call_type, call_id)
+                else:
+                    self.client.send_to_ws(params, call_type, call_id)
+            except Exception as e:
+                with self.lock: # not sent, so no round trip
+                    self.sent_at.pop(call_id, None)
+                self.resolve(call_id, "not sent: {}".format(e))
+        if len(legs[0]) > 2:
+            self.last_serialize_time = serialize_time / len(legs)
+        return batch_id
+
+
+    def acknowledge(self, reply):
+        """ Called with every reply carrying an id, True if it belonged to a batch """
+        error = None
+        if "error" in reply:
+            error = reply["error"].get("message", str(reply["error"]))
+            if "data" in reply["error"]:
+                error = "{} ({})".format(error, reply["error"]["data"])
+        return self.resolve(reply["id"], error)
+
+
+    def resolve(self, call_id, error=None):
+        with self.lock:
+            key = self.pending.pop(call_id, None)
+            if key is None:
+                return False
+            sent = self.sent_at.pop(call_id, None)
+            if sent is not None: # rejections are round trips too
+                round_trip = time.perf_counter() - sent
+                self.round_trips.append(round_trip)
+                self.round_trip_count += 1
+                self.round_trip_sum += round_trip
+            batch_id, leg = key
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return True
+            batch["open"] -= 1
+            if error is not None:
+                batch["failed"].append((leg, error))
+            if batch["open"] > 0:
+                return True
+            del self.batches[batch_id]
+
+        self.report(batch_id, batch)
+        return True
+
+
+    def expire(self):
+        """ Closes batches whose remaining legs got no reply within the timeout """
+        now = time.time()
+        with self.lock:
+            expired = [(batch_id, batch) for batch_id, batch in self.batches.items()
+                       if now - batch["started"] > self.timeout]
+            for batch_id, batch in expired:
+                for call_id, (pending_batch, leg) in list(self.pending.items()):
+                    if pending_batch == batch_id:
+                        del self.pending[call_id]
+                        self.sent_at.pop(call_id, None)
+                        batch["failed"].append((leg, "no reply"))
+                del self.batches[batch_id]
+        for batch_id, batch in expired:
+            self.report(batch_id, batch)
+
+
+    def report(self, batch_id, batch):
+        total = len(batch["legs"])
+        elapsed = (time.time() - batch["started"]) * 1000
+        self.last_report = {"batch": batch_id,
+                            "legs": total,
+                            "failed": sorted(batch["failed"]),
+                            "ms": elapsed}
+        if total == 1 and not batch["failed"]:
+            return
+        self.logger.info("Batch {}: {}/{} requests accepted in {:.0f}ms.".format(
+            batch_id, total - len(batch["failed"]), total, elapsed))
+        for leg, error in sorted(batch["failed"]):
+            params, call_type = batch["legs"][leg][:2]
+            # every rejected leg is listed, past the per line rate limit
+            self.logger.info("Batch {} leg {} failed: {} {} - {}".format(
+                batch_id, leg + 1, call_type, describe(params), error), extra={"unlimited": True})
+
+
+
+def describe(params):
+    """ Short form of an order request for log lines """
+    fields = ["instrument_name", "amount", "price", "type", "label"]
+    return " ".join(str(params[field]) for field in fields if field in params)
@@ -0,0 +1,240 @@
+"""
+Timing counters for the hot paths and an on-demand sampling profiler.
+
+Methods are marked with @timed in their class. While timings are disabled
+(the default) the mark is gone once the class is created and the method is
+the plain function, so it costs nothing. enable_timings() swaps a timing
+wrapper into the class for every marked method, disable_timings() swaps the
+plain functions back. Blocks inside a method are timed with
+
+    with measure("SaveBBO.derbbo write"):
+        ...
+
+which is a shared no-op context while disabled. Each name counts calls,
+total and maximum seconds, see timing_stats().
+"""
+
+from collections import Counter
+from datetime import datetime
+import functools
+import logging
+import sys
+import threading
+import time
+
+
+_records = dict() # name -> [calls, total seconds, max seconds]
+_marked = [] # (class, attribute, function, name) of all @timed methods
+_enabled = False
+
+
+class timed:
+
+    """ Marks a method for timing, recorded as 'Class.method' """
+
+    def __init__(self, function):
+        self.function = function
+
+
+    def __set_name__(self, owner, attribute):
+        name = "{}.{}".format(owner.__name__, attribute)
+        _marked.append((owner, attribute, self.function, name))
+        setattr(owner, attribute, timing_wrapper(self.function, name) if _enabled
+                else self.function)
+
+
+
+def timing_wrapper(function, name):
+    record = _records.setdefault(name, [0, 0., 0.])
+    clock = time.perf_counter
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = clock() - start
+            record[0] += 1
+            record[1] += elapsed
+            if elapsed > record[2]:
+                record[2] = elapsed
+    return wrapper
+
+
+
+class _Measure:
+
+    __slots__ = ["record", "start"]
+
+    def __init__(self, record):
+        self.record = record
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        record = self.record
+        record[0] += 1
+        record[1] += elapsed
+        if elapsed > record[2]:
+            record[2] = elapsed
+
+
+
+class _NoMeasure:
+
+    def __enter__(self):
+        pass
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_measure = _NoMeasure()
+
+
+def measure(name):
+    if not _enabled:
+        return _no_measure
+    return _Measure(_records.setdefault(name, [0, 0., 0.]))
+
+
+def enable_timings():
+    global _enabled
+    _enabled = True
+    for owner, attribute, function, name in _marked:
+        setattr(owner, attribute, timing_wrapper(function, name))
+
+
+def disable_timings():
+    global _enabled
+    _enabled = False
+    for owner, attribute, function, name in _marked:
+        setattr(owner, attribute, function)
+
+
+def timings_enabled():
+    return _enabled
+
+
+def reset_timings():
+    for record in _records.values():
+        record[0], record[1], record[2] = 0, 0., 0.
+
+
+def timing_stats():
+    """ [name, calls, total s, mean us, max ms] per name with calls, by total time """
+    rows = []
+    for name, (calls, total, longest) in list(_records.items()):
+        if calls:
+            rows.append([name, calls, round(total, 3), round(total / calls * 1e6, 1),
+                         round(longest * 1000, 2)])
+    return sorted(rows, key=lambda row: row[2], reverse=True)
+
+
+
+class TimingLog:
+
+    """ Logs the busiest timed paths every interval seconds (thread target) """
+
+    def __init__(self, interval=60, top=8):
+        self.interval = interval
+        self.top = top
+        self.logger = logging.getLogger("deribit")
+        self.shutdown = False
+
+
+    def run(self):
+        last = time.time()
+        while not self.shutdown:
+            time.sleep(0.5)
+            if time.time() - last < self.interval or not _enabled:
+                continue
+            last = time.time()
+            rows = timing_stats()[:self.top]
+            if rows:
+                self.logger.info("Timings: {}".format(", ".join(
+                    "{} {}x {:.0f}us max {:.1f}ms".format(name, calls, mean, longest)
+                    for name, calls, total, mean, longest in rows)))
+
+
+
+class SamplingProfiler:
+
+    """
+    Samples the stacks of all threads of the running process (every
+    interval seconds for duration seconds, on its own thread) and writes
+    where they were: functions by own samples (top of the stack) and by
+    cumulative samples (anywhere on the stack), and the collapsed stacks
+    (one 'thread;outer;...;inner count' line each, the input format of
+    flame graph tools). Idle threads blocked in waits show up as such.
+    """
+
+    def __init__(self, duration=10, interval=0.005, path=None, top=25):
+        self.duration = duration
+        self.interval = interval
+        self.path = path or "profile-{}.txt".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+        self.top = top
+        self.logger = logging.getLogger("deribit")
+        self.samples = 0
+        self.stacks = Counter()
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampling profiler", daemon=True)
+        self.thread.start()
+        return self.thread
+
+
+    def run(self):
+        own = threading.get_ident()
+        names = dict()
+        deadline = time.perf_counter() + self.duration
+        while time.perf_counter() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(code.co_name, code.co_filename.split("/")[-1],
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.write()
+
+
+    def write(self):
+        own = Counter()
+        cumulative = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack[1:]):
+                cumulative[function] += count
+
+        lines = ["Sampling profile: {} samples every {}ms over {}s, all threads".format(
+            self.samples, self.interval * 1000, self.duration), "", "Own samples:"]
+        lines += ["{:>8} {:>6.1f}%  {}".format(count, 100. * count / max(self.samples, 1), function)
+                  for function, count in own.most_common(self.top)]
+        lines += ["", "Cumulative samples:"]
+        lines += ["{:>8} {:>6.1f}%  {}".format(count, 100. * count / max(self.samples, 1), function)
+                  for function, count in cumulative.most_common(self.top)]
+        lines += ["", "Collapsed stacks:"]
+        lines += ["{} {}".format(";".join(stack), count) for stack, count in self.stacks.most_common()]
+        with open(self.path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        self.logger.info("Sampling profile written to {}, busiest: {}".format(self.path, ", ".join(
+            "{} {:.0f}%".format(function, 100. * count / max(self.samples, 1))
+            for function, count in own.most_common(3))))
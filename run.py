@@ -1,29 +1,51 @@
+import time
+started = time.perf_counter()
+
+import argparse
 import logging
 import logging.config
-from bot_start import Bot
+from startup_profile import StartupProfile
+from async_logging import setup_async_logging
+import database
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile-startup", action="store_true", 
+                        help="print import and init times once the first quote arrived")
+    args = parser.parse_args()
+    
     logger = setup_custom_logger()
-    bot = Bot()
+    profile = StartupProfile(started, trace_imports=args.profile_startup)
+    with profile.step("import bot"):
+        from bot_start import Bot
+    with profile.step("bot init"):
+        bot = Bot(profile)
     bot.run()
     
     
 def setup_custom_logger():
-    formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
-
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    fileHandler = logging.FileHandler("deribit.log", mode="w")
-    fileHandler.setFormatter(formatter)
+    
+    """ 
+    Terminal and deribit.log, written by a background thread (see 
+    async_logging.py), with the limits of the optional [Logging] section.
+    """
+    
+    config = database.read_settings("settings.txt")
+    options = {"json_file": True, "burst": 10, "period": 10, "sample": 0, "queue_size": 10000}
+    if config.has_section("Logging"):
+        options["json_file"] = config.getboolean("Logging", "json_file", fallback=True)
+        options["burst"] = config.getint("Logging", "burst", fallback=10)
+        options["period"] = config.getfloat("Logging", "period", fallback=10)
+        options["sample"] = config.getint("Logging", "sample", fallback=0)
+        options["queue_size"] = config.getint("Logging", "queue_size", fallback=10000)
     
     logger = logging.getLogger("deribit")
     logger.setLevel(logging.INFO)
     if not logger.handlers:
-        logger.addHandler(handler)
-        logger.addHandler(fileHandler)
+        setup_async_logging(logger, "deribit.log", **options)
     return logger
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
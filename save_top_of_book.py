@@ -3,14 +3,26 @@ from datetime import datetime, timedelta
 import pytz
 import numpy as np
 import time
-from py_vollib_vectorized import vectorized_implied_volatility as viv
+from implied_volatility import implied_volatility, call_flags
 from volatility_index import BVIX
+from analytics_pool import AnalyticsPool
+from profiling import timed, measure
 import logging
+import database
 
 class SaveBBO:
     
-    def __init__(self, feed, db_connection):
+    """ 
+    Minutely top of the book snapshots of one currency's options (that of 
+    the forward curve) into obot.derbbo, obot.derbbo_eth etc. 
+    """
+    
+    def __init__(self, feed, db_connection, forward_curve, analytics_workers=0, 
+                 vol_surface=None, analytics_pool=None):
         self.feed = feed
+        self.forward_curve = forward_curve
+        self.currency = forward_curve.currency
+        self.perpetual = forward_curve.perpetual
         self.logger = logging.getLogger("deribit")
         self.counter = 0
         self.c = db_connection["c"]
@@ -19,7 +31,7 @@ class SaveBBO:
         
         self.save_interval = 60
         self.schema = "obot"
-        self.table = "derbbo"
+        self.table = database.currency_table("derbbo", self.currency)
         
         self.prepare_db()
         
@@ -29,24 +41,47 @@ class SaveBBO:
                         "ask", "ask_size", "ask_iv"]
         
         self.took_snapshot = False
+        self.last_durations = dict() # seconds of the last snapshot per stage (read by metrics)
         self.months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", 
                        "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
         
         self.shutdown= False
-        self.bvix = BVIX(db_connection)
+        self.bvix = BVIX(db_connection, vol_surface, self.currency)
+        
+        # with workers, ivs and BVIX slices are computed per expiry in parallel,
+        # a pool passed in is shared with the other currencies and shut down by its owner
+        self.analytics_pool = analytics_pool
+        self.owns_pool = False
+        if analytics_pool is None and analytics_workers > 0:
+            self.owns_pool = True
+            self.analytics_pool = AnalyticsPool(analytics_workers, 
+                                                self.bvix.log_moneyness_intervals)
         
         
     def prepare_db(self):
         self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
         self.conn.commit()
         self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
-                        "timestamp TIMESTAMPTZ, btcusd_price INTEGER, "
+                        "timestamp TIMESTAMPTZ, btcusd_price DOUBLE PRECISION, "
                         "ttmyears NUMERIC, expiration TIMESTAMPTZ, "
                         "strike INTEGER, typ TEXT, oi NUMERIC, bid NUMERIC, "
                         "bid_usd NUMERIC, bid_size NUMERIC, bid_iv NUMERIC, "
                         "ask NUMERIC, ask_usd NUMERIC, ask_size NUMERIC, "
-                        "ask_iv NUMERIC)".format(self.schema, self.table))
+                        "ask_iv NUMERIC, forward NUMERIC)".format(self.schema, self.table))
+        self.conn.commit()
+        # tables created before forwards were stored
+        self.c.execute("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS "
+                       "forward NUMERIC".format(self.schema, self.table))
         self.conn.commit()
+        # tables created while the perpetual mid was stored in whole dollars
+        self.c.execute("SELECT data_type FROM information_schema.columns WHERE table_schema = %s "
+                       "AND table_name = %s AND column_name = 'btcusd_price'", 
+                       (self.schema, self.table))
+        row = self.c.fetchone()
+        if row is not None and row[0] == "integer":
+            self.c.execute("ALTER TABLE {}.{} ALTER COLUMN btcusd_price "
+                           "TYPE DOUBLE PRECISION".format(self.schema, self.table))
+            self.conn.commit()
         
     
     def schedule_snapshot(self):
@@ -66,6 +101,8 @@ class SaveBBO:
                         time.sleep(1.1)
                         
                 elif self.shutdown:
+                    if self.owns_pool:
+                        self.analytics_pool.shutdown()
                     break
                 
                 else:
@@ -75,12 +112,15 @@ class SaveBBO:
             except Exception:
                 pass
     
+    @timed
     def take_snapshot(self, ts):
         
+        start = time.perf_counter()
         self.ob = self.feed.fetch_local_ob().copy()
         self.oi = self.feed.fetch_local_oi().copy()
         ts = ts.replace(microsecond=0)
-        contracts = list(self.ob.keys())
+        prefix = self.currency + "-"
+        contracts = [contract for contract in self.ob.keys() if contract.startswith(prefix)]
         data = []
         
         for i in range(len(contracts)):
@@ -108,8 +148,10 @@ class SaveBBO:
         
         df = pd.DataFrame(data, columns=["timestamp", "contract", "bid", "bid_size", "ask", "ask_size", "oi"])
         self.options_calculations(df)
+        self.last_durations["snapshot"] = time.perf_counter() - start
         
         
+    @timed
     def options_calculations(self, df):
         
         df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
@@ -119,7 +161,7 @@ class SaveBBO:
         strikes = []
         types = []
         for i in contract_list:
-            underlying.append(i[:3])
+            underlying.append(i[:i.find("-")])
             types.append(i[-1])
             first = i.find("-")
             second = i.find("-", first+1)
@@ -148,24 +190,51 @@ class SaveBBO:
         df.drop(["month_string", "year", "month", "day", "expiration_date"], axis=1, inplace=True)
         df["ttmyears"] = (((df["expiration"] - df["timestamp"]).dt.total_seconds()) / (60*60*24*365)).round(6)
         
-        btcusd_price = int((self.feed.fetch_btcusd_bbo("BTC-PERPETUAL", "ask") 
-                            + self.feed.fetch_btcusd_bbo("BTC-PERPETUAL", "bid")) / 2)
+        # the currency's perpetual mid (the column keeps its name from the BTC
+        # table), not rounded as ETH and others trade in fractions of a dollar
+        btcusd_price = (self.feed.fetch_btcusd_bbo(self.perpetual, "ask") 
+                        + self.feed.fetch_btcusd_bbo(self.perpetual, "bid")) / 2
         
         df["btcusd_price"] = btcusd_price
-        df["bid_usd"] = (df["bid"] * df["btcusd_price"]).round(2)
-        df["ask_usd"] = (df["ask"] * df["btcusd_price"]).round(2)
         
-        df["bid_iv"] = viv(df["bid_usd"], df["btcusd_price"], df["strike"], 
-                           df["ttmyears"], 0, df["typ"].str.lower(), 0, 
-                           on_error="ignore", model='black_scholes_merton', 
-                           return_as = 'numpy').round(4)
+        # options are priced against their expiry's forward, not the perpetual
+        epoch = int(df["timestamp"].iloc[0].timestamp() // self.save_interval)
+        with measure("SaveBBO.forward curve"):
+            curve = self.forward_curve.update(epoch, expirations_unformatted, 
+                                              df["strike"].to_numpy(dtype=float), 
+                                              (df["typ"] == "C").to_numpy(), 
+                                              df["bid"].to_numpy(dtype=float), 
+                                              df["ask"].to_numpy(dtype=float), 
+                                              btcusd_price)
+        df["forward"] = [round(curve[code], 2) for code in expirations_unformatted]
+        # coin premiums are worth their price in the expiry's forward
+        df["bid_usd"] = (df["bid"] * df["forward"]).round(2)
+        df["ask_usd"] = (df["ask"] * df["forward"]).round(2)
         
-        df["ask_iv"] = viv(df["ask_usd"], df["btcusd_price"], df["strike"], 
-                           df["ttmyears"], 0, df["typ"].str.lower(), 0, 
-                           on_error="ignore", model='black_scholes_merton', 
-                           return_as = 'numpy').round(4)
+        slices = None
         
-        df = df.astype({"btcusd_price":float, "contract":str, "ttmyears":float, 
+        if self.analytics_pool is not None:
+            with measure("SaveBBO.analytics pool"):
+                bid_iv, ask_iv, slices = self.analytics_pool.process(df)
+            df["bid_iv"] = bid_iv
+            df["ask_iv"] = ask_iv
+        
+        else:
+            forwards = df["forward"].to_numpy(dtype=float)
+            strikes = df["strike"].to_numpy(dtype=float)
+            ttm = df["ttmyears"].to_numpy(dtype=float)
+            is_call = call_flags(df["typ"])
+            
+            with measure("SaveBBO.implied volatility"):
+                df["bid_iv"] = implied_volatility(df["bid_usd"].to_numpy(dtype=float), 
+                                                  forwards, strikes, ttm, 
+                                                  is_call).round(4)
+                
+                df["ask_iv"] = implied_volatility(df["ask_usd"].to_numpy(dtype=float), 
+                                                  forwards, strikes, ttm, 
+                                                  is_call).round(4)
+        
+        df = df.astype({"btcusd_price":float, "forward":float, "contract":str, "ttmyears":float, 
                         "underlying":str, "strike":float, "typ":str, 
                         "bid":float, "bid_usd":float, "bid_size":float, "bid_iv":float, 
                         "ask":float, "ask_usd":float, "ask_size":float, "ask_iv":float})
@@ -177,14 +246,24 @@ class SaveBBO:
         df.drop(["contract", "underlying"], axis=1, inplace=True)
         
         try:
-            df.to_sql("derbbo", con=self.engine, schema="obot", if_exists='append', index=False, chunksize=10000)
+            write_start = time.perf_counter()
+            with measure("SaveBBO.derbbo write"):
+                df.to_sql(self.table, con=self.engine, schema=self.schema, if_exists='append', index=False, chunksize=10000)
+            self.last_durations["derbbo_write"] = time.perf_counter() - write_start
         except Exception as e:
             self.logger.info("Error writing orderbook snapshot to database: {}".format(e))
 
-        self.bvix.create_volsurf_snapshot(df)
+        self.bvix.create_volsurf_snapshot(df, slices)
         self.took_snapshot = True
         
     
+    def durations(self):
+        """ Seconds per stage of the last snapshot, the BVIX build included """
+        durations = dict(self.last_durations)
+        durations.update(self.bvix.last_durations)
+        return durations
+        
+    
     def month_translator(self):
         month_numbers = [[self.months[i], i+1] for i in range(len(self.months))]
         return month_numbers 
@@ -0,0 +1,296 @@
+from datetime import datetime, timedelta
+import time
+import logging
+import pytz
+
+import database
+from volatility_index import BVIX
+
+
+class SchemaManager:
+
+    """
+    Opt-in storage layout for obot.derbbo and obot.bvix (section [Storage]
+    in settings.txt). It has to run before SaveBBO / BVIX, whose own
+    'CREATE TABLE IF NOT EXISTS' then leaves the managed tables alone.
+
+        - tables are range partitioned on timestamp, one partition per day
+          or month; partitions are created ahead of time by the maintenance
+          loop, so inserts never hit a missing partition
+        - a BRIN index on timestamp (tiny, ideal for append-only time series)
+          and a btree on (expiration, strike, typ, timestamp) for per
+          instrument history; indexes are declared on the parent and
+          inherited by every partition
+        - REAL (4 byte) columns instead of NUMERIC, DOUBLE PRECISION where
+          USD amounts need more than 7 significant digits
+        - with retention_days > 0, partitions entirely older than that are
+          rolled up to hourly resolution (the first snapshot of each hour,
+          so an hourly row is still one consistent cross section) into
+          obot.derbbo_hourly / obot.bvix_hourly, and then dropped
+
+    Existing unpartitioned tables are never touched automatically; see
+    migrate() to move their rows into the managed layout. Other currencies
+    than BTC get the same layout in their own tables (obot.derbbo_eth, ...).
+    """
+
+    def __init__(self, config, interval="daily", retention_days=0, lookahead=3, currencies=None):
+        self.logger = logging.getLogger("deribit")
+        self.conn = database.connect(config)
+        self.c = self.conn.cursor()
+        self.schema = "obot"
+        if interval not in ["daily", "monthly"]:
+            raise ValueError("partition_interval must be 'daily' or 'monthly'")
+        self.interval = interval
+        self.retention_days = retention_days
+        self.lookahead = lookahead # partitions created ahead of the current one
+        self.maintenance_interval = 60*60
+        self.shutdown = False
+
+        columns = {
+            "derbbo": ("timestamp TIMESTAMPTZ NOT NULL, btcusd_price DOUBLE PRECISION, "
+                       "ttmyears REAL, expiration TIMESTAMPTZ, strike INTEGER, "
+                       "typ CHAR(1), oi REAL, bid REAL, bid_usd DOUBLE PRECISION, "
+                       "bid_size REAL, bid_iv REAL, ask REAL, ask_usd DOUBLE PRECISION, "
+                       "ask_size REAL, ask_iv REAL, forward DOUBLE PRECISION"),
+            "bvix": ("timestamp TIMESTAMPTZ NOT NULL, moneyness REAL, "
+                     + ", ".join("d{} REAL".format(i) for i in BVIX.days_til_maturity)),
+        }
+        indexes = {
+            "derbbo": [("timestamp", "USING BRIN (timestamp)"),
+                       ("instrument", "(expiration, strike, typ, timestamp)")],
+            "bvix": [("timestamp", "USING BRIN (timestamp)")],
+        }
+        self.tables = dict()
+        self.indexes = dict()
+        for currency in currencies or ["BTC"]:
+            for table in columns:
+                name = database.currency_table(table, currency)
+                self.tables[name] = columns[table]
+                self.indexes[name] = indexes[table]
+
+
+    def prepare(self):
+        """ Creates the managed tables (if absent), their partitions and rollup tables """
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        for table, columns in self.tables.items():
+            if not self.exists(table):
+                self.c.execute("CREATE TABLE {}.{} ({}) PARTITION BY RANGE (timestamp)".format(
+                    self.schema, table, columns))
+                self.logger.info("Created partitioned table {}.{}.".format(self.schema, table))
+            if self.is_partitioned(table):
+                for name, definition in self.indexes[table]:
+                    self.c.execute("CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {2}.{0} "
+                                   "{3}".format(table, name, self.schema, definition))
+            else:
+                self.logger.info("{}.{} exists unpartitioned, run 'python schema_manager.py "
+                                 "migrate' to convert it.".format(self.schema, table))
+
+            self.c.execute("CREATE TABLE IF NOT EXISTS {0}.{1}_hourly ({2})".format(
+                self.schema, table, columns))
+            # tables created while the perpetual mid was stored in whole dollars
+            for name in [table, table + "_hourly"]:
+                if self.column_types(name).get("btcusd_price") == "integer":
+                    self.c.execute("ALTER TABLE {}.{} ALTER COLUMN btcusd_price "
+                                   "TYPE DOUBLE PRECISION".format(self.schema, name))
+            self.c.execute("CREATE INDEX IF NOT EXISTS {0}_hourly_timestamp_idx ON "
+                           "{1}.{0}_hourly (timestamp)".format(table, self.schema))
+        self.conn.commit()
+        self.maintain()
+
+
+    def run(self):
+        """ Maintenance loop for a separate thread """
+        last = time.time()
+        while not self.shutdown:
+            if time.time() - last >= self.maintenance_interval:
+                last = time.time()
+                try:
+                    self.maintain()
+                except Exception as e:
+                    self.conn.rollback()
+                    self.logger.info("Error during storage maintenance: {}".format(e))
+            time.sleep(1)
+
+
+    def maintain(self, now=None):
+        if now is None:
+            now = datetime.now(pytz.UTC)
+        for table in self.tables:
+            if not self.is_partitioned(table):
+                continue
+            self.create_partitions(table, now)
+            if self.retention_days > 0:
+                self.roll_up(table, now - timedelta(days=self.retention_days))
+
+
+    def create_partitions(self, table, now):
+        start = self.period_start(now)
+        for _ in range(self.lookahead + 1):
+            end = self.next_period(start)
+            self.c.execute("CREATE TABLE IF NOT EXISTS {0}.{1} PARTITION OF {0}.{2} "
+                           "FOR VALUES FROM (%s) TO (%s)".format(
+                               self.schema, self.partition_name(table, start), table),
+                           (start, end))
+            start = end
+        self.conn.commit()
+
+
+    def roll_up(self, table, cutoff):
+
+        """
+        Partitions ending before cutoff: first snapshot per hour goes to the
+        hourly table, then the partition is dropped. Each partition is one
+        transaction; rerunning after a failure rewrites the same hours.
+        """
+
+        for name, start, end in self.partitions(table):
+            if end > cutoff:
+                continue
+            try:
+                self.c.execute("DELETE FROM {0}.{1}_hourly WHERE timestamp >= %s "
+                               "AND timestamp < %s".format(self.schema, table), (start, end))
+                self.c.execute("INSERT INTO {0}.{1}_hourly ({3}) SELECT {4} FROM {0}.{2} p "
+                               "JOIN (SELECT min(timestamp) AS first_snapshot FROM {0}.{2} "
+                               "GROUP BY date_trunc('hour', timestamp)) h "
+                               "ON p.timestamp = h.first_snapshot".format(
+                                   self.schema, table, name, ", ".join(self.column_names(table)),
+                                   ", ".join("p." + c for c in self.column_names(table))))
+                self.c.execute("DROP TABLE {}.{}".format(self.schema, name))
+                self.conn.commit()
+                self.logger.info("Rolled up {}.{} to hourly and dropped it.".format(
+                    self.schema, name))
+            except Exception:
+                self.conn.rollback()
+                raise
+
+
+    def migrate(self, table, batch=timedelta(days=1)):
+
+        """
+        Moves an existing unpartitioned table into the managed layout: it is
+        renamed to <table>_unpartitioned, the partitioned table is created
+        and rows are copied over per batch (the columns both have, others stay
+        NULL). The old table is kept for inspection and can be dropped
+        afterwards.
+        """
+
+        if not self.exists(table) or self.is_partitioned(table):
+            return
+        legacy = "{}_unpartitioned".format(table)
+        self.c.execute("ALTER TABLE {}.{} RENAME TO {}".format(self.schema, table, legacy))
+        self.conn.commit()
+        self.prepare()
+
+        self.c.execute("SELECT min(timestamp), max(timestamp) FROM {}.{}".format(
+            self.schema, legacy))
+        first, last = self.c.fetchone()
+        if first is None:
+            return
+        # tables from before a column was added (e.g. forward) leave it NULL
+        legacy_columns = self.column_types(legacy)
+        columns = [column for column in self.column_names(table) if column in legacy_columns]
+        position = self.period_start(first)
+        while position <= last:
+            self.create_partitions(table, position)
+            end = position + batch
+            self.c.execute("INSERT INTO {0}.{1} ({3}) SELECT {3} FROM {0}.{2} "
+                           "WHERE timestamp >= %s AND timestamp < %s".format(
+                               self.schema, table, legacy, ", ".join(columns)),
+                           (position, end))
+            self.conn.commit()
+            self.logger.info("Migrated {}.{} up to {}.".format(self.schema, table, end))
+            position = end
+
+
+    def column_names(self, table):
+        return [column.split(" ")[0] for column in self.tables[table].split(", ")]
+
+
+    def column_types(self, table):
+        """ column name -> data type (as in information_schema) of an existing table """
+        self.c.execute("SELECT column_name, data_type FROM information_schema.columns "
+                       "WHERE table_schema = %s AND table_name = %s", (self.schema, table))
+        return dict(self.c.fetchall())
+
+
+    def exists(self, table):
+        self.c.execute("SELECT to_regclass(%s)", ("{}.{}".format(self.schema, table),))
+        return self.c.fetchone()[0] is not None
+
+
+    def is_partitioned(self, table):
+        self.c.execute("SELECT 1 FROM pg_partitioned_table t JOIN pg_class c ON c.oid = t.partrelid "
+                       "JOIN pg_namespace n ON n.oid = c.relnamespace "
+                       "WHERE n.nspname = %s AND c.relname = %s", (self.schema, table))
+        return self.c.fetchone() is not None
+
+
+    def partitions(self, table):
+        """ (name, start, end) of the table's partitions, from their names """
+        self.c.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                       "JOIN pg_class p ON p.oid = i.inhparent "
+                       "JOIN pg_namespace n ON n.oid = p.relnamespace "
+                       "WHERE n.nspname = %s AND p.relname = %s", (self.schema, table))
+        found = []
+        for (name,) in self.c.fetchall():
+            suffix = name[len(table) + 2:]
+            if not name.startswith(table + "_p") or not suffix.isnumeric():
+                continue
+            interval = "daily" if len(suffix) == 8 else "monthly"
+            start = datetime.strptime(suffix, "%Y%m%d" if interval == "daily" else "%Y%m")
+            start = start.replace(tzinfo=pytz.UTC)
+            found.append((name, start, self.next_period(start, interval)))
+        return sorted(found, key=lambda partition: partition[1])
+
+
+    def partition_name(self, table, start):
+        if self.interval == "daily":
+            return "{}_p{}".format(table, start.strftime("%Y%m%d"))
+        return "{}_p{}".format(table, start.strftime("%Y%m"))
+
+
+    def period_start(self, ts):
+        ts = ts.astimezone(pytz.UTC)
+        if self.interval == "daily":
+            return datetime(ts.year, ts.month, ts.day, tzinfo=pytz.UTC)
+        return datetime(ts.year, ts.month, 1, tzinfo=pytz.UTC)
+
+
+    def next_period(self, start, interval=None):
+        if (interval or self.interval) == "daily":
+            return start + timedelta(days=1)
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+
+
+
+def from_settings(config, required=False):
+    """ SchemaManager configured by the [Storage] section, None if not enabled (and not required) """
+    enabled = (config.has_section("Storage")
+               and config.getboolean("Storage", "partitioned", fallback=False))
+    if not enabled and not required:
+        return None
+    return SchemaManager(config,
+                         interval=config.get("Storage", "partition_interval", fallback="daily"),
+                         retention_days=config.getint("Storage", "retention_days", fallback=0),
+                         currencies=database.currencies(config))
+
+
+def main():
+    import sys
+    logger = logging.getLogger("deribit")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+
+    manager = from_settings(database.read_settings("settings.txt"), required=True)
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        for table in manager.tables:
+            manager.migrate(table)
+    else:
+        manager.prepare()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+One market data connection shared by several (sub-)accounts.
+
+The market connection (WSClient with channels "market") subscribes to the
+instruments, books and tickers once and decodes them into the market
+DataFeed. Every account gets a lightweight connection of its own (channels
+"account": auth, then orders, portfolio and trades only) with an account
+DataFeed, which shares the market feed's books and keeps the account's
+orders and positions, plus its own delta hedger per currency and order
+pipeline. No market data is received or decoded per account.
+"""
+
+import logging
+import threading
+
+from data_feed import DataFeed
+from hedger import DeltaHedge
+from order_pipeline import OrderPipeline
+from ws_client import WSClient
+
+
+class AccountSession:
+
+    """ forward_curves and vol_surfaces: {currency: module}, the first currency is the CLI's """
+
+    def __init__(self, name, market_feed, forward_curves, vol_surfaces, api_key, api_secret,
+                 ws_url, order_rate=5, order_burst=20):
+        self.name = name
+        self.feed = DataFeed(market=market_feed)
+        self.delta_hedgers = {currency: DeltaHedge(self.feed, forward_curve,
+                                                   vol_surfaces[currency], currency)
+                              for currency, forward_curve in forward_curves.items()}
+        self.delta_hedger = list(self.delta_hedgers.values())[0]
+        self.client = WSClient(self.feed, self.delta_hedger, api_key, api_secret, ws_url,
+                               channels="account", currencies=list(forward_curves))
+        self.client.delta_hedgers = self.delta_hedgers
+        self.order_pipeline = OrderPipeline(self.client, order_rate, order_burst)
+        self.client.order_pipeline = self.order_pipeline
+
+
+
+class SessionManager:
+
+    def __init__(self, market_client, forward_curves, vol_surfaces, order_rate=5, order_burst=20):
+        self.market_client = market_client
+        self.feed = market_client.feed
+        self.forward_curves = forward_curves
+        self.vol_surfaces = vol_surfaces
+        self.order_rate = order_rate
+        self.order_burst = order_burst
+        self.logger = logging.getLogger("deribit")
+        self.accounts = dict() # name -> AccountSession, in the order added
+
+
+    def add_account(self, name, api_key, api_secret):
+        session = AccountSession(name, self.feed, self.forward_curves, self.vol_surfaces,
+                                 api_key, api_secret, self.market_client.ws_url,
+                                 self.order_rate, self.order_burst)
+        self.accounts[name] = session
+        return session
+
+
+    def connect(self):
+        """ Connects all accounts in parallel, returns once all are subscribed """
+        threads = []
+        for name, session in self.accounts.items():
+            if session.client.connected:
+                continue
+            self.logger.info("Starting account connection '{}'.".format(name))
+            thread = threading.Thread(target=session.client.create_ws_connection,
+                                      name="connect {}".format(name))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+
+    def shutdown(self):
+        for session in self.accounts.values():
+            session.client.shutdown()
+
+
+    def join(self):
+        for session in self.accounts.values():
+            session.client.t1.join()
@@ -0,0 +1,517 @@
+"""
+Market state of the ingest process in shared memory, for processes which
+must not share its GIL (the snapshot / BVIX stage, strategies).
+
+SharedBookWriter runs in the process that owns the websocket and DataFeed
+and publishes, every interval, the options top of book (best bid and ask
+with sizes, open interest), the futures best bid and offer and the
+positions into one shared memory block. Only the option books changed
+since the last publication are rescanned (DataFeed.changed_books).
+SharedBookReader maps the block by name from any process on the machine,
+and SharedFeed answers the DataFeed read methods (fetch_local_ob,
+fetch_btcusd_bbo, positions, ...) from it, so the existing modules run on
+top of it unchanged. Option books are one level deep there, which is all
+the snapshots use.
+
+Consistency is a seqlock: the writer makes the sequence number odd, writes,
+and makes it even again; a reader copies the arrays and retries if the
+number was odd or changed meanwhile. Readers never block the writer.
+Instrument names only change on (re)connects and are rewritten then, under
+a new layout version.
+"""
+
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import logging
+import time
+
+import numpy as np
+
+from data_feed import expiry_key
+
+
+NAME_BYTES = 48
+
+# header fields (int64)
+SEQUENCE, VERSION, OPTIONS, FUTURES, POSITIONS, PUBLISHED_MS, EXCHANGE_MS, RECEIVED_MS = range(8)
+HEADER_FIELDS = 8
+
+OPTION_FIELDS = ["bid", "bid_size", "ask", "ask_size", "oi"]
+FUTURE_FIELDS = ["bid", "ask"]
+POSITION_FIELDS = ["size", "average_price"]
+
+# one consistent read of the block, arrays are copies
+BookView = namedtuple("BookView", ["version", "published", "last_futures_update",
+                                   "options", "option_quotes", "futures", "future_quotes",
+                                   "positions", "position_values"])
+
+
+class BookLayout:
+
+    """ The arrays of a block: header, names (options, futures, positions) and values """
+
+    def __init__(self, buffer, options=4000, futures=64, positions=512):
+        self.capacity = (options, futures, positions)
+        offset = 0
+        self.header = np.ndarray(HEADER_FIELDS, dtype=np.int64, buffer=buffer, offset=offset)
+        offset += self.header.nbytes
+        self.names = np.ndarray(options + futures + positions, dtype="S{}".format(NAME_BYTES),
+                                buffer=buffer, offset=offset)
+        offset += self.names.nbytes
+        self.options = np.ndarray((len(OPTION_FIELDS), options), dtype=np.float64,
+                                  buffer=buffer, offset=offset)
+        offset += self.options.nbytes
+        self.futures = np.ndarray((len(FUTURE_FIELDS), futures), dtype=np.float64,
+                                  buffer=buffer, offset=offset)
+        offset += self.futures.nbytes
+        self.positions = np.ndarray((len(POSITION_FIELDS), positions), dtype=np.float64,
+                                    buffer=buffer, offset=offset)
+        offset += self.positions.nbytes
+        self.size = offset
+
+
+    @staticmethod
+    def size_for(options=4000, futures=64, positions=512):
+        return (HEADER_FIELDS * 8 + (options + futures + positions) * NAME_BYTES
+                + (len(OPTION_FIELDS) * options + len(FUTURE_FIELDS) * futures
+                   + len(POSITION_FIELDS) * positions) * 8)
+
+
+
+class SharedBookWriter:
+
+    def __init__(self, feed, name="deribit_book", interval=0.05, options=4000, futures=64,
+                 positions=512):
+        self.feed = feed
+        self.name = name
+        self.interval = interval
+        self.logger = logging.getLogger("deribit")
+        self.shutdown = False
+
+        size = BookLayout.size_for(options, futures, positions)
+        try:
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left over from a process that did not exit cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.layout = BookLayout(self.block.buf, options, futures, positions)
+        self.layout.header[:] = 0
+        self.names = ([], [], []) # as last written
+        self.rows = dict() # option name -> row as last written
+        # the feed marks the option books it changes, only those are rescanned
+        feed.changed_books = dict()
+        self.oi_interval = 1.0 # seconds, open interest is only read by the minutely snapshots
+        self.last_oi = 0.
+        self.publications = 0
+        self.truncated = False
+
+
+    def run(self):
+        while not self.shutdown:
+            start = time.perf_counter()
+            try:
+                self.publish()
+            except Exception as e:
+                self.logger.info("Shared book not published: {}".format(e))
+            time.sleep(max(self.interval - (time.perf_counter() - start), 0.001))
+
+
+    def publish(self):
+
+        """
+        Writes what changed since the last publication: the rows of the
+        option books the feed marked as changed (all rows after a change of
+        the instrument names), open interest once per oi_interval, and the
+        futures and positions, which are few.
+        """
+
+        feed = self.feed
+        layout = self.layout
+        option_capacity, future_capacity, position_capacity = layout.capacity
+
+        # list() / dict() of a dict run without releasing the GIL, so the
+        # websocket thread cannot change the dicts while they are copied
+        option_names = list(feed.ob)
+        futures = list(feed.futures_bbo.items())
+        positions = list(feed.positions.items())
+        if (len(option_names) > option_capacity or len(futures) > future_capacity
+            or len(positions) > position_capacity) and not self.truncated:
+            self.truncated = True
+            self.logger.info("Shared book capacity exceeded, instruments beyond it are left out.")
+        option_names = option_names[:option_capacity]
+        futures = futures[:future_capacity]
+        positions = positions[:position_capacity]
+
+        relayout = option_names != self.names[0]
+        # taken one at a time (popitem is atomic), a book marked again meanwhile
+        # stays marked for the next publication, so no change is lost
+        changed = []
+        while True:
+            try:
+                changed.append(feed.changed_books.popitem()[0])
+            except KeyError:
+                break
+        if relayout:
+            self.rows = {name: i for i, name in enumerate(option_names)}
+            rows = list(enumerate(option_names))
+        else:
+            rows = [(self.rows[name], name) for name in changed if name in self.rows]
+
+        quotes = np.full((4, len(rows)), np.nan)
+        for k, (i, name) in enumerate(rows):
+            book = feed.ob.get(name)
+            if book is None: # removed meanwhile
+                continue
+            bids = book["bids"]
+            asks = book["asks"]
+            if bids:
+                best = max(bids)
+                quotes[0, k] = best
+                quotes[1, k] = bids.get(best, np.nan)
+            if asks:
+                best = min(asks)
+                quotes[2, k] = best
+                quotes[3, k] = asks.get(best, np.nan)
+        indices = np.fromiter((i for i, name in rows), dtype=np.int64, count=len(rows))
+
+        oi = None
+        now = time.monotonic()
+        if relayout or now - self.last_oi >= self.oi_interval:
+            oi = np.fromiter((feed.oi.get(name, np.nan) for name in option_names),
+                             dtype=np.float64, count=len(option_names))
+            self.last_oi = now
+
+        future_quotes = np.array([[bbo["bid"] for name, bbo in futures],
+                                  [bbo["ask"] for name, bbo in futures]], dtype=float).reshape(2, -1)
+        position_values = np.array([[position["size"] for name, position in positions],
+                                    [position.get("average_price", np.nan) for name, position in positions]],
+                                   dtype=float).reshape(2, -1)
+        names = (option_names, [name for name, bbo in futures],
+                 [name for name, position in positions])
+
+        exchange_ms, received_ms = 0, 0
+        if feed.last_futures_update is not None:
+            exchange_ms = feed.last_futures_update[0] or 0
+            received_ms = int(feed.last_futures_update[1] * 1000)
+
+        header = layout.header
+        header[SEQUENCE] += 1 # odd: writing
+        if names != self.names:
+            layout.names[:len(names[0])] = names[0]
+            layout.names[option_capacity:option_capacity + len(names[1])] = names[1]
+            layout.names[option_capacity + future_capacity:
+                         option_capacity + future_capacity + len(names[2])] = names[2]
+            header[VERSION] += 1
+            header[OPTIONS], header[FUTURES], header[POSITIONS] = [len(group) for group in names]
+            self.names = names
+        layout.options[:4, indices] = quotes
+        if oi is not None:
+            layout.options[4, :len(oi)] = oi
+        layout.futures[:, :len(futures)] = future_quotes
+        layout.positions[:, :len(positions)] = position_values
+        header[PUBLISHED_MS] = int(time.time() * 1000)
+        header[EXCHANGE_MS] = exchange_ms
+        header[RECEIVED_MS] = received_ms
+        header[SEQUENCE] += 1 # even: consistent
+        self.publications += 1
+
+
+    def close(self):
+        """ Removes the block, after the publishing thread has ended """
+        self.shutdown = True
+        self.layout = None # the arrays export the buffer, which must be released first
+        self.block.close()
+        self.block.unlink()
+
+
+
+class SharedBookReader:
+
+    """ Maps a writer's block by name; read() returns a consistent BookView """
+
+    def __init__(self, name="deribit_book", options=4000, futures=64, positions=512):
+        self.block = shared_memory.SharedMemory(name=name)
+        if multiprocessing.parent_process() is None:
+            # a process of its own has its own resource tracker, which would remove
+            # the block when the reader exits; processes started by the writer's
+            # process share its tracker, which forgets the block on unlink
+            resource_tracker.unregister(self.block._name, "shared_memory")
+        self.layout = BookLayout(self.block.buf, options, futures, positions)
+        for array in [self.layout.header, self.layout.names, self.layout.options,
+                      self.layout.futures, self.layout.positions]:
+            array.flags.writeable = False
+        self.version = None
+        self.names = ([], [], [])
+        self.retries = 0
+
+
+    def read(self, attempts=1000):
+        layout = self.layout
+        header = layout.header
+        option_capacity, future_capacity, position_capacity = layout.capacity
+        for _ in range(attempts):
+            sequence = int(header[SEQUENCE])
+            if sequence % 2:
+                self.retries += 1
+                time.sleep(0)
+                continue
+            values = header.copy()
+            n_options, n_futures, n_positions = (int(values[OPTIONS]), int(values[FUTURES]),
+                                                 int(values[POSITIONS]))
+            names = self.names
+            if values[VERSION] != self.version:
+                names = (layout.names[:n_options].copy(),
+                         layout.names[option_capacity:option_capacity + n_futures].copy(),
+                         layout.names[option_capacity + future_capacity:
+                                      option_capacity + future_capacity + n_positions].copy())
+            options = layout.options[:, :n_options].copy()
+            futures = layout.futures[:, :n_futures].copy()
+            positions = layout.positions[:, :n_positions].copy()
+            if int(header[SEQUENCE]) != sequence:
+                self.retries += 1
+                continue
+
+            if values[VERSION] != self.version:
+                self.names = tuple([name.decode() for name in group] for group in names)
+                self.version = values[VERSION]
+            last_update = None
+            if values[RECEIVED_MS]:
+                last_update = (int(values[EXCHANGE_MS]) or None, values[RECEIVED_MS] / 1000)
+            return BookView(int(values[VERSION]), values[PUBLISHED_MS] / 1000, last_update,
+                            self.names[0], options, self.names[1], futures,
+                            self.names[2], positions)
+        raise TimeoutError("shared book stayed inconsistent for {} reads".format(attempts))
+
+
+    def close(self):
+        self.layout = None
+        self.block.close()
+
+
+
+class SharedFeed:
+
+    """
+    The DataFeed read methods and attributes on top of a SharedBookReader.
+    Reads refresh from the block at most every max_age seconds,
+    fetch_local_ob always does.
+    """
+
+    def __init__(self, reader, max_age=0.01):
+        self.reader = reader
+        self.max_age = max_age
+        self.logger = logging.getLogger("deribit")
+        self.refreshed = 0
+        self._ob = dict()
+        self._oi = dict()
+        self._futures_bbo = dict()
+        self._positions = dict()
+        self._expiry_contracts = dict()
+        self._expiry_versions = dict()
+        self._last_futures_update = None
+        self.option_quotes = None
+
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.refreshed < self.max_age:
+            return
+        view = self.reader.read()
+        self.refreshed = time.time()
+
+        changed_rows = np.ones(len(view.options), dtype=bool)
+        if self.option_quotes is not None and self.option_quotes.shape == view.option_quotes.shape:
+            changed_rows = ~((self.option_quotes == view.option_quotes)
+                             | (np.isnan(self.option_quotes) & np.isnan(view.option_quotes))).all(axis=0)
+        self.option_quotes = view.option_quotes
+
+        ob = dict()
+        oi = dict()
+        expiry_contracts = dict()
+        bid, bid_size, ask, ask_size, interest = view.option_quotes.tolist()
+        for i, name in enumerate(view.options):
+            ob[name] = {"bids": {} if np.isnan(bid[i]) else {bid[i]: bid_size[i]},
+                        "asks": {} if np.isnan(ask[i]) else {ask[i]: ask_size[i]}}
+            if not np.isnan(interest[i]):
+                oi[name] = interest[i]
+            expiry = expiry_key(name)
+            if expiry not in expiry_contracts:
+                expiry_contracts[expiry] = set()
+            expiry_contracts[expiry].add(name)
+            if changed_rows[i]:
+                self._expiry_versions[expiry] = self._expiry_versions.get(expiry, 0) + 1
+
+        futures_bbo = dict()
+        for name, (bid, ask) in zip(view.futures, view.future_quotes.T.tolist()):
+            futures_bbo[name] = {"bid": None if np.isnan(bid) else bid,
+                                 "ask": None if np.isnan(ask) else ask}
+            if futures_bbo[name] != self._futures_bbo.get(name):
+                # as DataFeed.update_futures_bbo: the perpetual moves all expiries
+                if name.endswith("-PERPETUAL"):
+                    prefix = name[:name.find("-") + 1]
+                    changed = [expiry for expiry in expiry_contracts if expiry.startswith(prefix)]
+                else:
+                    changed = [expiry_key(name)] if expiry_key(name) in expiry_contracts else []
+                for expiry in changed:
+                    self._expiry_versions[expiry] = self._expiry_versions.get(expiry, 0) + 1
+        positions = dict()
+        for name, (size, price) in zip(view.positions, view.position_values.T.tolist()):
+            positions[name] = {"instrument_name": name, "size": size, "average_price": price,
+                               "direction": "buy" if size > 0 else "sell"}
+
+        self._ob = ob
+        self._oi = oi
+        self._expiry_contracts = expiry_contracts
+        self._futures_bbo = futures_bbo
+        self._positions = positions
+        self._last_futures_update = view.last_futures_update
+
+
+    @property
+    def ob(self):
+        self.refresh()
+        return self._ob
+
+
+    @property
+    def oi(self):
+        self.refresh()
+        return self._oi
+
+
+    @property
+    def futures_bbo(self):
+        self.refresh()
+        return self._futures_bbo
+
+
+    @property
+    def positions(self):
+        self.refresh()
+        return self._positions
+
+
+    @property
+    def expiry_contracts(self):
+        self.refresh()
+        return self._expiry_contracts
+
+
+    @property
+    def expiry_versions(self):
+        self.refresh()
+        return self._expiry_versions
+
+
+    @property
+    def last_futures_update(self):
+        self.refresh()
+        return self._last_futures_update
+
+
+    def fetch_local_ob(self):
+        self.refresh(force=True)
+        return self._ob
+
+
+    def fetch_local_oi(self):
+        return self.oi
+
+
+    def get_positions(self):
+        return self.positions
+
+
+    def fetch_btcusd_bbo(self, instrument, side):
+        return self.futures_bbo[instrument][side]
+
+
+    def feed_lag(self):
+        last_update = self.last_futures_update
+        if last_update is None:
+            return None
+        exchange_ms, received = last_update
+        lag = None
+        if exchange_ms is not None:
+            lag = received - exchange_ms / 1000
+        return lag, time.time() - received
+
+
+
+def snapshot_process(book_name, settings_path, surfaces, stop, analytics_workers=0,
+                     streaming_interval=0):
+
+    """
+    Target of the snapshot process: SaveBBO (and the streaming surface, if
+    enabled) per currency of the settings on a SharedFeed, with its own
+    database connection. Every new volatility surface is put on the
+    surfaces queue as (currency, state, durations) for the ingest process,
+    durations being the stages of the last snapshot (for its metrics). Runs
+    until the stop event is set.
+    """
+
+    import threading
+    import database
+    from async_logging import setup_async_logging
+    from forward_curve import ForwardCurve
+    from vol_surface import VolSurface
+    from save_top_of_book import SaveBBO
+
+    logger = logging.getLogger("deribit")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        setup_async_logging(logger, "deribit-snapshot.log")
+
+    feed = SharedFeed(SharedBookReader(book_name))
+    while not stop.is_set() and not feed.fetch_local_ob():
+        time.sleep(0.1) # first publication
+
+    config = database.read_settings(settings_path)
+    db_connection = database.db_connection(config)
+    analytics_pool = None
+    if analytics_workers > 0:
+        from analytics_pool import AnalyticsPool
+        from volatility_index import BVIX
+        analytics_pool = AnalyticsPool(analytics_workers, BVIX.log_moneyness_intervals)
+
+    vol_surfaces = dict()
+    save_bbos = dict()
+    modules = []
+    threads = []
+    for currency in database.currencies(config):
+        forward_curve = ForwardCurve(feed, currency)
+        vol_surfaces[currency] = VolSurface()
+        save_bbo = SaveBBO(feed, db_connection, forward_curve, vol_surface=vol_surfaces[currency],
+                           analytics_pool=analytics_pool)
+        save_bbos[currency] = save_bbo
+        modules.append(save_bbo)
+        threads.append(threading.Thread(target=save_bbo.schedule_snapshot, daemon=True))
+        if streaming_interval > 0:
+            from streaming_surface import StreamingSurface
+            streaming_surface = StreamingSurface(feed, forward_curve, vol_surfaces[currency],
+                                                 save_bbo.bvix, streaming_interval)
+            modules.append(streaming_surface)
+            threads.append(threading.Thread(target=streaming_surface.run, daemon=True))
+    for thread in threads:
+        thread.start()
+    logger.info("Snapshot process running on shared book '{}'.".format(book_name))
+
+    sent = dict() # currency -> (state, durations) last put on the queue
+    while not stop.wait(0.1):
+        for currency, vol_surface in vol_surfaces.items():
+            state = vol_surface.state
+            durations = save_bbos[currency].durations()
+            last_state, last_durations = sent.get(currency, (None, None))
+            if state is not None and (state is not last_state or durations != last_durations):
+                surfaces.put((currency, state, durations))
+                sent[currency] = (state, durations)
+
+    for module in modules:
+        module.shutdown = True
+    for thread in threads:
+        thread.join(timeout=10)
+    if analytics_pool is not None:
+        analytics_pool.shutdown()
@@ -0,0 +1,235 @@
+import numpy as np
+import pandas as pd
+import logging
+import database
+
+
+class SmileFitter:
+
+    """
+    Fits a raw SVI smile to every expiry of a snapshot:
+        w(k) = a + b * (rho * (k - m) + sqrt((k - m)**2 + sigma**2))
+    where w is total implied variance (iv**2 * ttmyears) and k the log
+    moneyness against the expiry's forward.
+
+    All expiries are calibrated together with a batched Levenberg-Marquardt:
+    residuals and Jacobians are evaluated for the whole surface at once and
+    the 5x5 normal equations of every expiry are solved as one stacked system.
+    The parameters are transformed (b, sigma > 0, |rho| < 1 and a minimum
+    total variance >= 0) so the optimisation is unconstrained. A weak
+    penalty towards a data driven guess keeps the otherwise flat directions
+    of SVI (e.g. nearly parabolic smiles) from drifting between snapshots.
+    Each expiry starts from the parameters found in an earlier snapshot,
+    which usually converges in a handful of iterations; new expiries start
+    from the guess with a larger iteration budget, in a batch of their own.
+    Fitted parameters are stored next to obot.bvix in obot.bvix_svi.
+    """
+
+    def __init__(self, db_connection, min_points=5, currency="BTC"):
+        self.logger = logging.getLogger("deribit")
+        self.schema = "obot"
+        self.table = database.currency_table("bvix_svi", currency)
+        self.c = db_connection["c"]
+        self.conn = db_connection["conn"]
+        self.engine = db_connection["engine"]
+
+        self.min_points = min_points
+        self.warm_iterations = 15
+        self.cold_iterations = 200
+        self.tolerance = 1e-12
+        self.regularisation = 1e-3 # relative to the typical total variance
+
+        self.previous = dict() # expiration -> transformed parameters
+        self.params = dict() # expiration -> latest raw parameters (a, b, rho, m, sigma)
+        self.prepare_db()
+
+
+    def prepare_db(self):
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        self.conn.commit()
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
+                       "timestamp TIMESTAMPTZ, expiration TIMESTAMPTZ, "
+                       "ttmyears NUMERIC, a NUMERIC, b NUMERIC, rho NUMERIC, "
+                       "m NUMERIC, sigma NUMERIC, rmse NUMERIC, points INTEGER, "
+                       "iterations INTEGER)".format(self.schema, self.table))
+        self.conn.commit()
+
+
+    def fit_surface(self, slices):
+
+        """
+        slices: {expiration: ExpirySlice} as built by the BVIX. Returns a
+        DataFrame with one row of fitted parameters per expiry.
+        """
+
+        expirations = []
+        ttms = []
+        quotes = []
+        for expiration, expiry in sorted(slices.items(), key=lambda item: item[1].ttmdays):
+            has_iv = ~np.isnan(expiry.strike_iv)
+            if has_iv.sum() < self.min_points or expiry.ttmdays <= 0:
+                continue
+            ttm = expiry.ttmdays / 365
+            expirations.append(expiration)
+            ttms.append(ttm)
+            quotes.append((expiry.strike_moneyness[has_iv], expiry.strike_iv[has_iv] ** 2 * ttm))
+
+        columns = ["expiration", "ttmyears", "a", "b", "rho", "m", "sigma",
+                   "rmse", "points", "iterations"]
+        if not expirations:
+            return pd.DataFrame(columns=columns)
+
+        # pad all expiries to the same number of strikes, masked by weight 0
+        size = max(len(k) for k, _ in quotes)
+        k = np.zeros((len(quotes), size))
+        w = np.zeros((len(quotes), size))
+        weight = np.zeros((len(quotes), size))
+        for i, (k_i, w_i) in enumerate(quotes):
+            k[i, :len(k_i)] = k_i
+            w[i, :len(w_i)] = w_i
+            weight[i, :len(k_i)] = 1
+
+        anchor = np.vstack([initial_guess(k[i], w[i], weight[i]) for i in range(len(expirations))])
+        theta = np.vstack([self.previous.get(e, anchor[i]) for i, e in enumerate(expirations)])
+        penalty = self.regularisation * np.nanmedian(np.where(weight > 0, w, np.nan), axis=1)
+
+        # expiries with parameters of an earlier snapshot start there, new ones
+        # from the guess with the larger budget, as two batches
+        warm = np.array([e in self.previous for e in expirations])
+        iterations = np.zeros(len(expirations), dtype=int)
+        for rows, max_iterations in [(warm, self.warm_iterations), (~warm, self.cold_iterations)]:
+            if rows.any():
+                theta[rows], iterations[rows] = levenberg_marquardt(
+                    theta[rows], k[rows], w[rows], weight[rows], anchor[rows], penalty[rows],
+                    max_iterations, self.tolerance)
+
+        raw = raw_parameters(theta)
+        points = weight.sum(axis=1)
+        fitted = svi_total_variance(raw, k)
+        rmse = np.sqrt((((fitted - w) * weight) ** 2).sum(axis=1) / points)
+
+        # an expiry left out for too few points keeps its parameters while listed
+        self.previous = {e: params for e, params in self.previous.items() if e in slices}
+        self.previous.update({e: theta[i] for i, e in enumerate(expirations)})
+        self.params = {e: raw[i] for i, e in enumerate(expirations)}
+
+        df = pd.DataFrame(raw, columns=["a", "b", "rho", "m", "sigma"])
+        df.insert(0, "ttmyears", ttms)
+        df.insert(0, "expiration", expirations)
+        df["rmse"] = rmse
+        df["points"] = points.astype(int)
+        df["iterations"] = iterations
+        return df[columns]
+
+
+    def store(self, df, ts):
+        if len(df) == 0:
+            return
+        df = df.copy()
+        df.insert(0, "timestamp", pd.to_datetime(ts, utc=True))
+        df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
+        df.to_sql(self.table, con=self.engine, schema=self.schema,
+                  if_exists='append', index=False)
+
+
+
+def initial_guess(k, w, weight):
+    """ Cold start in transformed parameters (log v_min, log b, atanh rho, m, log sigma) """
+    valid = weight > 0
+    k = k[valid]
+    w = w[valid]
+    v_min = max(w.min() * 0.9, 1e-8)
+    span = max(k.max() - k.min(), 1e-3)
+    b = max((w.max() - w.min()) / span, 1e-3)
+    return np.array([np.log(v_min), np.log(b), np.arctanh(-0.1), k[np.argmin(w)], np.log(0.1)])
+
+
+def raw_parameters(theta):
+    """ Transformed parameters -> raw SVI (a, b, rho, m, sigma), one row per expiry """
+    v_min = np.exp(theta[:, 0])
+    b = np.exp(theta[:, 1])
+    rho = np.tanh(theta[:, 2])
+    m = theta[:, 3]
+    sigma = np.exp(theta[:, 4])
+    a = v_min - b * sigma * np.sqrt(1 - rho ** 2)
+    return np.column_stack([a, b, rho, m, sigma])
+
+
+def svi_total_variance(params, k):
+    """ Raw SVI total variance for parameter rows (n, 5) and moneyness (n, ...) """
+    a, b, rho, m, sigma = [params[:, i:i+1] for i in range(5)]
+    d = k - m
+    return a + b * (rho * d + np.sqrt(d ** 2 + sigma ** 2))
+
+
+def residuals_and_jacobian(theta, k, w, weight, prior, penalty):
+    v_min = np.exp(theta[:, 0:1])
+    b = np.exp(theta[:, 1:2])
+    rho = np.tanh(theta[:, 2:3])
+    m = theta[:, 3:4]
+    sigma = np.exp(theta[:, 4:5])
+    root = np.sqrt(1 - rho ** 2)
+
+    d = k - m
+    r = np.sqrt(d ** 2 + sigma ** 2)
+    model = v_min - b * sigma * root + b * (rho * d + r)
+    residuals = (model - w) * weight
+
+    jacobian = np.empty(k.shape + (5,))
+    jacobian[..., 0] = v_min
+    jacobian[..., 1] = b * (rho * d + r - sigma * root)
+    jacobian[..., 2] = b * root ** 2 * d + b * sigma * rho * root
+    jacobian[..., 3] = -b * (rho + d / r)
+    jacobian[..., 4] = b * sigma * (sigma / r - root)
+    jacobian *= weight[..., None]
+
+    # penalty rows towards the prior parameters
+    residuals = np.concatenate([residuals, penalty[:, None] * (theta - prior)], axis=1)
+    jacobian = np.concatenate([jacobian, penalty[:, None, None] * np.eye(5)], axis=1)
+    return residuals, jacobian
+
+
+def levenberg_marquardt(theta, k, w, weight, prior, penalty, max_iterations, tolerance):
+
+    """
+    Batched Levenberg-Marquardt over expiries (rows), starting at theta and
+    penalised towards prior. Returns the parameters and the iterations used
+    per row.
+    """
+
+    theta = theta.copy()
+    damping = np.full(len(theta), 1e-3)
+    iterations = np.zeros(len(theta), dtype=int)
+    active = np.ones(len(theta), dtype=bool)
+
+    residuals, jacobian = residuals_and_jacobian(theta, k, w, weight, prior, penalty)
+    cost = 0.5 * (residuals ** 2).sum(axis=1)
+
+    for _ in range(max_iterations):
+        jtj = np.einsum("eni,enj->eij", jacobian, jacobian)
+        gradient = np.einsum("eni,en->ei", jacobian, residuals)
+        diagonal = np.einsum("eii->ei", jtj)
+        system = jtj + (damping[:, None] * np.maximum(diagonal, 1e-12))[:, :, None] * np.eye(5)
+        step = -np.linalg.solve(system, gradient[..., None])[..., 0]
+        step[~active] = 0
+
+        candidate = theta + step
+        new_residuals, new_jacobian = residuals_and_jacobian(candidate, k, w, weight, prior, penalty)
+        new_cost = 0.5 * (new_residuals ** 2).sum(axis=1)
+
+        improved = active & np.isfinite(new_cost) & (new_cost < cost)
+        converged = improved & ((cost - new_cost) <= tolerance * np.maximum(cost, 1e-12))
+        stalled = active & ~improved & (damping > 1e10)
+
+        theta[improved] = candidate[improved]
+        residuals[improved] = new_residuals[improved]
+        jacobian[improved] = new_jacobian[improved]
+        cost[improved] = new_cost[improved]
+        damping = np.where(improved, damping / 3, damping * 4)
+
+        iterations += active
+        active &= ~(converged | stalled)
+        if not active.any():
+            break
+
+    return theta, iterations
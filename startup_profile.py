@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+import builtins
+import threading
+import time
+import sys
+import logging
+
+
+class StartupProfile:
+
+    """
+    Timings of the bot's startup: the steps Bot runs (imports of the
+    subsystems, DB setup, websocket handshake, ...) and the time from process
+    start to the first quote, which is checked against a budget.
+    With trace_imports (run.py --profile-startup) every first import of a
+    module is timed as well, cumulative including the modules it imports,
+    like python -X importtime.
+    """
+
+    def __init__(self, started=None, trace_imports=False, budget=10):
+        self.logger = logging.getLogger("deribit")
+        self.started = time.perf_counter() if started is None else started
+        self.budget = budget # seconds from process start to the first quote
+        self.steps = [] # (name, start offset, seconds, thread name)
+        self.imports = [] # (module, seconds, nesting depth) in completion order
+        self.first_quote = None
+        self.lock = threading.Lock()
+        self.original_import = None
+        if trace_imports:
+            self.trace_imports()
+
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.steps.append((name, start - self.started, time.perf_counter() - start,
+                                   threading.current_thread().name))
+
+
+    def trace_imports(self):
+        self.original_import = builtins.__import__
+        original = self.original_import
+        depth = threading.local()
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level > 0 or name in sys.modules:
+                return original(name, globals, locals, fromlist, level)
+            current = getattr(depth, "value", 0)
+            depth.value = current + 1
+            start = time.perf_counter()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                depth.value = current
+                with self.lock:
+                    self.imports.append((name, time.perf_counter() - start, current))
+
+        builtins.__import__ = timed_import
+
+
+    def stop_tracing(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+
+    def wait_for_first_quote(self, feed, shutdown=lambda: False, timeout=600):
+        """ Blocks until the feed has a first quote, then checks the budget (thread target) """
+        deadline = time.time() + timeout
+        while feed.last_futures_update is None and not feed.ob:
+            if shutdown() or time.time() > deadline:
+                return
+            time.sleep(0.01)
+        self.first_quote = time.perf_counter() - self.started
+        if self.first_quote > self.budget:
+            self.logger.warning("First quote {:.2f}s after start, over the startup budget "
+                                "of {}s.".format(self.first_quote, self.budget))
+        else:
+            self.logger.info("First quote {:.2f}s after start (budget {}s).".format(
+                self.first_quote, self.budget))
+
+
+    def report(self, min_import=0.005):
+        lines = ["Startup profile (seconds since process start):"]
+        for name, offset, seconds, thread in sorted(self.steps, key=lambda step: step[1]):
+            lines.append("  {:>7.3f} +{:>7.3f}  {:<28} [{}]".format(offset, seconds, name, thread))
+        if self.first_quote is not None:
+            lines.append("  {:>7.3f}           first quote (budget {}s)".format(
+                self.first_quote, self.budget))
+        if self.imports:
+            lines.append("Imports slower than {:.0f}ms (cumulative):".format(min_import * 1000))
+            for name, seconds, depth in self.imports:
+                if seconds >= min_import:
+                    lines.append("  {:>7.3f}  {}{}".format(seconds, "  " * depth, name))
+        return "\n".join(lines)
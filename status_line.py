@@ -0,0 +1,90 @@
+import shutil
+import sys
+import time
+import logging
+
+
+class StatusLine:
+
+    """
+    One line of live state for the CLI: best bid and offer and position of
+    the selected instrument, net delta (options plus hedge, in USD, as of
+    the hedger's last check), hedger state and feed lag. On a terminal it is
+    kept on the top row, which is excluded from scrolling, and redrawn with
+    the cursor saved and restored, so it never touches what is being typed.
+    Without a terminal it is not drawn; the CLI 'status' command prints it
+    on demand either way.
+    """
+
+    def __init__(self, feed, delta_hedger, input_parser, interval=1):
+        self.feed = feed
+        self.delta_hedger = delta_hedger
+        self.input_parser = input_parser
+        self.interval = interval
+        self.logger = logging.getLogger("deribit")
+        self.interactive = sys.stdout.isatty()
+        self.shutdown = False
+
+
+    def run(self):
+        if not self.interactive:
+            return
+        rows = shutil.get_terminal_size().lines
+        # scrolling region from the second row down, cursor to the bottom
+        sys.stdout.write("\x1b[2;{0}r\x1b[{0};1H".format(rows))
+        sys.stdout.flush()
+        while not self.shutdown:
+            try:
+                self.draw(self.text())
+            except Exception as e:
+                self.logger.debug("Status line skipped: {}".format(e))
+            time.sleep(self.interval)
+        self.restore()
+
+
+    def draw(self, text):
+        width = shutil.get_terminal_size().columns
+        sys.stdout.write("\x1b7\x1b[1;1H\x1b[2K{}\x1b8".format(text[:width]))
+        sys.stdout.flush()
+
+
+    def restore(self):
+        """ Gives the whole terminal back to scrolling """
+        sys.stdout.write("\x1b7\x1b[1;1H\x1b[2K\x1b[r\x1b8")
+        sys.stdout.flush()
+
+
+    def text(self):
+        instrument = self.input_parser.instrument
+        fields = []
+
+        if instrument in self.feed.futures_bbo:
+            bbo = self.feed.futures_bbo[instrument]
+            fields.append("{} {} / {}".format(instrument, bbo["bid"], bbo["ask"]))
+        else:
+            fields.append(instrument or "no instrument")
+
+        position = self.feed.positions.get(instrument)
+        fields.append("pos {}".format(position["size"] if position else 0))
+
+        # as of the last check of the instrument's currency's hedger, which 
+        # runs on the websocket thread, nothing is computed here
+        delta_hedger = self.input_parser.delta_hedger
+        if delta_hedger.delta_time is None:
+            fields.append("net delta n/a")
+        else:
+            fields.append("net delta ${:,.0f} ({:.0f}s ago)".format(
+                delta_hedger.op_delta + delta_hedger.btchedge_delta, 
+                time.time() - delta_hedger.delta_time))
+
+        fields.append("hedger {}".format("on" if delta_hedger.delta_hedging_activated
+                                         else "off"))
+
+        lag = self.feed.feed_lag()
+        if lag is None:
+            fields.append("no feed")
+        elif lag[0] is None:
+            fields.append("last update {:.1f}s ago".format(lag[1]))
+        else:
+            fields.append("lag {:.0f}ms, {:.1f}s ago".format(lag[0] * 1000, lag[1]))
+        return " | ".join(fields)
@@ -0,0 +1,134 @@
+from datetime import datetime
+import time
+import logging
+import numpy as np
+import pandas as pd
+import pytz
+
+from implied_volatility import implied_volatility
+from volatility_index import expiry_slice
+from vol_surface import expiration_from_code
+
+
+class StreamingSurface:
+
+    """
+    Keeps the in-memory volatility surface current between the minutely
+    snapshots. The data feed counts book updates per expiry; every interval
+    (e.g. 0.25 seconds) the expiries whose count changed since the last
+    cycle are the dirty ones. Only those are re-solved and re-interpolated
+    into a new ExpirySlice; clean expiries keep their previous slice.
+    All bursts of updates within one interval are coalesced into a single
+    rebuild per expiry, so the work follows what actually changed, not the
+    message rate. Every cycle with dirty expiries publishes a new surface
+    (VolSurface refresh and the BVIX grid in self.grid). One instance per
+    currency, that of its forward curve.
+    """
+
+    def __init__(self, feed, forward_curve, vol_surface, bvix, interval=0.25):
+        self.feed = feed
+        self.forward_curve = forward_curve
+        self.vol_surface = vol_surface
+        self.bvix = bvix
+        self.currency = forward_curve.currency
+        self.interval = interval
+        self.logger = logging.getLogger("deribit")
+
+        self.versions = dict() # expiry (e.g. 'BTC-30DEC22') -> update count at its last rebuild
+        self.slices = dict() # expiration -> ExpirySlice
+        self.grid = None # latest BVIX grid (DataFrame like obot.bvix without timestamp)
+        self.published = None
+        self.shutdown = False
+
+
+    def run(self):
+        while not self.shutdown:
+            start = time.time()
+            try:
+                self.update()
+            except Exception as e:
+                self.logger.info("Streaming surface update skipped: {}".format(e))
+            time.sleep(max(self.interval - (time.time() - start), 0))
+
+
+    def dirty_expiries(self):
+        versions = self.feed.expiry_versions.copy()
+        prefix = self.currency + "-"
+        dirty = [expiry for expiry, version in versions.items()
+                 if expiry.startswith(prefix) and self.versions.get(expiry) != version]
+        return dirty, versions
+
+
+    def update(self):
+
+        """ Rebuilds the dirty expiries and publishes, returns them """
+
+        dirty, versions = self.dirty_expiries()
+        if not dirty:
+            return dirty
+
+        now = datetime.now(pytz.UTC)
+        spot = self.forward_curve.spot()
+        for key in dirty:
+            code = key.split("-")[1]
+            expiration = pd.Timestamp(expiration_from_code(code))
+            ttmyears = (expiration - now).total_seconds() / (60*60*24*365)
+            if ttmyears <= 0:
+                self.slices.pop(expiration, None)
+                self.versions[key] = versions[key]
+                continue
+            expiry = self.rebuild(key, ttmyears, spot)
+            if expiry is None:
+                self.slices.pop(expiration, None)
+            else:
+                self.slices[expiration] = expiry
+            # only once rebuilt, an expiry that failed stays dirty and is retried
+            self.versions[key] = versions[key]
+
+        slices = dict(self.slices)
+        self.vol_surface.refresh(slices, now)
+        if slices:
+            self.grid = self.bvix.surface_from_slices(slices)
+        self.published = now
+        return dirty
+
+
+    def rebuild(self, key, ttmyears, spot):
+
+        """ One expiry's ExpirySlice from the live books, None without quotes """
+
+        code = key.split("-")[1]
+        books = self.feed.fetch_local_ob()
+        contracts = list(self.feed.expiry_contracts.get(key, ()))
+        strikes = []
+        is_call = []
+        bids = []
+        asks = []
+        for contract in contracts:
+            book = books.get(contract)
+            if book is None:
+                continue
+            bid_prices = list(book["bids"].keys())
+            ask_prices = list(book["asks"].keys())
+            strikes.append(float(contract.split("-")[2]))
+            is_call.append(contract[-1] == "C")
+            bids.append(max(bid_prices) if bid_prices else np.nan)
+            asks.append(min(ask_prices) if ask_prices else np.nan)
+        if not strikes:
+            return None
+
+        strikes = np.array(strikes)
+        is_call = np.array(is_call)
+        bids = np.array(bids)
+        asks = np.array(asks)
+        codes = [code] * len(strikes)
+
+        forward = self.forward_curve.compute(codes, strikes, is_call, bids, asks, spot)[code]
+        forwards = np.full(len(strikes), round(forward, 2))
+        ttm = np.full(len(strikes), round(ttmyears, 6))
+
+        # same conversions and rounding as the snapshots
+        bid_iv = implied_volatility((bids * forwards).round(2), forwards, strikes, ttm, is_call).round(4)
+        ask_iv = implied_volatility((asks * forwards).round(2), forwards, strikes, ttm, is_call).round(4)
+        return expiry_slice(bids, asks, bid_iv, ask_iv, strikes, forwards, is_call,
+                            ttm[0] * 365, self.bvix.log_moneyness_intervals)
@@ -0,0 +1,317 @@
+"""
+Synthetic Deribit traffic for benchmarks and the mock server: an option
+chain with a volatility smile over several expiries, dated futures and the
+perpetual, and the frames the exchange sends for them, as dicts in the
+shape WSClient and DataFeed read (json.dumps gives the wire format).
+
+    market = SyntheticDeribit(options=800)
+    market.instruments()             # public/get_instruments result
+    market.book_snapshot(name)       # book.<name>.raw snapshot
+    market.book_change()             # a random change on a random book
+    market.public_trades()           # trades.<kind>.<currency>.raw prints
+    market.stream(10000)             # mixed subscription traffic
+
+The books are tracked, so changes stay consistent: deleted levels exist,
+the best bid stays below the best ask, and the change ids are sequential
+per instrument.
+"""
+
+from datetime import datetime, timedelta
+import random
+import time
+import numpy as np
+import pytz
+
+from implied_volatility import black_price
+
+
+MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN",
+          "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+
+# subscription traffic mix of stream(), roughly as seen on a full BTC chain
+DEFAULT_MIX = {"book_change": 0.80, "futures_bbo": 0.08, "ticker": 0.08,
+               "tape": 0.02, "portfolio": 0.01, "trades": 0.01}
+
+
+def expiry_code(expiration):
+    """ datetime -> deribit expiry code, e.g. '2DEC22' (day without padding) """
+    return "{}{}{}".format(expiration.day, MONTHS[expiration.month - 1],
+                           expiration.strftime("%y"))
+
+
+def subscription(channel, data):
+    return {"jsonrpc": "2.0", "method": "subscription",
+            "params": {"channel": channel, "data": data}}
+
+
+class SyntheticDeribit:
+
+    """ One currency's instruments, books and account, see module docstring """
+
+    def __init__(self, options=800, expiry_days=(1, 2, 3, 7, 14, 21, 49, 77, 140, 231, 322),
+                 spot=20000., currency="BTC", levels=5, seed=0, now=None):
+        self.rng = random.Random(seed)
+        self.currency = currency
+        self.spot = float(spot)
+        self.levels = levels
+        self.tick = 0.0005
+        now = now or datetime.now(pytz.UTC)
+
+        today = datetime(now.year, now.month, now.day, 8, tzinfo=pytz.UTC)
+        self.expirations = dict() # code -> expiration
+        for days in expiry_days:
+            expiration = today + timedelta(days=days)
+            self.expirations[expiry_code(expiration)] = expiration
+
+        self.perpetual = "{}-PERPETUAL".format(currency)
+        self.futures = [self.perpetual] + ["{}-{}".format(currency, code)
+                                           for code in list(self.expirations)[2::2]]
+
+        # strikes per expiry widen with maturity, calls and puts on each
+        per_expiry = max(1, options // (2 * len(self.expirations)))
+        self.options = []
+        self.option_params = dict() # name -> (forward, strike, ttm, vol, is_call)
+        for code, expiration in self.expirations.items():
+            ttm = max((expiration - now).total_seconds(), 3600) / (60*60*24*365)
+            width = 0.15 + 0.6 * np.sqrt(ttm)
+            moneyness = np.linspace(-width, width, per_expiry)
+            strikes = sorted(set(int(round(self.spot * np.exp(k), -2)) for k in moneyness))
+            forward = self.spot * (1 + 0.03 * ttm)
+            for strike in strikes:
+                k = np.log(strike / forward)
+                vol = 0.55 + 0.35 * k ** 2 - 0.08 * k + 0.05 / np.sqrt(ttm + 0.02)
+                for typ in ["C", "P"]:
+                    name = "{}-{}-{}-{}".format(currency, code, strike, typ)
+                    self.options.append(name)
+                    self.option_params[name] = (forward, strike, ttm, vol, typ == "C")
+
+        self.books = dict() # name -> {"bids": {price: amount}, "asks": {...}}
+        self.change_ids = dict()
+        for name in self.options:
+            self.books[name] = self.option_book(name)
+            self.change_ids[name] = self.rng.randrange(10**9, 2 * 10**9)
+        self.futures_quotes = {name: self.future_mid(name) for name in self.futures}
+
+        self.positions = dict()
+        self.order_counter = 0
+
+
+    def future_mid(self, name):
+        code = name.split("-")[1]
+        if code in self.expirations:
+            ttm = (self.expirations[code] - datetime.now(pytz.UTC)).total_seconds() / (60*60*24*365)
+            return round(self.spot * (1 + 0.03 * max(ttm, 0)) * 2) / 2
+        return self.spot
+
+
+    def theoretical(self, name):
+        """ Option value in BTC """
+        forward, strike, ttm, vol, is_call = self.option_params[name]
+        price = black_price(np.array([forward]), np.array([float(strike)]), np.array([ttm]),
+                            np.array([vol]), np.array([is_call]))[0]
+        return price / self.spot
+
+
+    def option_book(self, name):
+        value = self.theoretical(name)
+        ticks = max(int(round(value / self.tick)), 1)
+        spread = max(1, ticks // 20)
+        bids = dict()
+        asks = dict()
+        for level in range(self.levels):
+            bid = (ticks - spread - level) * self.tick
+            if bid > 0:
+                bids[round(bid, 4)] = float(self.rng.randrange(1, 50))
+            asks[round((ticks + spread + level) * self.tick, 4)] = float(self.rng.randrange(1, 50))
+        return {"bids": bids, "asks": asks}
+
+
+    def timestamp(self):
+        return int(time.time() * 1000)
+
+
+    # replies to requests
+
+    def instruments(self):
+        result = []
+        for name in self.futures:
+            result.append({"instrument_name": name, "kind": "future",
+                           "settlement_period": "perpetual" if name == self.perpetual else "month"})
+        for name in self.options:
+            forward, strike, ttm, vol, is_call = self.option_params[name]
+            code = name.split("-")[1]
+            result.append({"instrument_name": name, "kind": "option", "strike": strike,
+                           "option_type": "call" if is_call else "put",
+                           "expiration_timestamp": int(self.expirations[code].timestamp() * 1000),
+                           "tick_size": self.tick, "min_trade_amount": 0.1})
+        return result
+
+
+    def open_position(self, name, size):
+        """ Adds an account position (in contracts, negative for short) """
+        mark = self.theoretical(name) if name in self.option_params else self.futures_quotes[name]
+        self.positions[name] = {"instrument_name": name, "size": size,
+                                "direction": "buy" if size > 0 else "sell",
+                                "average_price": round(mark, 4), "mark_price": round(mark, 4),
+                                "delta": 0, "total_profit_loss": 0.0,
+                                "kind": "option" if name in self.option_params else "future"}
+        return self.positions[name]
+
+
+    def order(self, name, direction, amount, price, label="", order_type="limit",
+              state="open", filled=0):
+        self.order_counter += 1
+        return {"instrument_name": name, "order_id": "{}-{}".format(self.currency, self.order_counter),
+                "order_type": order_type, "order_state": state, "direction": direction,
+                "amount": amount, "filled_amount": filled, "max_show": amount,
+                "price": price, "label": label, "post_only": order_type == "limit",
+                "reduce_only": False, "time_in_force": "good_til_cancelled",
+                "creation_timestamp": self.timestamp(), "last_update_timestamp": self.timestamp()}
+
+
+    # subscription frames
+
+    def book_snapshot(self, name):
+        book = self.books[name]
+        return subscription("book.{}.raw".format(name), {
+            "type": "snapshot", "instrument_name": name, "timestamp": self.timestamp(),
+            "change_id": self.change_ids[name],
+            "bids": [["new", price, amount] for price, amount in sorted(book["bids"].items(), reverse=True)],
+            "asks": [["new", price, amount] for price, amount in sorted(book["asks"].items())]})
+
+
+    def book_change(self, name=None):
+        if name is None:
+            name = self.rng.choice(self.options)
+        book = self.books[name]
+        side = self.rng.choice(["bids", "asks"])
+        levels = book[side]
+        roll = self.rng.random()
+        if roll < 0.2 and len(levels) > 1:
+            price = self.rng.choice(list(levels))
+            del levels[price]
+            entry = ["delete", price, 0.0]
+        elif roll < 0.4 or not levels:
+            # a new level next to the outermost one, which never crosses
+            if side == "bids":
+                price = round(min(levels) - self.tick, 4) if levels else self.tick
+            else:
+                price = round(max(levels) + self.tick, 4) if levels else 10 * self.tick
+            if price <= 0 or price in levels:
+                price = self.rng.choice(list(levels)) if levels else self.tick
+            levels[price] = float(self.rng.randrange(1, 50))
+            entry = ["new", price, levels[price]]
+        else:
+            price = self.rng.choice(list(levels))
+            levels[price] = float(self.rng.randrange(1, 50))
+            entry = ["change", price, levels[price]]
+
+        previous = self.change_ids[name]
+        self.change_ids[name] = previous + 1
+        data = {"type": "change", "instrument_name": name, "timestamp": self.timestamp(),
+                "prev_change_id": previous, "change_id": previous + 1, "bids": [], "asks": []}
+        data[side].append(entry)
+        return subscription("book.{}.raw".format(name), data)
+
+
+    def futures_bbo(self, name=None):
+        if name is None:
+            name = self.rng.choice(self.futures)
+        mid = self.futures_quotes[name] + self.rng.choice([-1, -0.5, 0, 0.5, 1])
+        self.futures_quotes[name] = mid
+        return subscription("book.{}.none.1.100ms".format(name), {
+            "instrument_name": name, "timestamp": self.timestamp(),
+            "change_id": self.rng.randrange(10**9),
+            "bids": [[mid - 0.5, float(self.rng.randrange(1000, 100000))]],
+            "asks": [[mid + 0.5, float(self.rng.randrange(1000, 100000))]]})
+
+
+    def ticker(self, name=None):
+        if name is None:
+            name = self.rng.choice(self.options)
+        book = self.books[name]
+        forward, strike, ttm, vol, is_call = self.option_params[name]
+        return subscription("ticker.{}.raw".format(name), {
+            "instrument_name": name, "timestamp": self.timestamp(),
+            "open_interest": float(self.rng.randrange(0, 2000)),
+            "mark_price": round(self.theoretical(name), 4), "mark_iv": round(vol * 100, 2),
+            "underlying_price": forward, "index_price": self.spot,
+            "best_bid_price": max(book["bids"]) if book["bids"] else 0,
+            "best_ask_price": min(book["asks"]) if book["asks"] else 0,
+            "state": "open"})
+
+
+    def public_trades(self, name=None, direction=None, amount=None, price=None):
+        """ Prints on the tape, by default one to three at the touch of a random instrument """
+        if name is None:
+            name = self.rng.choice(self.options if self.rng.random() < 0.5 else self.futures)
+        option = name in self.books
+        prints = []
+        for _ in range(1 if price is not None else self.rng.randint(1, 3)):
+            side = direction or self.rng.choice(["buy", "sell"])
+            if price is not None:
+                fill = price
+            elif option:
+                levels = self.books[name]["asks" if side == "buy" else "bids"]
+                fill = (min(levels) if side == "buy" else max(levels)) if levels else self.tick
+            else:
+                fill = self.futures_quotes[name] + (0.5 if side == "buy" else -0.5)
+            trade = {"instrument_name": name, "direction": side, "price": fill,
+                     "amount": amount or (float(self.rng.randrange(1, 20)) / 10 if option
+                                          else float(self.rng.randrange(1, 50)) * 10),
+                     "trade_id": str(self.rng.randrange(10**9)),
+                     "trade_seq": self.rng.randrange(10**6), "timestamp": self.timestamp(),
+                     "tick_direction": self.rng.randrange(4), "index_price": self.spot}
+            if option:
+                trade["iv"] = round(self.option_params[name][3] * 100, 2)
+            prints.append(trade)
+        return subscription("trades.{}.{}.raw".format("option" if option else "future",
+                                                      self.currency), prints)
+
+
+    def portfolio(self):
+        balance = 10 + self.rng.random()
+        return subscription("user.portfolio.{}".format(self.currency.lower()), {
+            "currency": self.currency, "available_funds": balance * 0.8, "balance": balance,
+            "delta_total": self.rng.uniform(-1, 1), "initial_margin": balance * 0.15,
+            "maintenance_margin": balance * 0.1, "margin_balance": balance,
+            "equity": balance, "total_pl": 0.0})
+
+
+    def trades(self, name=None, direction=None, amount=None, price=None):
+        if name is None:
+            name = self.rng.choice(list(self.positions) or self.futures)
+        if direction is None:
+            direction = self.rng.choice(["buy", "sell"])
+        if amount is None:
+            amount = 10.0 if name in self.futures else 0.1
+        if price is None:
+            price = self.futures_quotes[name] if name in self.futures else round(self.theoretical(name), 4)
+        return subscription("user.trades.any.any.raw", [{
+            "instrument_name": name, "direction": direction, "amount": amount, "price": price,
+            "trade_id": str(self.rng.randrange(10**9)), "timestamp": self.timestamp(),
+            "order_type": "market", "label": ""}])
+
+
+    def order_update(self, order):
+        return subscription("user.orders.any.any.raw", order)
+
+
+    def initial_frames(self):
+        """ A snapshot for every book, a bbo for every future and a ticker for every option """
+        frames = [self.futures_bbo(name) for name in self.futures]
+        frames += [self.book_snapshot(name) for name in self.options]
+        frames += [self.ticker(name) for name in self.options]
+        return frames
+
+
+    def stream(self, count, mix=None):
+        """ count subscription frames, message types drawn by the mix weights """
+        mix = mix or DEFAULT_MIX
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        makers = {"book_change": self.book_change, "futures_bbo": self.futures_bbo,
+                  "ticker": self.ticker, "tape": self.public_trades, "portfolio": self.portfolio,
+                  "trades": self.trades}
+        for kind in self.rng.choices(kinds, weights, k=count):
+            yield makers[kind]()
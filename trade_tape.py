@@ -0,0 +1,170 @@
+"""
+The public trades (tape) of options and futures. Each instrument's trades
+go into a ring buffer of preallocated arrays: price, amount, side (+1 taker
+buy, -1 taker sell), iv (options, nan for futures) and exchange timestamp
+in ms. A full buffer overwrites its oldest trade, so memory stays the same
+however long the session runs. Buffers are created on an instrument's first
+trade and dropped with the instrument (e.g. after expiry).
+
+Per instrument, volume, VWAP and signed flow (taker buys minus sells) over
+the last 'window' seconds are kept up to date as trades come in: a trade is
+added once and subtracted once when it leaves the window or is overwritten,
+no buffer is ever rescanned. Amounts are in the instrument's unit (options
+in coin, futures in USD).
+
+    tape = TradeTape(window=300)
+    tape.add_trades(data)           # data of a trades.<kind>.<currency>.raw message
+    tape.rolling("BTC-PERPETUAL")   # {"trades", "volume", "vwap", "flow"}
+    tape.recent("BTC-PERPETUAL")    # the trades held, oldest first
+"""
+
+from array import array
+import math
+import threading
+
+
+SIDES = {"buy": 1, "sell": -1}
+
+
+class TradeBuffer:
+
+    """ One instrument's trades and rolling sums, see module docstring """
+
+    __slots__ = ("capacity", "price", "amount", "side", "iv", "timestamp",
+                 "count", "first", "volume", "notional", "flow")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.price = array("d", bytes(8 * capacity))
+        self.amount = array("d", bytes(8 * capacity))
+        self.side = array("b", bytes(capacity))
+        self.iv = array("d", bytes(8 * capacity))
+        self.timestamp = array("q", bytes(8 * capacity))
+        self.count = 0 # trades added so far, the next one goes to count % capacity
+        self.first = 0 # the oldest trade (by count) still in the window
+        self.volume = 0.
+        self.notional = 0.
+        self.flow = 0.
+
+
+    def add(self, timestamp, price, amount, side, iv, cutoff):
+        if self.count - self.first == self.capacity:
+            self.drop() # about to be overwritten
+        i = self.count % self.capacity
+        self.price[i] = price
+        self.amount[i] = amount
+        self.side[i] = side
+        self.iv[i] = iv
+        self.timestamp[i] = timestamp
+        self.count += 1
+        self.volume += amount
+        self.notional += price * amount
+        self.flow += side * amount
+        self.expire(cutoff)
+
+
+    def drop(self):
+        i = self.first % self.capacity
+        amount = self.amount[i]
+        self.volume -= amount
+        self.notional -= self.price[i] * amount
+        self.flow -= self.side[i] * amount
+        self.first += 1
+        if self.first == self.count:
+            # empty window, no rounding residue carried on
+            self.volume = self.notional = self.flow = 0.
+
+
+    def expire(self, cutoff):
+        while self.first < self.count and self.timestamp[self.first % self.capacity] < cutoff:
+            self.drop()
+
+
+    def held(self):
+        return min(self.count, self.capacity)
+
+
+    def ordered(self, column, count):
+        """ The last count values of a column, oldest first """
+        if count <= 0:
+            return []
+        if self.count <= self.capacity:
+            return column[max(self.count - count, 0):self.count].tolist()
+        end = self.count % self.capacity
+        values = column[end:].tolist() + column[:end].tolist()
+        return values[-count:]
+
+
+
+class TradeTape:
+
+    """
+    Trades per instrument, see module docstring. Written on the websocket
+    thread, a lock keeps readers on other threads consistent (taken once per
+    trades message, which is rare next to the book updates).
+    """
+
+    def __init__(self, window=300, options_capacity=256, futures_capacity=4096):
+        self.window_ms = int(window * 1000)
+        self.options_capacity = options_capacity
+        self.futures_capacity = futures_capacity
+        self.buffers = dict() # instrument -> TradeBuffer
+        self.last_timestamp = 0 # exchange time of the latest trade, in ms
+        self.lock = threading.Lock()
+
+
+    def add_trades(self, data):
+        with self.lock:
+            for trade in data:
+                name = trade["instrument_name"]
+                buffer = self.buffers.get(name)
+                if buffer is None:
+                    option = name.count("-") == 3
+                    buffer = TradeBuffer(self.options_capacity if option else self.futures_capacity)
+                    self.buffers[name] = buffer
+                timestamp = trade["timestamp"]
+                if timestamp > self.last_timestamp:
+                    self.last_timestamp = timestamp
+                buffer.add(timestamp, trade["price"], trade["amount"],
+                           SIDES.get(trade["direction"], 0), trade.get("iv", math.nan),
+                           timestamp - self.window_ms)
+
+
+    def remove(self, instrument):
+        with self.lock:
+            self.buffers.pop(instrument, None)
+
+
+    def instruments(self):
+        return list(self.buffers)
+
+
+    def rolling(self, instrument, now=None):
+        """
+        Trades, volume, VWAP and signed flow of the instrument over the window
+        up to now (exchange time in ms, by default the latest trade of any
+        instrument), None if it has not traded.
+        """
+        with self.lock:
+            buffer = self.buffers.get(instrument)
+            if buffer is None:
+                return None
+            buffer.expire((now or self.last_timestamp) - self.window_ms)
+            return {"trades": buffer.count - buffer.first,
+                    "volume": buffer.volume,
+                    "vwap": buffer.notional / buffer.volume if buffer.volume > 0 else math.nan,
+                    "flow": buffer.flow}
+
+
+    def recent(self, instrument, count=None):
+        """ The instrument's last count trades held (all by default) as columns, oldest first """
+        with self.lock:
+            buffer = self.buffers.get(instrument)
+            if buffer is None:
+                return None
+            count = buffer.held() if count is None else min(count, buffer.held())
+            return {"timestamp": buffer.ordered(buffer.timestamp, count),
+                    "price": buffer.ordered(buffer.price, count),
+                    "amount": buffer.ordered(buffer.amount, count),
+                    "side": buffer.ordered(buffer.side, count),
+                    "iv": buffer.ordered(buffer.iv, count)}
@@ -0,0 +1,172 @@
+from collections import namedtuple
+from datetime import datetime
+import time
+import logging
+import numpy as np
+import pytz
+
+
+# Everything a query needs, built once per refresh and never modified after.
+# Expirations are unix seconds (sorted), moneyness/total_variance hold one
+# sorted array per expiration.
+SurfaceState = namedtuple("SurfaceState", ["timestamp", "expirations", "forwards",
+                                           "moneyness", "total_variance"])
+
+SECONDS_PER_YEAR = 60*60*24*365
+
+
+class VolSurface:
+
+    """
+    In-memory implied volatility surface built from the same per expiry
+    slices as the BVIX (strike level mid ivs against each expiry's forward).
+
+    A refresh builds a new, immutable SurfaceState and swaps the reference
+    in one assignment. Readers (hedger, CLI) take the reference once per
+    query, so they always see one complete build without any locking, even
+    while the snapshot thread refreshes.
+
+    Queries at arbitrary strikes and expirations are answered by binary
+    search plus linear interpolation:
+        - within an expiry, total variance is interpolated in log moneyness
+          (flat beyond the outermost quoted strikes)
+        - between expiries, total variance is interpolated in time at
+          constant log moneyness against the interpolated forward
+        - before the first and after the last expiry, the iv is held flat
+    """
+
+    def __init__(self, max_age=180):
+        self.logger = logging.getLogger("deribit")
+        self.max_age = max_age # seconds after which consumers should not rely on the surface
+        self.state = None
+
+
+    def refresh(self, slices, ts):
+
+        """
+        slices: {expiration: ExpirySlice} of one snapshot, ts its timestamp.
+        Expiries without any valid iv are left out.
+        """
+
+        import pandas as pd # refreshes come from the snapshot modules, which load it anyway
+        rows = []
+        for expiration, expiry in slices.items():
+            has_iv = ~np.isnan(expiry.strike_iv)
+            if not has_iv.any() or expiry.ttmdays <= 0 or np.isnan(expiry.forward):
+                continue
+            ttm = expiry.ttmdays / 365
+            rows.append((pd.Timestamp(expiration).timestamp(), expiry.forward,
+                         expiry.strike_moneyness[has_iv],
+                         expiry.strike_iv[has_iv] ** 2 * ttm))
+        rows.sort(key=lambda row: row[0])
+
+        self.state = SurfaceState(timestamp=pd.Timestamp(ts).timestamp(),
+                                  expirations=np.array([row[0] for row in rows]),
+                                  forwards=np.array([row[1] for row in rows]),
+                                  moneyness=tuple(row[2] for row in rows),
+                                  total_variance=tuple(row[3] for row in rows))
+
+
+    def age(self):
+        if self.state is None:
+            return np.inf
+        return time.time() - self.state.timestamp
+
+
+    def available(self):
+        state = self.state
+        return (state is not None and len(state.expirations) > 0
+                and self.age() <= self.max_age)
+
+
+    def implied_volatility(self, strikes, expirations, now=None):
+
+        """
+        Bulk query: arrays (or scalars) of strikes and expirations (datetimes,
+        pandas timestamps or date strings), broadcast against each other.
+        Returns an array of ivs, NaN for expired contracts or an empty surface.
+        """
+
+        state = self.state
+        strikes = np.atleast_1d(np.asarray(strikes, dtype=float))
+        expirations = to_seconds(expirations)
+        strikes, expirations = np.broadcast_arrays(strikes, expirations)
+        ivs = np.full(strikes.shape, np.nan)
+        if state is None or len(state.expirations) == 0:
+            return ivs
+
+        if now is None:
+            now = time.time()
+        ttm = (expirations - now) / SECONDS_PER_YEAR
+        ttm_nodes = (state.expirations - now) / SECONDS_PER_YEAR
+
+        # bracketing expiries; outside the covered range both are the outermost one
+        right = np.searchsorted(state.expirations, expirations)
+        left = np.clip(right - 1, 0, len(ttm_nodes) - 1)
+        right = np.clip(right, 0, len(ttm_nodes) - 1)
+
+        span = ttm_nodes[right] - ttm_nodes[left]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(span > 0, (ttm - ttm_nodes[left]) / span, 0.)
+        forward = state.forwards[left] + weight * (state.forwards[right] - state.forwards[left])
+        moneyness = np.log(strikes / forward)
+
+        left_variance = np.empty(strikes.shape)
+        right_variance = np.empty(strikes.shape)
+        for node in np.unique(np.r_[left, right]):
+            for bracket, variance in [(left, left_variance), (right, right_variance)]:
+                rows = bracket == node
+                variance[rows] = np.interp(moneyness[rows], state.moneyness[node],
+                                           state.total_variance[node])
+
+        total_variance = left_variance + weight * (right_variance - left_variance)
+
+        # flat iv before the first and after the last expiry
+        first = ttm < ttm_nodes[0]
+        total_variance[first] = left_variance[first] * ttm[first] / ttm_nodes[0]
+        last = ttm > ttm_nodes[-1]
+        total_variance[last] = right_variance[last] * ttm[last] / ttm_nodes[-1]
+
+        valid = (ttm > 0) & (total_variance >= 0)
+        ivs[valid] = np.sqrt(total_variance[valid] / ttm[valid])
+        return ivs
+
+
+    def iv(self, strike, expiration, now=None):
+        """ Single strike and expiration, returns a float (NaN if unavailable) """
+        return float(self.implied_volatility(strike, expiration, now)[0])
+
+
+    def expiry_summary(self, now=None):
+        """ Forward and at-the-forward iv per expiry of the current build """
+        state = self.state
+        if state is None:
+            return []
+        if now is None:
+            now = time.time()
+        summary = []
+        for i in range(len(state.expirations)):
+            ttm = (state.expirations[i] - now) / SECONDS_PER_YEAR
+            if ttm <= 0:
+                continue
+            variance = np.interp(0., state.moneyness[i], state.total_variance[i])
+            summary.append([datetime.fromtimestamp(state.expirations[i], pytz.UTC),
+                            round(state.forwards[i], 2), round(float(np.sqrt(variance / ttm)), 4)])
+        return summary
+
+
+
+def to_seconds(expirations):
+    """ Datetime like scalar or array -> unix seconds (naive values are UTC) """
+    if isinstance(expirations, datetime):
+        if expirations.tzinfo is None:
+            expirations = expirations.replace(tzinfo=pytz.UTC)
+        return np.array([expirations.timestamp()])
+    import pandas as pd
+    index = pd.DatetimeIndex(pd.to_datetime(np.atleast_1d(expirations), utc=True))
+    return index.asi8 / 1e9
+
+
+def expiration_from_code(code):
+    """ Deribit expiry code (e.g. '30DEC22') -> expiration at 08:00 UTC """
+    return datetime.strptime(code.upper(), "%d%b%y").replace(hour=8, tzinfo=pytz.UTC)
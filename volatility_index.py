@@ -4,154 +4,242 @@ from datetime import datetime
 import pytz
 import warnings
 import logging
+import time
+from collections import namedtuple
+from smile_fit import SmileFitter
+import database
+from profiling import timed, measure
 warnings.filterwarnings("ignore")
 
 
+# One expiry's interpolated slice on the log moneyness grid, plus the strike
+# level quotes and forward it was built from (used for the parametric smile
+# fit and the in-memory surface)
+ExpirySlice = namedtuple("ExpirySlice", ["ttmdays", "grid_iv", "strike_moneyness", "strike_iv",
+                                         "forward"])
+
+
 class BVIX:
     
-    def __init__(self, db_connection):
+    """
+    Builds a constant maturity, constant log moneyness implied volatility
+    surface from the top of the book snapshot of all options contracts.
+    
+    The build is split into two steps so the first one can run per expiry,
+    e.g. in worker processes (see analytics_pool.py):
+        1. each expiry's quotes are cleaned, reduced to one mid iv per strike
+           and linearly interpolated onto the log moneyness grid (a 'slice')
+        2. the slices are linearly interpolated across maturities onto the
+           constant maturity grid
+    Points outside the range of available quotes are left empty (NaN).
+    The grids are class attributes so tools without a live connection 
+    (e.g. bvix_backfill.py) build exactly the same surface.
+    """
+    
+    days_til_maturity = [3, 7, 10, 14, 17, 21, 24, 28, 31, 35, 38, 
+                         42, 45, 49, 52, 56, 84]
+    
+    moneyness_intervals = [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 
+                           0.95, 0.96, 0.97, 0.98, 0.99, 1, 1.01, 
+                           1.02, 1.03, 1.04, 1.05, 1.1, 1.15, 1.2, 
+                           1.3, 1.4, 1.5, 1.6, 1.7]
+    
+    log_moneyness_intervals = [i-1 for i in moneyness_intervals]
+    
+    def __init__(self, db_connection, vol_surface=None, currency="BTC"):
         
         self.logger = logging.getLogger("deribit")
         self.schema = "obot"
-        self.table = "bvix"
+        self.table = database.currency_table("bvix", currency) # bvix_eth etc. for other currencies
         self.c = db_connection["c"]
         self.conn = db_connection["conn"]
         self.engine = db_connection["engine"]
         
-        self.days_til_maturity = [3, 7, 10, 14, 17, 21, 24, 28, 31, 35, 38, 
-                                  42, 45, 49, 52, 56, 84]
-        
-        self.moneyness_intervals = [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 
-                                    0.95, 0.96, 0.97, 0.98, 0.99, 1, 1.01, 
-                                    1.02, 1.03, 1.04, 1.05, 1.1, 1.15, 1.2, 
-                                    1.3, 1.4, 1.5, 1.6, 1.7]
-        
-        self.log_moneyness_intervals = [i-1 for i in self.moneyness_intervals]
         self.prepare_db()
         
+        self.smile_fitter = SmileFitter(db_connection, currency=currency)
+        self.vol_surface = vol_surface # in-memory surface refreshed with every build
+        self.last_durations = dict() # seconds of the last build per stage (read by metrics)
+        
     def prepare_db(self):
         self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
         self.conn.commit()
         
-        string = "CREATE TABLE IF NOT EXISTS {}.{}".format(self.schema, self.table)
-        string = string + "(timestamp TIMESTAMPTZ, moneyness NUMERIC, "
-        for i in self.days_til_maturity:
-            string += "d" + str(i) + " NUMERIC, "
-        string = string[:-2] + ")"
-        self.c.execute(string)
+        self.c.execute(bvix_table_sql(self.schema, self.table, self.days_til_maturity))
         self.conn.commit()
         
         
-    def create_volsurf_snapshot(self, df):
-        try:
-            df = df.astype({"btcusd_price":float, "strike":float, "ttmyears":float, 
-                            "bid":float, "bid_size":float, "bid_usd":float, "bid_iv":float, 
-                            "ask":float, "ask_size":float, "ask_usd":float, "ask_iv":float, 
-                            "typ":str})
-            
-            df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
-            df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
-            df["ttmdays"] = df["ttmyears"] * 365
+    @timed
+    def create_volsurf_snapshot(self, df, slices=None):
         
-            df["moneyness"] = (np.log(df["strike"] / df["btcusd_price"]))
-            df["mid_iv"] = (df["bid_iv"] + df["ask_iv"]) / 2
+        """
+        df is the options snapshot from SaveBBO. If the per expiry slices
+        were already computed elsewhere (analytics pool), they are passed
+        as {expiration: ExpirySlice} and only the term interpolation and
+        the smile fit are done here.
+        """
         
-            df["ask"].loc[df["ask"] >= 0.6] = 0
-            df["bid"].loc[df["bid"] >= 0.6] = 0
-            df = df[df["ask"] != 0.0005]
-            
-            df["bid"].fillna(0, inplace=True)
-            df["ask"].fillna(0, inplace=True)
-            
-            df["bid_usd"].loc[df["bid"] == 0] = 0
-            df["ask_usd"].loc[df["ask"] == 0] = 0
-            df["bid_iv"].loc[df["bid"] == 0] = 0
-            df["ask_iv"].loc[df["ask"] == 0] = 0
-            df["bid_size"].loc[df["bid"] == 0] = 0
-            df["ask_size"].loc[df["ask"] == 0] = 0
-            
-            df = df[(df["bid"] > 0) | (df["ask"] > 0)]
-            df = df[(df["bid_iv"] > 0) | (df["ask_iv"] > 0)]
-            
-            itm_max = np.log(1.1)
-            
-            df = df[((df["moneyness"] < itm_max) & (df["typ"] == "P")) | 
-                    ((df["moneyness"] > -1*itm_max) & (df["typ"] == "C"))]
-            
-            df["mid_iv"].loc[(df["ask_iv"] > 0) & (df["bid_iv"] == 0)] = df["ask_iv"]
-            df["mid_iv"].loc[(df["bid_iv"] > 0) & (df["ask_iv"] == 0)] = df["bid_iv"]
-            
-            df["contract"] = df["expiration"].dt.date.astype(str) + df["strike"].astype(str) + df["typ"]
-            
-            df_grouped = df.groupby(["strike", "expiration"], 
-                                    as_index=False).agg({"ttmdays":"first", 
-                                                         "moneyness":"first", 
-                                                         "mid_iv":"mean"})
-            
-            df_grouped.sort_values(by=["ttmdays", "moneyness"], ascending=True, inplace=True)
-            df_grouped.drop(["strike", "expiration"], axis=1, inplace=True)
-            
-            
-            unique_ttms = df_grouped["ttmdays"].unique()
-            
-            df_atm_intervals = pd.DataFrame()
-            
-            for ttm in unique_ttms:
-                df2 = df_grouped[df_grouped["ttmdays"] == ttm]
-                df_moneyness = pd.DataFrame(self.log_moneyness_intervals, columns=["moneyness"])
-                df2 = df2.merge(df_moneyness, on="moneyness", how="outer").replace([np.inf, -np.inf], 0)
-                df2["ttmdays"].fillna(method="ffill", inplace=True)
-                df2["ttmdays"].fillna(method="bfill", inplace=True)
-                df2 = df2.sort_values(by="moneyness", ascending=True).set_index("moneyness")
-                df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0).reset_index()
-                df_atm_intervals = df_atm_intervals.append(df2)
-            
-            
-            ttm_atm_combinations = []
-            
-            for i in self.days_til_maturity:
-                for m in self.log_moneyness_intervals:
-                    ttm_atm_combinations.append([i, m])
-            
-            dfy = pd.DataFrame(ttm_atm_combinations, columns=["ttmdays", "moneyness"])
-            
-            df_atm_intervals = df_atm_intervals[df_atm_intervals["moneyness"].isin(self.log_moneyness_intervals)]
-            df_atm_intervals = df_atm_intervals.append(dfy)
-            
-            
-            unique_atms = df_atm_intervals["moneyness"].unique()
-            
-            df_ttm_intervals = pd.DataFrame()
-            
-            for m in unique_atms:
-                df2 = df_atm_intervals[df_atm_intervals["moneyness"] == m]
-                df2.set_index("ttmdays", inplace=True)
-                df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0)
-                df2.reset_index(inplace=True)
-                df_ttm_intervals = df_ttm_intervals.append(df2)
-                
-            df_ttm_intervals = df_ttm_intervals[df_ttm_intervals["ttmdays"].isin(self.days_til_maturity)]
-            df_ttm_intervals["moneyness"] = round(np.exp(df_ttm_intervals["moneyness"]), 3)
-            df_ttm_intervals["ttmdays"] = df_ttm_intervals["ttmdays"].astype(int)
-            
-            
-            df_atm_ttm = df_ttm_intervals.pivot(index="moneyness", columns="ttmdays", values="mid_iv")
-            df_atm_ttm.reset_index(inplace=True)
-            df_atm_ttm = df_atm_ttm.round(decimals=4)
+        start = time.perf_counter()
+        ts = datetime.now(pytz.UTC)
+        ts = ts.replace(microsecond=0)
+        
+        try:
+            if slices is None:
+                with measure("BVIX.build slices"):
+                    slices = self.build_slices(df)
             
-            db_columns = ["moneyness"]
-            for i in self.days_til_maturity:
-                db_columns.append("d" + str(i))
-            df_atm_ttm.columns = db_columns
-            ts = datetime.now(pytz.UTC)
-            ts = ts.replace(microsecond=0)
+            if self.vol_surface is not None:
+                self.vol_surface.refresh(slices, ts)
+        
+            df_atm_ttm = self.surface_from_slices(slices)
             df_atm_ttm["timestamp"] = ts
             df_atm_ttm["timestamp"] = pd.to_datetime(df_atm_ttm["timestamp"], utc=True)
         
-            df_atm_ttm.to_sql("bvix", con=self.engine, schema="obot", 
-                              if_exists='append', index=False, chunksize=10000)            
+            write_start = time.perf_counter()
+            with measure("BVIX.bvix write"):
+                df_atm_ttm.to_sql(self.table, con=self.engine, schema=self.schema,
+                                  if_exists='append', index=False, chunksize=10000)
+            self.last_durations["bvix_write"] = time.perf_counter() - write_start
         except Exception as e:
             self.logger.info("Error writing volatility surface to database: {}".format(e))
+        
+        if slices is not None:
+            try:
+                with measure("BVIX.smile fit"):
+                    self.smile_fitter.store(self.smile_fitter.fit_surface(slices), ts)
+            except Exception as e:
+                self.logger.info("Error fitting or storing SVI parameters: {}".format(e))
+        self.last_durations["bvix_build"] = time.perf_counter() - start
+        
+        
+    def build_slices(self, df):
+        return build_slices(df, self.log_moneyness_intervals)
+        
+        
+    def surface_from_slices(self, slices):
+        return surface_frame(slices, self.log_moneyness_intervals, self.days_til_maturity)
+
+
+def bvix_table_sql(schema, table, days_til_maturity):
+    string = "CREATE TABLE IF NOT EXISTS {}.{}".format(schema, table)
+    string = string + "(timestamp TIMESTAMPTZ, moneyness NUMERIC, "
+    for i in days_til_maturity:
+        string += "d" + str(i) + " NUMERIC, "
+    return string[:-2] + ")"
+
+
+def build_slices(df, grid):
+    
+    """
+    Per expiry slices {expiration: ExpirySlice} of one options snapshot
+    (columns as in obot.derbbo).
+    """
+    
+    expirations = pd.to_datetime(df["expiration"], utc=True)
+    # moneyness is measured against each expiry's forward when available
+    underlying = "forward" if "forward" in df.columns else "btcusd_price"
+    slices = dict()
+    for expiration, rows in df.groupby(expirations).indices.items():
+        part = df.iloc[rows]
+        slices[expiration] = expiry_slice(part["bid"].to_numpy(dtype=float),
+                                          part["ask"].to_numpy(dtype=float),
+                                          part["bid_iv"].to_numpy(dtype=float),
+                                          part["ask_iv"].to_numpy(dtype=float),
+                                          part["strike"].to_numpy(dtype=float),
+                                          part[underlying].to_numpy(dtype=float),
+                                          (part["typ"] == "C").to_numpy(),
+                                          float(part["ttmyears"].iloc[0]) * 365,
+                                          grid)
+    return slices
+
+
+def surface_frame(slices, grid, days_til_maturity):
+    """ The rows written to obot.bvix for one timestamp (without the timestamp) """
+    surface = term_structure(slices, days_til_maturity)
+    
+    df_atm_ttm = pd.DataFrame(surface, columns=["d" + str(i) for i in days_til_maturity])
+    df_atm_ttm.insert(0, "moneyness", np.round(np.exp(grid), 3))
+    df_atm_ttm = df_atm_ttm.sort_values(by="moneyness").reset_index(drop=True)
+    return df_atm_ttm.round(decimals=4)
 
+
+def strike_quotes(bid, ask, bid_iv, ask_iv, strike, underlying, is_call):
+    
+    """
+    Cleans one expiry's quotes and reduces them to one mid iv per strike
+    (calls and puts averaged). Returns sorted log moneyness and mid iv arrays.
+    Quotes at 0.6 BTC or above, asks at the minimum tick, in-the-money
+    options (beyond 10%) and quotes without a valid iv are discarded.
+    """
+    
+    moneyness = np.log(strike / underlying)
+    mid_iv = (bid_iv + ask_iv) / 2
+    
+    bid = np.where(bid >= 0.6, 0, bid)
+    ask = np.where(ask >= 0.6, 0, ask)
+    keep = ask != 0.0005
+    
+    bid = np.nan_to_num(bid, nan=0)
+    ask = np.nan_to_num(ask, nan=0)
+    bid_iv = np.where(bid == 0, 0, bid_iv)
+    ask_iv = np.where(ask == 0, 0, ask_iv)
+    
+    keep &= (bid > 0) | (ask > 0)
+    keep &= (bid_iv > 0) | (ask_iv > 0)
+    
+    itm_max = np.log(1.1)
+    keep &= ((moneyness < itm_max) & ~is_call) | ((moneyness > -1*itm_max) & is_call)
+    
+    mid_iv = np.where((ask_iv > 0) & (bid_iv == 0), ask_iv, mid_iv)
+    mid_iv = np.where((bid_iv > 0) & (ask_iv == 0), bid_iv, mid_iv)
+    
+    strikes, first, inverse = np.unique(strike[keep], return_index=True, return_inverse=True)
+    mid_iv = mid_iv[keep]
+    has_iv = ~np.isnan(mid_iv)
+    iv_sum = np.bincount(inverse[has_iv], weights=mid_iv[has_iv], minlength=len(strikes))
+    iv_count = np.bincount(inverse[has_iv], minlength=len(strikes))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        strike_iv = iv_sum / iv_count
+    
+    strike_moneyness = moneyness[keep][first]
+    order = np.argsort(strike_moneyness, kind="stable")
+    return strike_moneyness[order], strike_iv[order]
+
+
+def interpolate_slice(moneyness, iv, grid):
+    """ Linear interpolation onto the grid, NaN outside the quoted range """
+    has_iv = ~np.isnan(iv)
+    if not has_iv.any():
+        return np.full(len(grid), np.nan)
+    return np.interp(grid, moneyness[has_iv], iv[has_iv], left=np.nan, right=np.nan)
+
+
+def expiry_slice(bid, ask, bid_iv, ask_iv, strike, underlying, is_call, ttmdays, grid):
+    """ One expiry's ExpirySlice, the unit of work of the surface build """
+    moneyness, iv = strike_quotes(bid, ask, bid_iv, ask_iv, strike, underlying, is_call)
+    forward = float(underlying[0]) if len(underlying) > 0 else np.nan
+    return ExpirySlice(ttmdays, interpolate_slice(moneyness, iv, grid), moneyness, iv, forward)
+
+
+def term_structure(slices, days_til_maturity):
+    
+    """
+    Interpolates slices {key: ExpirySlice} across maturities for every
+    moneyness value. Returns an array of shape (moneyness, maturities).
+    """
     
+    pairs = sorted(slices.values(), key=lambda pair: pair.ttmdays)
+    days = np.array([pair.ttmdays for pair in pairs], dtype=float)
+    grid_size = len(pairs[0].grid_iv) if pairs else 0
+    surface = np.full((grid_size, len(days_til_maturity)), np.nan)
+    if not pairs:
+        return surface
     
+    ivs = np.vstack([pair.grid_iv for pair in pairs])
+    targets = np.asarray(days_til_maturity, dtype=float)
+    for m in range(grid_size):
+        has_iv = ~np.isnan(ivs[:, m])
+        if has_iv.any():
+            surface[m] = np.interp(targets, days[has_iv], ivs[has_iv, m],
+                                   left=np.nan, right=np.nan)
+    return surface
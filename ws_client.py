@@ -10,6 +10,9 @@ import pytz
 import logging
 import traceback
 import sys
+import os
+from vol_surface import expiration_from_code
+from profiling import timed
 
 class WSClient:
     
@@ -22,20 +25,37 @@ class WSClient:
         3. Subscription to channels (private and public channels)
         4. Keeping connection alive and reconnecting if dropped
         5. Correct distribution of incoming messages to other endpoints
+    Steps 1 to 3 overlap: auth and the instrument request go out together, 
+    the private requests follow the auth reply, and the public channels of 
+    the previous session's instruments (cached in memory and on disk) are 
+    subscribed right away, corrected once the instrument list arrives.
+    With channels "market" the connection only carries the market data 
+    (instruments, books, tickers, public trades), with "account" only an 
+    account's orders, portfolio and trades, see session_manager.py. "all" 
+    carries both.
+    All requests and channels cover the given currencies (BTC, ETH, ...).
     """
     
-    def __init__(self, feed, delta_hedger, api_key, api_secret):
+    def __init__(self, feed, delta_hedger, api_key, api_secret, 
+                 ws_url="wss://www.deribit.com/ws/api/v2", channels="all", currencies=None):
         
         self.feed = feed
         self.delta_hedger = delta_hedger
+        self.currencies = currencies or ["BTC"]
+        # hedger per currency, checked on that currency's portfolio updates
+        self.delta_hedgers = dict()
+        if delta_hedger is not None:
+            self.delta_hedgers[delta_hedger.currency] = delta_hedger
         self.logger = logging.getLogger("deribit")
         self.api_key = api_key
         self.api_secret = api_secret
-        self.ws_url = "wss://www.deribit.com/ws/api/v2"
+        self.ws_url = ws_url # e.g. ws://127.0.0.1:8765 for mock_deribit.py
+        self.channels = channels # all, market or account
         
         self.shutdown_client = False
         
         self.error_counter = 0
+        self.reconnects = 0
         self.ping_interval = 5
         self.ping_timeout = 2
         
@@ -45,6 +65,7 @@ class WSClient:
         """
         # unique, ascending ID later associated with specific call types (API endpoints)
         self.api_call_id_counter = 0
+        self.call_id_lock = threading.Lock() # ids are drawn from several threads
         
         # Call types (API endpoints)
         self.api_call_types = ["public/get_instruments", "public/subscribe", 
@@ -52,15 +73,21 @@ class WSClient:
                                "private/get_positions", "private/get_position", 
                                "private/buy", "private/sell", 
                                "private/cancel_by_label", "private/cancel_all", 
-                               "private/get_open_orders_by_currency"]
+                               "private/get_open_orders_by_currency", 
+                               "public/unsubscribe"]
         
         # For each call type, contains all associated call IDs
         self.api_call_ids = dict()
         
         self.build_api_call_ids() # Initiates the previous dictionary
         
+        # set by the bot, receives the replies to batched order requests
+        self.order_pipeline = None
+        
         self.active_options_contracts = []
         self.active_futures_contracts = []
+        self.instrument_replies = 0 # instrument lists (one per currency) still to come
+        self.instruments_complete = True
         
         
         # A number of flags associated with the state of the progess / connection
@@ -70,11 +97,33 @@ class WSClient:
         self.subscribed_public = False
         self.subscribed_private = False 
         
-        self.public_subscription_count = 0
+        # public subscription requests without reply, and the instruments subscribed
+        self.pending_subscriptions = set()
+        self.subscribed_options = set()
+        self.subscribed_futures = set()
+        self.subscription_segment = 400 # channels per subscribe request
+        self.subscription_lock = threading.Lock() # optimistic and actual subscribe may overlap
+        self.tape = True # public trades of all options and futures per currency (the trade tape)
+        self.subscribed_tape = False
+        
+        # instruments of the last session, for an immediate subscribe on (re)connect
+        self.instrument_cache_file = "instrument_cache.json"
+        self.cached_instruments = self.load_instrument_cache()
         
         # updated upon (re)connection
         self.connection_initiation_time = datetime.now(pytz.UTC)
         
+        # seconds from starting a connection to auth, instruments, 
+        # subscriptions and the first book, per (re)connect
+        self.bootstrap_start = None
+        self.bootstrap_times = dict()
+        self.bootstrap_history = []
+        self.awaiting_first_book = False
+        
+        # messages received per kind, only incremented on the websocket thread (read by metrics)
+        self.message_counts = dict.fromkeys(["reply", "futures_bbo", "book_snapshot", "book_change", 
+                                             "ticker", "tape", "orders", "portfolio", "trades"], 0)
+        
         
     def build_api_call_ids(self):
         for i in self.api_call_types:
@@ -83,6 +132,9 @@ class WSClient:
         
     def create_ws_connection(self):
         
+        self.bootstrap_start = time.perf_counter()
+        self.bootstrap_times = dict()
+        self.awaiting_first_book = True
         self.ws = websocket.WebSocketApp(self.ws_url, 
                                          on_open=self.on_open, 
                                          on_message=self.on_message, 
@@ -143,6 +195,7 @@ class WSClient:
         if not self.shutdown_client:
             if not self.connected:
                 self.logger.info("Reconnecting to Websocket.")
+                self.reconnects += 1
                 self.create_ws_connection()
     
     
@@ -174,7 +227,10 @@ class WSClient:
         self.got_active_contracts = False
         self.subscribed_public = False
         self.subscribed_private = False
-        self.public_subscription_count = 0
+        self.pending_subscriptions = set()
+        self.subscribed_options = set()
+        self.subscribed_futures = set()
+        self.subscribed_tape = False
     
     
     def daily_reconnect(self):
@@ -185,6 +241,7 @@ class WSClient:
                     if (now.hour == 8 and now.minute == 0 and now.second == 2):
                         self.close_ws()
                         time.sleep(5)
+                        self.reconnects += 1
                         self.create_ws_connection()
                     else:
                         time.sleep(0.4)        
@@ -196,18 +253,32 @@ class WSClient:
                 
             
     
-    def send_to_ws(self, data, call_type):
+    def new_call_id(self):
+        with self.call_id_lock:
+            call_id = self.api_call_id_counter
+            self.api_call_id_counter += 1
+        return call_id
+    
+    
+    def send_to_ws(self, data, call_type, call_id=None):
         # method used across modules to send to websocket
-        call_id = self.api_call_id_counter
+        if call_id is None:
+            call_id = self.new_call_id()
         message_to_send = {"jsonrpc" : "2.0", 
                            "id" : call_id, 
                            "method" : call_type, 
                            "params" : data}
         
         json_message_to_send = json.dumps(message_to_send)
-        self.ws.send(json_message_to_send)
+        self.send_frame(json_message_to_send, call_type, call_id)
+        return call_id
+    
+    
+    def send_frame(self, frame, call_type, call_id):
+        # already serialized request (e.g. order templates) with its call id
+        # registered before sending, the reply can arrive before send returns
         self.api_call_ids[call_type].append(call_id)
-        self.api_call_id_counter += 1   
+        self.ws.send(frame)
         
         
     def authenticate(self):
@@ -234,8 +305,13 @@ class WSClient:
         
     def get_instruments(self):
         call_type = "public/get_instruments"
-        message = {"currency" : "BTC", "expired" : False}
-        self.send_to_ws(message, call_type)
+        self.active_options_contracts = []
+        self.active_futures_contracts = []
+        self.instrument_replies = len(self.currencies)
+        self.instruments_complete = True # no error reply
+        for currency in self.currencies:
+            message = {"currency" : currency, "expired" : False}
+            self.send_to_ws(message, call_type)
         
     
     def collect_active_contracts(self, data):
@@ -248,51 +324,164 @@ class WSClient:
             elif len(instrument) - len(instrument.replace("-", "")) == 3:
                 if instrument[-1] == "C" or instrument[-1] == "P":
                     self.active_options_contracts.append(instrument)         
-        
     
-    def build_subscriptions(self, option_contracts, futures_contracts):
+    
+    def load_instrument_cache(self):
+        if not os.path.exists(self.instrument_cache_file):
+            return None
+        try:
+            with open(self.instrument_cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.info("Instrument cache not readable: {}".format(e))
+            return None
+    
+    
+    def save_instrument_cache(self):
+        try:
+            with open(self.instrument_cache_file, "w") as f:
+                json.dump(self.cached_instruments, f)
+        except OSError as e:
+            self.logger.info("Instrument cache not written: {}".format(e))
+    
+    
+    def unexpired(self, contracts):
+        """ Drops cached contracts that expired since they were cached """
+        now = datetime.now(pytz.UTC)
+        alive = []
+        for contract in contracts:
+            code = contract.split("-")[1]
+            try:
+                if expiration_from_code(code) <= now:
+                    continue
+            except ValueError: # e.g. PERPETUAL
+                pass
+            alive.append(contract)
+        return alive
+    
+    
+    def subscribe_public(self, option_contracts, futures_contracts, optimistic=False):
         
         """
-        Subscribing to all channels at the same time yields a response to large
-        for the websocket. Therefore, subscriptions are sent in segments.
+        Subscribes to the public channels of the given contracts which are 
+        not subscribed yet and unsubscribes those no longer given. Subscribing 
+        to all channels at the same time yields a response to large for the 
+        websocket. Therefore, subscriptions are sent in segments (back to back, 
+        the replies are counted in pending_subscriptions). An optimistic call 
+        (the cached instruments of the last session) only subscribes, and is 
+        skipped once the actual instrument list was subscribed.
         """
         
-        mid = round(len(option_contracts) / 2)
-        ob_channels_1 = ["book." + str(contract) + ".raw" 
-                         for contract in option_contracts[:mid]]
-        ob_channels_2 = ["book." + str(contract) + ".raw" 
-                         for contract in option_contracts[mid:]]
-        oi_channels_1 = ["ticker." + str(contract) + ".raw" 
-                         for contract in option_contracts[:mid]]
-        oi_channels_2 = ["ticker." + str(contract) + ".raw" 
-                         for contract in option_contracts[mid:]]
-        
-        futures_bbo_channels = ["book." + str(contract) + ".none.1.100ms" 
-                                for contract in futures_contracts]
-        
-        private_channels = ["user.orders.any.any.raw", "user.portfolio.btc", 
-                          "user.trades.any.any.raw"]
-        
-        channels = [ob_channels_1, ob_channels_2, oi_channels_1, oi_channels_2, 
-                    private_channels, futures_bbo_channels]
-        
-        for channel in channels:
-            if channel == private_channels:
-                call_type = "private/subscribe"
-            else:
-                call_type = "public/subscribe"
-            message = {"channels": channel}
-            self.send_to_ws(message, call_type)
-            time.sleep(0.2)
+        with self.subscription_lock:
+            if optimistic and self.got_active_contracts:
+                return
+            new_options = [c for c in option_contracts if c not in self.subscribed_options]
+            new_futures = [c for c in futures_contracts if c not in self.subscribed_futures]
+            gone_options = self.subscribed_options.difference(option_contracts)
+            gone_futures = self.subscribed_futures.difference(futures_contracts)
+            
+            channels = (["book." + str(contract) + ".raw" for contract in new_options]
+                        + ["ticker." + str(contract) + ".raw" for contract in new_options]
+                        + ["book." + str(contract) + ".none.1.100ms" for contract in new_futures])
+            # one trades channel per kind and currency instead of one per instrument
+            if self.tape and not self.subscribed_tape:
+                channels += ["trades.{}.{}.raw".format(kind, currency) 
+                             for currency in self.currencies for kind in ["option", "future"]]
+                self.subscribed_tape = True
+            
+            self.subscribed_options.update(new_options)
+            self.subscribed_futures.update(new_futures)
+            for i in range(0, len(channels), self.subscription_segment):
+                message = {"channels": channels[i:i+self.subscription_segment]}
+                call_id = self.new_call_id()
+                self.pending_subscriptions.add(call_id)
+                self.send_to_ws(message, "public/subscribe", call_id)
+            
+            # optimistically subscribed contracts which are not listed anymore
+            if (gone_options or gone_futures) and not optimistic:
+                self.subscribed_options.difference_update(gone_options)
+                self.subscribed_futures.difference_update(gone_futures)
+                channels = ["book." + str(contract) + ".none.1.100ms" for contract in gone_futures]
+                for contract in gone_options:
+                    channels += ["book." + str(contract) + ".raw", 
+                                 "ticker." + str(contract) + ".raw"]
+                    self.feed.ob.pop(contract, None)
+                    self.feed.trades.remove(contract)
+                for contract in gone_futures:
+                    self.feed.futures_bbo.pop(contract, None)
+                    self.feed.trades.remove(contract)
+                    if self.feed.bars is not None:
+                        self.feed.bars.remove(contract)
+                self.send_to_ws({"channels": channels}, "public/unsubscribe")
+            
+            self.check_public_subscriptions()
+    
+    
+    def subscribe_private(self):
+        private_channels = (["user.orders.any.any.raw", "user.trades.any.any.raw"] 
+                            + ["user.portfolio.{}".format(currency.lower()) 
+                               for currency in self.currencies])
+        self.send_to_ws({"channels": private_channels}, "private/subscribe")
+    
+    
+    def check_public_subscriptions(self):
+        # complete once the actual instrument list is subscribed and confirmed
+        if self.got_active_contracts and not self.pending_subscriptions:
+            if not self.subscribed_public:
+                self.subscribed_public = True
+                self.mark_bootstrap("subscribed")
+    
+    
+    def on_authenticated(self):
+        # private requests go out as soon as auth completes
+        self.mark_bootstrap("auth")
+        if self.channels == "market":
+            return
+        self.subscribe_private()
+        self.get_open_orders()
+        self.get_positions()
+    
+    
+    def on_instruments(self, data):
+        # the public channels follow once the lists of all currencies are in
+        if data is not None:
+            self.collect_active_contracts(data)
+        else:
+            self.instruments_complete = False
+        self.instrument_replies -= 1
+        if self.instrument_replies > 0:
+            return
+        self.got_active_contracts = True
+        self.mark_bootstrap("instruments")
+        # the lists of all currencies, never a part of them
+        if self.instruments_complete:
+            self.cached_instruments = {"options": list(self.active_options_contracts), 
+                                       "futures": list(self.active_futures_contracts)}
+            self.save_instrument_cache()
+        self.subscribe_public(self.active_options_contracts, self.active_futures_contracts)
+    
+    
+    def mark_bootstrap(self, step):
+        if self.bootstrap_start is not None:
+            self.bootstrap_times[step] = time.perf_counter() - self.bootstrap_start
+    
+    
+    def on_first_book(self):
+        self.awaiting_first_book = False
+        self.mark_bootstrap("first_book")
+        self.bootstrap_history.append(dict(self.bootstrap_times))
+        self.logger.info("Bootstrap: {}.".format(", ".join(
+            "{} {:.0f}ms".format(step, seconds * 1000) 
+            for step, seconds in sorted(self.bootstrap_times.items(), key=lambda t: t[1]))))
             
             
     def get_positions(self):
         call_type = "private/get_positions"
-        currency = "BTC"
         kind = ["future", "option"]
-        for k in kind:
-            message = {"currency":currency, "kind":k}
-            self.send_to_ws(message, call_type)
+        for currency in self.currencies:
+            for k in kind:
+                message = {"currency":currency, "kind":k}
+                self.send_to_ws(message, call_type)
     
     def get_single_position(self, instrument_name):
         call_type = "private/get_position"
@@ -302,12 +491,12 @@ class WSClient:
     
     def get_open_orders(self):
         call_type = "private/get_open_orders_by_currency"
-        currency = "BTC"
         typ = "all"
         kind = ["future", "option"]
-        for k in kind:
-            message = {"currency":currency, "type":typ, "kind":k}
-            self.send_to_ws(message, call_type)
+        for currency in self.currencies:
+            for k in kind:
+                message = {"currency":currency, "type":typ, "kind":k}
+                self.send_to_ws(message, call_type)
     
     
     def wait_for_connection(self):
@@ -343,25 +532,32 @@ class WSClient:
     
     
     def initiate_streams(self):
-        """ Procedure to set up all streams iteratively once previous step completed """
+        """ Sends the independent setup requests at once, then waits for all steps """
         try:
-            if not self.authenticated:
-                self.authenticate()
-                
-            self.wait_for_auth()
+            self.mark_bootstrap("open")
+            if self.channels == "market":
+                # authenticated nevertheless, raw book channels require it
+                self.subscribed_private = True
+            elif self.channels == "account":
+                # the books come from the market connection
+                self.got_active_contracts = True
+                self.subscribed_public = True
+                self.awaiting_first_book = False
             
-            self.get_open_orders()
-            self.get_positions()
+            if not self.authenticated:
+                self.authenticate() # private requests follow in on_authenticated
             
             if not self.got_active_contracts:
-                self.get_instruments()
+                self.get_instruments() # public subscriptions follow in on_instruments
                 
-            self.wait_for_instruments()
+                # meanwhile, optimistically subscribe the last session's instruments
+                if self.cached_instruments and not self.subscribed_options:
+                    self.subscribe_public(self.unexpired(self.cached_instruments["options"]), 
+                                          self.unexpired(self.cached_instruments["futures"]), 
+                                          optimistic=True)
             
-            if ((not self.subscribed_public) and (not self.subscribed_private)):
-                self.build_subscriptions(self.active_options_contracts, 
-                                         self.active_futures_contracts)
-                
+            self.wait_for_auth()
+            self.wait_for_instruments()
             self.wait_for_subscriptions()
             
         except KeyboardInterrupt:
@@ -372,6 +568,7 @@ class WSClient:
             self.on_error(0, e)
             
         
+    @timed
     def message_distribution(self, reply):
         
         """ 
@@ -384,26 +581,35 @@ class WSClient:
         reply = json.loads(reply)
         
         if "id" in reply:
+            self.message_counts["reply"] += 1
+            # replies to batched order requests are tracked per batch
+            tracked = False
+            if self.order_pipeline is not None:
+                tracked = self.order_pipeline.acknowledge(reply)
+            
             if "result" in reply:
 
                 if reply["id"] in self.api_call_ids["public/get_instruments"]:
-                    self.collect_active_contracts(reply)
-                    self.got_active_contracts = True
+                    self.on_instruments(reply)
                     
                 elif reply["id"] in self.api_call_ids["public/auth"]:
                     if reply["result"]["token_type"] == "bearer":
                         self.authenticated = True
+                        self.on_authenticated()
                     else:
                         self.authenticated = False
                         
                 elif reply["id"] in self.api_call_ids["public/subscribe"]:
-                    # 5 versions of public subscriptions are sent iteratively
-                    self.public_subscription_count += 1
-                    if self.public_subscription_count == 5:
-                        self.subscribed_public = True
+                    self.pending_subscriptions.discard(reply["id"])
+                    self.check_public_subscriptions()
+                
+                elif reply["id"] in self.api_call_ids["public/unsubscribe"]:
+                    pass
                         
                 elif reply["id"] in self.api_call_ids["private/subscribe"]:
                     self.subscribed_private = True
+                    if self.channels == "account":
+                        self.mark_bootstrap("subscribed")
                     
                 elif reply["id"] in self.api_call_ids["private/get_positions"]:
                     self.feed.initial_positions(reply["result"])
@@ -422,18 +628,30 @@ class WSClient:
                     
                 elif reply["id"] in self.api_call_ids["private/cancel_all"]:
                     if self.feed.orders:
-                        self.feed.orders = {}
+                        self.feed.clear_orders()
                 
                 elif reply["id"] in self.api_call_ids["private/cancel_by_label"]:
                     pass
                     
                 
                 else:
-                    self.logger.info("Unhandled reply (unknown id): {}".format(reply))
-            else:
-                self.logger.info("Unhandled reply (result not in reply): {}".format(reply))
+                    # payloads are formatted (shortened) on the logging thread, if not rate limited
+                    self.logger.info("Unhandled reply (unknown id): %.500s", reply)
+            elif reply["id"] in self.api_call_ids["public/subscribe"]:
+                # e.g. a cached contract that is gone, the instrument list corrects it
+                self.logger.info("Subscription error: %.500s", reply)
+                self.pending_subscriptions.discard(reply["id"])
+                self.check_public_subscriptions()
+            
+            elif reply["id"] in self.api_call_ids["public/get_instruments"]:
+                # e.g. a currency not listed, the others are subscribed nevertheless
+                self.logger.info("Instrument request failed: %.500s", reply)
+                self.on_instruments(None)
+            
+            elif not tracked:
+                self.logger.info("Unhandled reply (result not in reply): %.500s", reply)
         elif "method" not in reply:
-            self.logger.info("Unhandled reply (method not in reply): {}".format(reply))
+            self.logger.info("Unhandled reply (method not in reply): %.500s", reply)
                 
         
         if "method" in reply:
@@ -445,32 +663,51 @@ class WSClient:
                             
                             # Orderbook updates from futures trading pairs
                             if reply["params"]["channel"][-13:] == ".none.1.100ms":
+                                self.message_counts["futures_bbo"] += 1
                                 self.feed.update_futures_bbo(reply["params"]["data"])
+                                if self.awaiting_first_book:
+                                    self.on_first_book()
                             
                             # Orderbook updates from options contracts
-                            elif reply["params"]["channel"][:9] == "book.BTC-":
+                            elif reply["params"]["channel"][:5] == "book.":
                                 if "type" in reply["params"]["data"]:
                                     
                                     if reply["params"]["data"]["type"] == "snapshot":
+                                        self.message_counts["book_snapshot"] += 1
                                         self.feed.build_options_ob_from_snapshots(reply["params"]["data"])
+                                        if self.awaiting_first_book:
+                                            self.on_first_book()
                                     
                                     elif reply["params"]["data"]["type"] == "change":
+                                        self.message_counts["book_change"] += 1
                                         self.feed.update_options_ob(reply["params"]["data"])
                             
                             # OI updates from option contracts
-                            elif reply["params"]["channel"][:11] == "ticker.BTC-":
+                            elif reply["params"]["channel"][:7] == "ticker.":
+                                self.message_counts["ticker"] += 1
                                 self.feed.manage_option_oi(reply["params"]["data"])
                             
+                            # Public trades of a currency's options or futures
+                            elif reply["params"]["channel"][:7] == "trades.":
+                                self.message_counts["tape"] += 1
+                                self.feed.update_trades(reply["params"]["data"])
+                            
                             # Private channels
                             elif reply["params"]["channel"] == "user.orders.any.any.raw":
+                                self.message_counts["orders"] += 1
                                 self.feed.manage_orders(reply["params"]["data"])
                                 
-                            elif reply["params"]["channel"] == "user.portfolio.btc":
+                            elif reply["params"]["channel"][:15] == "user.portfolio.":
+                                self.message_counts["portfolio"] += 1
                                 self.feed.manage_portfolio(reply["params"]["data"])
-                                self.delta_hedger.check_deltas(self.send_to_ws)
+                                delta_hedger = self.delta_hedgers.get(
+                                    reply["params"]["channel"][15:].upper())
+                                if delta_hedger is not None:
+                                    delta_hedger.check_deltas(self.send_to_ws)
                                 
                                 
                             elif reply["params"]["channel"] == "user.trades.any.any.raw":
+                                self.message_counts["trades"] += 1
                                 self.feed.update_positions(reply["params"]["data"])
                                 for k in range(len(reply["params"]["data"])):
                                     if reply["params"]["data"][k]["instrument_name"] not in self.feed.positions: